@@ -18,24 +18,31 @@
 # A copy of the GNU General Public License is in the file COPYING.
 
 
-from pyndn import Name, ThreadsafeFace, Data, Interest
+from pyndn import Name, ThreadsafeFace, Data
 from pyndn.encoding import ProtobufTlv
 from repo_command_pb2 import RepoCommandParameterMessage
 from repo_response_pb2 import RepoCommandResponseMessage
 from pyndn.security import KeyChain
+from pyparsing import ParseException
+
+from repo_query import encodeQueryParams, splitKeyEqualities
+from result_stream import ResultStream
+from key_cache import KeyCache
+from record_decoder import RecordDecoder
+from result_writer import RESULT_WRITERS
+from columnar_result import ColumnarResult
+from simpleSQL import parseSelect
 
-from Crypto.Cipher import AES
 from Crypto.PublicKey import RSA
 from Crypto.Hash import SHA256
 
 import trollius as asyncio
-from trollius import From
+from trollius import From, Return
 import logging
-from bson import Binary, BSON
-import json
-import string
+from bson import Binary
+import multiprocessing
+from collections import OrderedDict, deque
 import datetime
-import re
 
 class NdnRepoClient(object):
     def __init__(self, repoPrefix=None):
@@ -46,8 +53,15 @@ class NdnRepoClient(object):
             self.repoPrefix = Name('/test/repo')
         self.loadKey()
         self.isStopped = False
-        self.dataReady = asyncio.Event()
-        self.resultQueue = asyncio.Queue()
+        # the most segments of a result to request at once
+        self.fetchWindow = 16
+        # decoding processes (None for one per core), and the most segments
+        # to decode at once
+        self.decodeWorkers = None
+        self.decodeAhead = 2*multiprocessing.cpu_count()
+        # where results go as they arrive (see result_writer.py), instead
+        # of being printed as tables
+        self.resultWriter = None
 
         self.log = logging.getLogger(str(self.__class__))
         h = logging.FileHandler('repo_client.log')
@@ -63,8 +77,9 @@ class NdnRepoClient(object):
         self.isStopped = True
         logging.getLogger('trollius').addHandler(h)
 
-        self.knownKeys = {}
-        self.pendingKeys = []
+        # decrypted keys to remember, and where to save them (or None)
+        self.maxKeys = 256
+        self.keyCacheFile = None
 
     def loadKey(self, keyFile='bms_key.pri'):
         self.keyId = '\xa2\xeb9\xbcGo$\xad\xbf\xe9?k\xb2\xb8|\xa8 E\x96\x13\x1e\xb9\x97\x91Z\xf6\xda\xd1]\xa1lD'
@@ -72,62 +87,24 @@ class NdnRepoClient(object):
             binDer = keyFile.read()
             self.privateKey = RSA.importKey(binDer)
 
-    @asyncio.coroutine
-    def _decryptAndPrintRecord(self, recordData, keyName, parentDoc):
-        keyUri = keyName.toUri()
-        def cleanString(dirty):
-            return ''.join(filter(string.printable.__contains__, str(dirty)))
-
-        def onKeyDataReceived(keyInterest, keyData):
-            self.log.debug('Got key for {}'.format(keyInterest.getName()))
-            cipherText = str(keyData.getContent())
-            symKeyRaw = self.privateKey.decrypt(cipherText)
-            symKey = symKeyRaw[-64:].decode('hex')
-
-            msg = recordData[8:]
-            iv = msg[:16]
-            cipherText = msg[16:]
-
-            cipher = AES.new(key=symKey, IV=iv, mode=AES.MODE_CBC)
-            decData = cleanString(cipher.decrypt(cipherText))
-
-            fromJson = json.loads(decData)
-            fromJson.update(parentDoc)
-            self.knownKeys[keyUri] = keyData
-            try:
-                self.pendingKeys.remove(keyUri)
-            except ValueError:
-                pass # already removed
+    def _decryptSymmetricKey(self, cipherText):
+        symKeyRaw = self.privateKey.decrypt(cipherText)
+        return symKeyRaw[-64:].decode('hex')
 
-            self.resultQueue.put_nowait(fromJson)
-
-        def onKeyTimeout(keyInterest):
-            self.log.error('Could not get decryption key for {}'.format(keyInterest.getName()))
-            self.resultQueue.put_nowait({})
-
-        i = Interest(keyName)
-        i.setMustBeFresh(False)
-        i.setInterestLifetimeMilliseconds(2000)
-
-        if keyUri in self.knownKeys:
-            self.log.debug('Using known key')
-            onKeyDataReceived(i, self.knownKeys[keyUri])
-        elif keyUri in self.pendingKeys:
-            self.log.debug('Waiting on pending key')
-            timeout = 0
-            while keyUri not in self.knownKeys:
-                yield From(asyncio.sleep(0.5))
-                timeout += 1
-                if timeout > 5:
-                    self.log.warn('Timed out on key {}'.format(keyUri))
-                    onKeyTimeout(i)
-                    break
-            else:
-                onKeyDataReceived(i, self.knownKeys[keyUri])
-        else:
-            self.log.debug('Adding {} to pending keys'.format(keyUri))
-            self.pendingKeys.append(keyUri)
-            self.keyFace.expressInterest(i, onKeyDataReceived, onKeyTimeout)
+    @asyncio.coroutine
+    def _decryptRecords(self, keyName, records):
+        """
+        Decrypt records that share a key.
+        :param records: (encrypted value, parent document) pairs
+        :return: The decrypted records, with the fields of their parent
+            documents added, or empty dicts if the key could not be fetched
+        """
+        symKey = yield From(self.keyCache.getKey(keyName))
+        if symKey is None:
+            self.log.error('Could not get decryption key {}'.format(keyName))
+            raise Return([{}]*len(records))
+        decoded = yield From(self.recordDecoder.decryptRecords(symKey, records))
+        raise Return(decoded)
 
     def prettifyResults(self, resultsList):
         # dictionary comparison is by length (# of k:v pairs)
@@ -163,127 +140,228 @@ class NdnRepoClient(object):
 
     @asyncio.coroutine
     def collectResults(self, allData):
-        try:
-            for record in allData:
-                parentDoc = {k:v for (k,v) in record.items() if k not in [u'_id', u'value']} 
-                aDataVal = str(record[u'value'])
-                keyTs = aDataVal[:8]
-                keyDataName = Name('/ndn/ucla.edu/bms/melnitz/kds').append(keyTs).append(self.keyId)
-                yield From(self._decryptAndPrintRecord(aDataVal, keyDataName, parentDoc))
-            receivedVals = []
-            try:
-                for i in asyncio.as_completed([
-                    self.resultQueue.get() for n in range(len(allData))], timeout=5):
-                    v = yield From(i)
-                    receivedVals.append(v)
-            except asyncio.TimeoutError:
-                pass
-            self.prettifyResults(receivedVals)
-            print
-        finally:
-            self.dataReady.set()
-
-    def onDataReceived(self, interest, data):
-        # now we have to retrieve the key
-        dataContent = str(data.getContent())
-        dataContent = BSON(dataContent)
-        dataDict = dataContent.decode()
-
+        """
+        Decrypt the records in a segment of results.
+        :return: A list of the decrypted records, in order
+        """
+        # records that share a key wait for a single fetch of it, and are
+        # decrypted in batches
+        keyGroups = OrderedDict()
+        for (i, record) in enumerate(allData):
+            parentDoc = {k:v for (k,v) in record.items() if k not in [u'_id', u'value']} 
+            aDataVal = str(record[u'value'])
+            keyTs = aDataVal[:8]
+            keyDataName = Name('/ndn/ucla.edu/bms/melnitz/kds').append(keyTs).append(self.keyId)
+            keyName, indices, records = keyGroups.setdefault(keyTs,
+                    (keyDataName, [], []))
+            indices.append(i)
+            records.append((aDataVal, parentDoc))
+
+        receivedVals = [None]*len(allData)
+        groupNames = keyGroups.keys()
+        decodedGroups = yield From(asyncio.gather(*[
+                self._decryptRecords(keyGroups[k][0], keyGroups[k][2])
+                for k in groupNames]))
+        for (keyTs, decoded) in zip(groupNames, decodedGroups):
+            for (i, record) in zip(keyGroups[keyTs][1], decoded):
+                receivedVals[i] = record
+        raise Return(receivedVals)
+
+    def printResults(self, dataDict, receivedVals, resultWriter=None):
+        if resultWriter is not None:
+            resultWriter.writeRecords(receivedVals)
+            return
         allData = dataDict['results']
-        totalCount = dataDict['count']
-        dataCount = len(allData)
-        skipPos = dataDict['skip']
         print '---------'
-        print 'Got {}/{} result(s), starting at {}'.format(dataCount, totalCount, skipPos)
-
-        asyncio.async(self.collectResults(allData))
+        print 'Got {}/{} result(s), starting at {}'.format(len(allData),
+                dataDict['count'], dataDict['skip'])
+        if len(receivedVals) > 0:
+            self.prettifyResults(receivedVals)
+        print
 
-    def onDataTimeout(self, interest):
-        self.log.warn("Timed out on {}".format(interest.toUri()))
-        self.dataReady.set()
+    @asyncio.coroutine
+    def fetchResults(self, dataName, resultWriter=None):
+        """
+        Fetch every segment of a query's results, printing them in order, or
+        passing them to resultWriter (by default, the client's resultWriter).
+        Up to decodeAhead segments are decrypted at once, so that the
+        decoding workers are kept busy.
+        """
+        if resultWriter is None:
+            resultWriter = self.resultWriter
+        stream = ResultStream(self.face, dataName, window=self.fetchWindow)
+        stream.start()
+        decoding = deque()
+        while True:
+            dataDict = yield From(stream.next())
+            if dataDict is None:
+                break
+            allData = dataDict['results']
+            if len(allData) == 0 or u'value' not in allData[0]:
+                # aggregate and projected results have nothing to decrypt
+                decoded = asyncio.Future()
+                decoded.set_result(allData)
+            else:
+                # now we have to retrieve the key
+                decoded = asyncio.async(self.collectResults(allData))
+            decoding.append((dataDict, decoded))
+            while len(decoding) >= self.decodeAhead:
+                dataDict, decoded = decoding.popleft()
+                self.printResults(dataDict, (yield From(decoded)), 
+                        resultWriter)
+        while len(decoding) > 0:
+            dataDict, decoded = decoding.popleft()
+            self.printResults(dataDict, (yield From(decoded)), resultWriter)
+        if stream.error is not None:
+            self.log.warn(stream.error)
 
-    def sendDataRequestCommand(self, dataName):
-        interest = Interest(dataName)
-        interest.setInterestLifetimeMilliseconds(4000)
-        self.face.expressInterest(interest, self.onDataReceived, self.onDataTimeout)
-        return interest
+    @asyncio.coroutine
+    def queryColumns(self, sqlStatement, **kwargs):
+        """
+        Run a query, collecting the results into arrays as they arrive. The
+        client must be connected.
+        :param kwargs: Passed on to ColumnarResult
+        :return: A ColumnarResult, or None if the query is malformed
+        :raise: ImportError if NumPy is not installed
+        """
+        dataName = self.assembleDataName(sqlStatement)
+        if dataName is None:
+            raise Return(None)
+        result = ColumnarResult(**kwargs)
+        yield From(self.fetchResults(dataName, result))
+        raise Return(result)
 
     def stop(self):
         self.isStopped = True
 
     def parseSqlSelect(self, statement):
-        statement = statement.strip()
-        queryDict = {}
         try:
-            selection, parts = re.split(r'\s+WHERE\s+', statement, flags=re.I) 
-        except ValueError:
-            print 'WHERE clause is missing'
-            return  None
-        
-        selectMatch = re.match(r'^SELECT\s+(?:(\*)|(\w+,(\s*\w+)*))', selection, flags=re.I)
-        if selectMatch is None:
-            print 'Malformed SELECT'
-            return None
-
-        expressions = re.split(r'\s+AND\s+', parts, flags=re.I)
-        for ex in expressions:
-            if len(ex) == 0:
-                continue
-            try:
-                k,v = ex.split('=')
-            except ValueError:
-                print 'Malformed WHERE clause {}'.format(ex)
-            else:
-                queryDict[k.strip()] = v.strip()
-        return queryDict
-
-        # get = pairs
-    def assembleDataName(self):
+            return parseSelect(statement.strip())
+        except ParseException as e:
+            print 'Malformed query: {}'.format(e)
+        except ValueError as e:
+            print 'Unsupported query: {}'.format(e)
+        return None
+
+    def assembleDataName(self, sqlStatement=None):
         schemaStr = ('/ndn/ucla.edu/bms/{building}/data/{room}/electrical/panel/{panel_name}/{quantity}/{data_type}')
         keyNames = ['building', 'room', 'panel_name', 'quantity', 'data_type']
-        sqlStatement = raw_input('Query> ').strip()
-        valueDict = self.parseSqlSelect(sqlStatement)
-        if valueDict is None:
+        if sqlStatement is None:
+            sqlStatement = raw_input('Query> ').strip()
+        query = self.parseSqlSelect(sqlStatement)
+        if query is None:
             return None
+        # equality on the name keys goes in the name, anything else is
+        # left for the repo to evaluate
+        valueDict, where = splitKeyEqualities(query['where'], keyNames)
         for k in keyNames:
             valueDict.setdefault(k, '_')
-        dataName = schemaStr.format(**valueDict)
-        return Name(dataName)
+        dataName = Name(schemaStr.format(**valueDict))
+        queryParams = {}
+        if where is not None:
+            queryParams['where'] = where
+        if query['aggregate'] is not None:
+            queryParams['aggregate'] = query['aggregate']
+        elif query['distinct']:
+            if len(query['columns']) == 1:
+                queryParams['distinct'] = query['columns'][0]
+            else:
+                # distinct combinations are the groups of those columns
+                queryParams['aggregate'] = {'functions':[], 
+                        'groupBy':query['columns'], 'bucket':None}
+        elif query['columns'] != ['*']:
+            queryParams['fields'] = query['columns']
+        for k in ('limit', 'offset'):
+            if query[k] is not None:
+                queryParams[k] = query[k]
+        if len(queryParams) > 0:
+            dataName.append(encodeQueryParams(queryParams))
+        return dataName
 
     @asyncio.coroutine
     def parseDataRequest(self):
         while True:
-            self.dataReady.clear()
             dataName = self.assembleDataName()
             if dataName is not None:
-                self.loop.call_soon(self.sendDataRequestCommand, dataName)
-                yield From(self.dataReady.wait())
+                yield From(self.fetchResults(dataName))
+
+    def start(self, sqlStatement=None):
+        """
+        Run queries typed at the prompt until EOF, or just sqlStatement if it
+        is given.
+        """
+        self.connect()
+        try:
+            if sqlStatement is None:
+                self.loop.run_until_complete(self.parseDataRequest())
+            else:
+                dataName = self.assembleDataName(sqlStatement)
+                if dataName is not None:
+                    self.loop.run_until_complete(self.fetchResults(dataName))
+        except (EOFError, KeyboardInterrupt):
+            pass
+        finally:
+            self.shutdown()
 
-    def start(self):
+    def connect(self):
+        """
+        Set up the faces and decoding workers, for queries run on the event
+        loop.
+        """
         self.isStopped = False
         self.loop = asyncio.get_event_loop()
-        
+
         self.face = ThreadsafeFace(self.loop, '')
         self.keyFace = ThreadsafeFace(self.loop, 'borges.metwi.ucla.edu')
         self.face.stopWhen(lambda:self.isStopped)
         self.keyFace.stopWhen(lambda:self.isStopped)
+        self.keyCache = KeyCache(self.keyFace, self._decryptSymmetricKey,
+                self.maxKeys, self.keyCacheFile)
+        self.recordDecoder = RecordDecoder(self.loop, self.decodeWorkers)
 
         k = KeyChain()
         self.face.setCommandSigningInfo(k, k.getDefaultCertificateName())
-        try:
-            self.loop.run_until_complete(self.parseDataRequest())
-        except (EOFError, KeyboardInterrupt):
-            pass
-        finally:
-            self.face.shutdown()
+
+    def shutdown(self):
+        self.face.shutdown()
+        self.keyFace.shutdown()
+        self.recordDecoder.shutdown()
+        self.keyCache.close()
         
 
 def main():
-    import threading
-    import time
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Query the BMS repo.')
+    parser.add_argument('query', nargs='?',
+            help='a SELECT statement to run, instead of prompting for queries')
+    parser.add_argument('-o', '--output', help='write results to this file')
+    parser.add_argument('-f', '--format', choices=sorted(RESULT_WRITERS),
+            help='write results as CSV or JSON lines instead of tables')
+    args = parser.parse_args()
+
+    if args.format is None and args.output is not None:
+        if args.output.endswith('.csv'):
+            args.format = 'csv'
+        else:
+            args.format = 'jsonl'
 
     client = NdnRepoClient()
-    client.start()
+    outFile = None
+    if args.format is not None:
+        if args.output is not None:
+            outFile = open(args.output, 'wb')
+        else:
+            outFile = sys.stdout
+        client.resultWriter = RESULT_WRITERS[args.format](outFile)
+    try:
+        client.start(args.query)
+    finally:
+        if outFile is not None:
+            client.resultWriter.close()
+            if outFile is not sys.stdout:
+                outFile.close()
 
 if __name__ == '__main__':
     main()
@@ -24,13 +24,29 @@ from pyndn.encoding import ProtobufTlv
 from repo_command_pb2 import RepoCommandParameterMessage
 from repo_response_pb2 import RepoCommandResponseMessage
 from pyndn.security import KeyChain
+from pyndn import Exclude
 import trollius as asyncio
-from trollius import From
 import logging
+from poll_scheduler import PollScheduler
+
 class NdnRepoPing(object):
     """
      A repo is supposed to be notified of new data by the publisher. Since the 
      publisher doesn't know about this repo, I will 'manually' poke the repo to      insert data points.
+
+     Each watch name is polled for Data newer than the last timestamp seen
+     under it, and the repo is only sent an insert command when there is
+     some, for that Data's name. The polls are spread out and rate limited by
+     a PollScheduler, and each name's poll interval follows how often it has
+     new data.
+
+     Polls go through the forwarder on pollHost, which the repo fetches
+     inserts through as well (the local forwarder doesn't reach the
+     publishers), so the repo's fetch is answered from that forwarder's
+     cache. A timed out poll says nothing about new data, so it leaves the
+     interval alone; after maxPollTimeouts in a row, the repo is sent an
+     insert command for the watch name anyway, to fetch the newest Data by
+     its own route.
     """
     def __init__(self, repoPrefix=None):
         super(NdnRepoPing, self).__init__()
@@ -38,7 +54,20 @@ class NdnRepoPing(object):
             self.repoPrefix = repoPrefix
         else:
             self.repoPrefix = Name('/test/repo')
-        self.repoWatchNames = []
+        # watch name URI -> last timestamp component seen under it
+        self.lastTimestamps = {}
+        # polling limits, in seconds and polls per second
+        self.initialInterval = 60*15
+        self.minInterval = 60
+        self.maxInterval = 60*60
+        self.pollRate = 10
+        self.pollBurst = 20
+        self.pollHost = 'borges.metwi.ucla.edu'
+        self.maxPollTimeouts = 3
+        # watch name URI -> polls timed out in a row
+        self.pollTimeouts = {}
+        self.scheduler = None
+        self.pollFace = None
         self.log = logging.getLogger(str(self.__class__))
         h = logging.FileHandler('repo_ping.log')
         h.setFormatter(logging.Formatter(
@@ -64,7 +93,8 @@ class NdnRepoPing(object):
         command = commandMessage.command
         for component in dataName:
             command.name.components.append(str(component.getValue()))
-        command.start_block_id = command.end_block_id = 0
+        # no block ids: we want the reading named (or the latest under a
+        # watch name), not segments of one
         commandComponent = ProtobufTlv.encode(commandMessage)
 
         interestName = Name(self.repoPrefix).append('insert')
@@ -75,13 +105,50 @@ class NdnRepoPing(object):
         
         self.face.expressInterest(interest, self.onDataReceived, self.onTimeout)
 
-    @asyncio.coroutine
-    def sendNextInsertRequest(self):
-        sleepTime = 60*15
-        while True:
-            for name in self.repoWatchNames:
-                self.sendRepoInsertCommand(name)
-            yield From(asyncio.sleep(sleepTime))
+    def pollWatchName(self, watchName):
+        """
+        Ask for the newest Data under watchName, excluding timestamps up to
+        the last one seen.
+        """
+        watchUri = watchName.toUri()
+        interest = Interest(watchName)
+        interest.setChildSelector(1)
+        interest.setInterestLifetimeMilliseconds(4000)
+        lastTimestamp = self.lastTimestamps.get(watchUri)
+        if lastTimestamp is not None:
+            exclude = Exclude()
+            exclude.appendAny()
+            exclude.appendComponent(lastTimestamp)
+            interest.setExclude(exclude)
+        self.pollFace.expressInterest(interest,
+                lambda i, d: self.onPollData(watchName, d),
+                lambda i: self.onPollTimeout(watchName))
+
+    def onPollTimeout(self, watchName):
+        watchUri = watchName.toUri()
+        timeoutCount = self.pollTimeouts.get(watchUri, 0) + 1
+        if timeoutCount < self.maxPollTimeouts:
+            self.pollTimeouts[watchUri] = timeoutCount
+            return
+        self.log.warn('{} polls of {} timed out, asking the repo to insert '
+                'it anyway'.format(timeoutCount, watchUri))
+        self.pollTimeouts.pop(watchUri, None)
+        self.sendRepoInsertCommand(watchName)
+
+    def onPollData(self, watchName, data):
+        watchUri = watchName.toUri()
+        self.pollTimeouts.pop(watchUri, None)
+        dataName = data.getName()
+        if dataName.size() <= watchName.size():
+            self.scheduler.onPollResult(watchUri, False)
+            return
+        timestamp = dataName[watchName.size()]
+        lastTimestamp = self.lastTimestamps.get(watchUri)
+        foundNew = lastTimestamp is None or timestamp.compare(lastTimestamp) > 0
+        if foundNew:
+            self.lastTimestamps[watchUri] = timestamp
+            self.sendRepoInsertCommand(dataName)
+        self.scheduler.onPollResult(watchUri, foundNew)
 
     def start(self):
         self.isStopped = False
@@ -91,17 +158,34 @@ class NdnRepoPing(object):
         k = KeyChain()
         self.face.setCommandSigningInfo(k, k.getDefaultCertificateName())
         self.face.stopWhen(lambda:self.isStopped)
+        if self.pollHost is None:
+            self.pollFace = self.face
+        else:
+            self.pollFace = ThreadsafeFace(self.loop, self.pollHost)
+        self.scheduler = PollScheduler(self.loop, self.pollWatchName,
+                self.initialInterval, self.minInterval, self.maxInterval,
+                self.pollRate, self.pollBurst)
         try:
-            self.loop.run_until_complete(self.sendNextInsertRequest())
+            self.loop.run_until_complete(self.scheduler.run())
         finally:
             self.face.shutdown()
+            if self.pollFace is not self.face:
+                self.pollFace.shutdown()
 
     def stop(self):
         self.isStopped = True
+        if self.scheduler is not None:
+            self.loop.call_soon_threadsafe(self.scheduler.stop)
 
     def addWatchName(self, newName):
-        if newName not in self.repoWatchNames:
-            self.repoWatchNames.append(Name(newName))
+        newName = Name(newName)
+        self.scheduler.add(newName.toUri(), newName)
+
+    def removeWatchName(self, oldName):
+        oldUri = Name(oldName).toUri()
+        self.scheduler.remove(oldUri)
+        self.lastTimestamps.pop(oldUri, None)
+        self.pollTimeouts.pop(oldUri, None)
 
 def assembleDataName():
     schemaStr = ('/ndn/ucla.edu/bms/{building}/data/{room}/electrical/panel/{panel_name}/{quantity}/{data_type}')
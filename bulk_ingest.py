@@ -0,0 +1,211 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+Buffers documents headed for the database so they can be written in batches
+instead of one round trip per document.
+"""
+
+import logging
+import time
+from functools import partial
+
+import trollius as asyncio
+from trollius import From
+
+class BulkIngestBuffer(object):
+    """
+     Collects sanitized documents and hands them to a batch writer when
+     maxDocuments are waiting or the oldest has waited maxDelay seconds,
+     whichever comes first. Batches are written in the loop's default
+     executor, one at a time, so the event loop never blocks on the database.
+
+     Other writes that must not run alongside a batch (or each other) can be
+     run in the executor between batches, through call().
+
+     writeBatch(schema, documents) is called in the executor for each schema
+     in the batch; it must return a dict with 'nUpserted' and 'nMatched' counts
+     (as StorageEngine.bulkUpsert() does), and raise if the write failed. It
+     may also count documents that were already stored, in 'nDuplicates'.
+    """
+    def __init__(self, loop, writeBatch, maxDocuments=500, maxDelay=0.5):
+        super(BulkIngestBuffer, self).__init__()
+        self.loop = loop
+        self.writeBatch = writeBatch
+        self.maxDocuments = maxDocuments
+        self.maxDelay = maxDelay
+
+        self._pending = []
+        self._flushHandle = None
+        self._isWriting = False
+        # (function, args, future) to run in the executor between batches
+        self._calls = []
+        # while draining, everything buffered is written without waiting;
+        # the futures are resolved when nothing is left to write
+        self._drainCount = 0
+        self._idleWaiters = []
+
+        self.log = logging.getLogger(str(self.__class__))
+
+        self.startTime = time.time()
+        self.stats = {'buffered':0, 'written':0, 'upserted':0, 'matched':0,
+                'duplicates':0, 'batches':0, 'failed':0, 'writeSeconds':0.0}
+
+    def add(self, schema, document, onDurable=None):
+        """
+        Queue a document for writing.
+        :param onDurable: Called with True once the document is written, or
+            with False if the write failed
+        """
+        self._pending.append((schema, document, onDurable))
+        self.stats['buffered'] += 1
+        if len(self._pending) >= self.maxDocuments or self._drainCount > 0:
+            self.flush()
+        elif self._flushHandle is None:
+            self._flushHandle = self.loop.call_later(self.maxDelay, self.flush)
+
+    def flush(self):
+        """
+        Start writing everything that is buffered. If a batch is already being
+        written, the flush happens as soon as it finishes.
+        """
+        if self._flushHandle is not None:
+            self._flushHandle.cancel()
+            self._flushHandle = None
+        if self._isWriting or len(self._pending) == 0:
+            return
+
+        batch = self._pending
+        self._pending = []
+        self._isWriting = True
+        writeFuture = self.loop.run_in_executor(None, self._writeBatch, batch)
+        writeFuture.add_done_callback(partial(self._onBatchWritten, batch,
+                time.time()))
+
+    def call(self, function, *args):
+        """
+        Run function(*args) in the executor as soon as no batch is being
+        written, and before the next batch.
+        :return: A future for what the function returns
+        """
+        future = asyncio.Future(loop=self.loop)
+        self._calls.append((function, args, future))
+        if not self._isWriting:
+            self._writeNext()
+        return future
+
+    def isWriting(self):
+        """
+        :return: Whether a batch, or a function given to call(), is running
+            in the executor
+        """
+        return self._isWriting
+
+    @asyncio.coroutine
+    def drain(self):
+        """
+        Write everything that is buffered, without waiting for maxDelay, and
+        wait until it has been written, along with any batch already being
+        written. Documents added meanwhile are written too. Run this before
+        shutting down, or buffered documents are lost.
+        """
+        self._drainCount += 1
+        try:
+            self.flush()
+            while (self._isWriting or len(self._pending) > 0 or
+                    len(self._calls) > 0):
+                waiter = asyncio.Future(loop=self.loop)
+                self._idleWaiters.append(waiter)
+                yield From(waiter)
+        finally:
+            self._drainCount -= 1
+
+    def _writeBatch(self, batch):
+        # runs in the executor
+        documentsBySchema = {}
+        for (schema, document, onDurable) in batch:
+            documentsBySchema.setdefault(schema, []).append(document)
+        results = []
+        for (schema, documents) in documentsBySchema.items():
+            results.append(self.writeBatch(schema, documents))
+        return results
+
+    def _onBatchWritten(self, batch, startTime, writeFuture):
+        self._isWriting = False
+        self.stats['writeSeconds'] += time.time() - startTime
+        success = writeFuture.exception() is None
+        if success:
+            self.stats['batches'] += 1
+            self.stats['written'] += len(batch)
+            for result in writeFuture.result():
+                self.stats['upserted'] += result.get('nUpserted', 0)
+                self.stats['matched'] += result.get('nMatched', 0)
+                self.stats['duplicates'] += result.get('nDuplicates', 0)
+        else:
+            self.stats['failed'] += len(batch)
+            self.log.error('Could not write {} document(s): {}'.format(
+                    len(batch), writeFuture.exception()))
+
+        for (schema, document, onDurable) in batch:
+            if onDurable is not None:
+                onDurable(success)
+        self._writeNext()
+
+    def _onCallDone(self, future, callFuture):
+        self._isWriting = False
+        if callFuture.exception() is not None:
+            future.set_exception(callFuture.exception())
+        else:
+            future.set_result(callFuture.result())
+        self._writeNext()
+
+    def _writeNext(self):
+        if self._isWriting:
+            # a callback has already started a batch
+            return
+        if len(self._calls) > 0:
+            (function, args, future) = self._calls.pop(0)
+            self._isWriting = True
+            callFuture = self.loop.run_in_executor(None, function, *args)
+            callFuture.add_done_callback(partial(self._onCallDone, future))
+        elif len(self._pending) >= self.maxDocuments or (self._drainCount > 0
+                and len(self._pending) > 0):
+            self.flush()
+        elif len(self._pending) > 0 and self._flushHandle is None:
+            self._flushHandle = self.loop.call_later(self.maxDelay, self.flush)
+
+        if not self._isWriting:
+            (waiters, self._idleWaiters) = (self._idleWaiters, [])
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    def getStats(self):
+        """
+        Insert throughput counters, including the current buffer depth and the
+        average number of documents written per second since creation.
+        """
+        stats = dict(self.stats)
+        stats['depth'] = len(self._pending)
+        elapsed = time.time() - self.startTime
+        if elapsed > 0:
+            stats['writtenPerSecond'] = stats['written']/elapsed
+        else:
+            stats['writtenPerSecond'] = 0.0
+        return stats
@@ -0,0 +1,139 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+Collects query results into NumPy arrays, one per field, for analysis.
+NumPy is only needed if this is used.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def _toFloat(value):
+    """
+    :return: The value as a float, or NaN if it is missing or not a number
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+class ColumnarResult(object):
+    """
+     Query results stored by column: ts as datetime64 (microseconds), the
+     decoded values as floats (NaN where a record has none, or one that is not
+     a number), and each key as integer codes into a list of its distinct
+     values, in the order they were first seen. Records are added a segment
+     at a time, with writeRecords(), so this can be used as a client's result
+     writer.
+    """
+    def __init__(self, keyNames=('building', 'room', 'panel_name', 'quantity',
+            'quantity_type'), valueField='val', capacity=1024):
+        """
+        :param valueField: The field of the decoded records holding the
+            reading (the encrypted 'value' is gone once they are decoded)
+        """
+        super(ColumnarResult, self).__init__()
+        if np is None:
+            raise ImportError('ColumnarResult needs NumPy')
+        self.keyNames = list(keyNames)
+        self.valueField = valueField
+        self.size = 0
+
+        self._ts = np.empty(capacity, dtype='datetime64[us]')
+        self._values = np.empty(capacity, dtype=np.float64)
+        self._codes = {k:np.empty(capacity, dtype=np.int32)
+                for k in self.keyNames}
+        # key name -> list of values, and value -> code
+        self.categories = {k:[] for k in self.keyNames}
+        self._categoryCodes = {k:{} for k in self.keyNames}
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def ts(self):
+        return self._ts[:self.size]
+
+    @property
+    def values(self):
+        return self._values[:self.size]
+
+    def codes(self, keyName):
+        """
+        :return: The codes of a key, indexes into categories[keyName]; -1
+            where a record has no value for it
+        """
+        return self._codes[keyName][:self.size]
+
+    def column(self, keyName):
+        """
+        :return: The values of a key as an array of objects
+        """
+        categories = np.array(self.categories[keyName] + [None], dtype=object)
+        return categories[self.codes(keyName)]
+
+    def writeRecords(self, records):
+        records = [r for r in records if len(r) > 0]
+        count = len(records)
+        if count == 0:
+            return
+        self._reserve(self.size + count)
+        end = self.size + count
+
+        self._ts[self.size:end] = [r.get('ts') for r in records]
+        self._values[self.size:end] = [_toFloat(r.get(self.valueField))
+                for r in records]
+        for keyName in self.keyNames:
+            categories = self.categories[keyName]
+            categoryCodes = self._categoryCodes[keyName]
+            segmentCodes = []
+            for record in records:
+                value = record.get(keyName)
+                if value is None:
+                    segmentCodes.append(-1)
+                    continue
+                code = categoryCodes.get(value)
+                if code is None:
+                    code = len(categories)
+                    categoryCodes[value] = code
+                    categories.append(value)
+                segmentCodes.append(code)
+            self._codes[keyName][self.size:end] = segmentCodes
+        self.size = end
+
+    def _reserve(self, capacity):
+        if capacity <= len(self._ts):
+            return
+        newCapacity = max(capacity, 2*len(self._ts))
+        self._ts = self._grow(self._ts, newCapacity)
+        self._values = self._grow(self._values, newCapacity)
+        for keyName in self.keyNames:
+            self._codes[keyName] = self._grow(self._codes[keyName],
+                    newCapacity)
+
+    def _grow(self, array, capacity):
+        grown = np.empty(capacity, dtype=array.dtype)
+        grown[:self.size] = array[:self.size]
+        return grown
+
+    def close(self):
+        pass
@@ -0,0 +1,103 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+Limits how many insert fetches run at once, and shares them out between
+publishers.
+"""
+
+import time
+from collections import OrderedDict, deque
+
+class FetchQueue(object):
+    """
+     Runs at most maxInFlight fetches at a time. Fetches beyond that wait in
+     a queue of at most maxQueued, and are started in turn from each
+     publisher that has some waiting, so that one busy publisher does not
+     hold up the others.
+
+     A fetch is submitted as a function that starts it; the owner calls
+     onFetchDone() when a started fetch is over, for whatever reason.
+    """
+    def __init__(self, maxInFlight=32, maxQueued=1024):
+        super(FetchQueue, self).__init__()
+        self.maxInFlight = maxInFlight
+        self.maxQueued = maxQueued
+        self.inFlight = 0
+        self.queuedCount = 0
+
+        # publisher -> deque of (time queued, start function), in turn order
+        self._queues = OrderedDict()
+
+        self.stats = {'started':0, 'queued':0, 'rejected':0, 'maxDepth':0,
+                'waitSeconds':0.0}
+
+    def isFull(self):
+        return (self.inFlight >= self.maxInFlight and
+                self.queuedCount >= self.maxQueued)
+
+    def reject(self):
+        """
+        Count a fetch that was turned away because the queue was full.
+        """
+        self.stats['rejected'] += 1
+
+    def submit(self, publisher, startFetch):
+        """
+        Start the fetch now, or queue it behind others.
+        :return: False if the queue is full and the fetch was not accepted
+        """
+        if self.inFlight < self.maxInFlight:
+            self._start(startFetch)
+            return True
+        if self.queuedCount >= self.maxQueued:
+            self.reject()
+            return False
+        queue = self._queues.get(publisher)
+        if queue is None:
+            queue = self._queues[publisher] = deque()
+        queue.append((time.time(), startFetch))
+        self.queuedCount += 1
+        self.stats['queued'] += 1
+        self.stats['maxDepth'] = max(self.stats['maxDepth'], self.queuedCount)
+        return True
+
+    def onFetchDone(self):
+        self.inFlight -= 1
+        while self.inFlight < self.maxInFlight and len(self._queues) > 0:
+            # the next publisher in turn goes to the back of the line
+            (publisher, queue) = self._queues.popitem(last=False)
+            (queuedTime, startFetch) = queue.popleft()
+            if len(queue) > 0:
+                self._queues[publisher] = queue
+            self.queuedCount -= 1
+            self.stats['waitSeconds'] += time.time() - queuedTime
+            self._start(startFetch)
+
+    def _start(self, startFetch):
+        self.inFlight += 1
+        self.stats['started'] += 1
+        startFetch()
+
+    def getStats(self):
+        stats = dict(self.stats)
+        stats['inFlight'] = self.inFlight
+        stats['depth'] = self.queuedCount
+        stats['publishers'] = len(self._queues)
+        return stats
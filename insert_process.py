@@ -0,0 +1,257 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+Keeps track of insert commands, for 'insert check', and for as long as they
+are useful.
+"""
+
+import time
+from collections import OrderedDict
+
+class InsertProcess(object):
+    """
+    The progress of one insert command, as reported by 'insert check'.
+    insertNum counts the documents that have been written so far.
+
+    A process is first fetching its data, then writing it (while writes are
+    outstanding), and finally done or failed.
+    """
+    STATE_FETCHING = 'fetching'
+    STATE_WRITING = 'writing'
+    STATE_DONE = 'done'
+    STATE_FAILED = 'failed'
+
+    def __init__(self, processId, dataName, startBlockId=None,
+            endBlockId=None):
+        super(InsertProcess, self).__init__()
+        self.processId = processId
+        self.dataName = dataName
+        self.startBlockId = startBlockId
+        self.endBlockId = endBlockId
+        self.state = self.STATE_FETCHING
+        self.statusCode = 100
+        self.insertNum = 0
+        self.pendingWrites = 0
+        self.fetcher = None
+        # called with the process when its state changes
+        self.onStateChanged = None
+
+    def isSegmented(self):
+        return self.startBlockId is not None
+
+    def isFetching(self):
+        return self.state == self.STATE_FETCHING
+
+    def isFinished(self):
+        return self.state in (self.STATE_DONE, self.STATE_FAILED)
+
+    def getCoalesceKey(self):
+        """
+        Insert commands with the same key can share a fetch.
+        """
+        return (self.dataName.toUri(), self.startBlockId, self.endBlockId)
+
+    def onFetchDone(self, statusCode=None):
+        """
+        No more data will be fetched for this process. If statusCode is given,
+        the process failed with that code.
+        """
+        if not self.isFetching():
+            return
+        self.fetcher = None
+        if statusCode is not None:
+            self.statusCode = statusCode
+        self._setState(self.STATE_WRITING)
+        self._updateStatus()
+
+    def onWriteDone(self, success):
+        self.pendingWrites -= 1
+        if success:
+            self.insertNum += 1
+        else:
+            self.statusCode = 500
+        self._updateStatus()
+
+    def _updateStatus(self):
+        if self.state != self.STATE_WRITING or self.pendingWrites > 0:
+            return
+        if self.statusCode == 100:
+            self.statusCode = 200
+            self._setState(self.STATE_DONE)
+        else:
+            self._setState(self.STATE_FAILED)
+
+    def _setState(self, state):
+        self.state = state
+        if self.onStateChanged is not None:
+            self.onStateChanged(self)
+
+    def fillResponse(self, response):
+        response.process_id = self.processId
+        response.status_code = self.statusCode
+        response.insert_num = self.insertNum
+        if self.startBlockId is not None:
+            response.start_block_id = self.startBlockId
+        if self.endBlockId is not None:
+            response.end_block_id = self.endBlockId
+
+class WatchProcess(InsertProcess):
+    """
+    A watch command: the repo keeps fetching Data newer than lastTimestamp
+    under dataName until the watch is stopped. insertNum counts the
+    documents written so far. Watch check reports status 300 while the
+    watch runs, and 101 once it is stopped.
+    """
+    STATE_WATCHING = 'watching'
+    STATE_STOPPED = 'stopped'
+
+    def __init__(self, processId, dataName):
+        super(WatchProcess, self).__init__(processId, dataName)
+        self.state = self.STATE_WATCHING
+        self.statusCode = 300
+        self.lastTimestamp = None
+        # whether an Interest for the watch is queued or outstanding, and
+        # whether the current round of them has found new Data
+        self.isPolling = False
+        self.foundNew = False
+        self.failedWrites = 0
+
+    def isWatching(self):
+        return self.state == self.STATE_WATCHING
+
+    def stop(self):
+        self.statusCode = 101
+        self._setState(self.STATE_STOPPED)
+
+    def onWriteDone(self, success):
+        self.pendingWrites -= 1
+        if success:
+            self.insertNum += 1
+        else:
+            self.failedWrites += 1
+
+class InsertProcessTable(object):
+    """
+     Insert processes by process id, up to maxProcesses. A finished process
+     is kept for ttl seconds, so that its status can still be checked, and
+     is then forgotten. If the table is full, the processes that finished
+     first are forgotten first, then the oldest unfinished ones; these keep
+     running, but can no longer be checked.
+
+     While a process is fetching, an insert command for the same data shares
+     it, rather than starting another fetch.
+    """
+    def __init__(self, maxProcesses=4096, ttl=300):
+        super(InsertProcessTable, self).__init__()
+        self.maxProcesses = maxProcesses
+        self.ttl = ttl
+        self.nextProcessId = 0
+
+        # process id -> process, oldest first
+        self._processes = OrderedDict()
+        # coalesce key -> process, while it is fetching
+        self._fetching = {}
+        # process id -> time it finished, in that order
+        self._finished = OrderedDict()
+
+        self.stats = {'created':0, 'coalesced':0, 'expired':0, 'evicted':0}
+
+    def __len__(self):
+        return len(self._processes)
+
+    def get(self, processId):
+        """
+        :return: The process, or None if it is unknown or was forgotten
+        """
+        self._expire()
+        return self._processes.get(processId)
+
+    def newProcessId(self):
+        """
+        :return: A process id that has not been used yet, e.g. for a watch
+        """
+        processId = self.nextProcessId
+        self.nextProcessId += 1
+        return processId
+
+    def findFetching(self, dataName, startBlockId=None, endBlockId=None):
+        """
+        :return: The process fetching this data, or None
+        """
+        return self._fetching.get((dataName.toUri(), startBlockId, endBlockId))
+
+    def findOrCreate(self, dataName, startBlockId=None, endBlockId=None):
+        """
+        :return: (process, isNew): the process still fetching the same data,
+            or else a new one, which the caller should start fetching
+        """
+        self._expire()
+        key = (dataName.toUri(), startBlockId, endBlockId)
+        process = self._fetching.get(key)
+        if process is not None:
+            self.stats['coalesced'] += 1
+            return (process, False)
+
+        process = InsertProcess(self.newProcessId(), dataName, startBlockId,
+                endBlockId)
+        self.stats['created'] += 1
+        process.onStateChanged = self._onStateChanged
+        self._processes[process.processId] = process
+        self._fetching[key] = process
+        self._trim()
+        return (process, True)
+
+    def _onStateChanged(self, process):
+        key = process.getCoalesceKey()
+        if self._fetching.get(key) is process:
+            del self._fetching[key]
+        if (process.isFinished() and
+                process.processId in self._processes):
+            self._finished[process.processId] = time.time()
+
+    def _expire(self):
+        expiry = time.time() - self.ttl
+        while len(self._finished) > 0:
+            (processId, finishTime) = next(self._finished.iteritems())
+            if finishTime > expiry:
+                break
+            del self._finished[processId]
+            self._processes.pop(processId, None)
+            self.stats['expired'] += 1
+
+    def _trim(self):
+        while len(self._processes) > self.maxProcesses:
+            if len(self._finished) > 0:
+                (processId, finishTime) = self._finished.popitem(last=False)
+                process = self._processes.pop(processId)
+            else:
+                (processId, process) = self._processes.popitem(last=False)
+                key = process.getCoalesceKey()
+                if self._fetching.get(key) is process:
+                    del self._fetching[key]
+                process.onStateChanged = None
+            self.stats['evicted'] += 1
+
+    def getStats(self):
+        stats = dict(self.stats)
+        stats['processes'] = len(self._processes)
+        stats['fetching'] = len(self._fetching)
+        stats['finished'] = len(self._finished)
+        return stats
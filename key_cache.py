@@ -0,0 +1,198 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+Fetches and remembers the symmetric keys that data records are encrypted
+with.
+"""
+
+import os
+from collections import OrderedDict
+
+import trollius as asyncio
+from trollius import From, Return
+
+from pyndn import Interest
+
+class KeyCache(object):
+    """
+     Decrypted keys by key name, for the most recently used maxKeys names.
+     A key that is not known is fetched with an Interest on face, and its
+     content decrypted with decryptKey(content), once: any other requests
+     for it while the fetch is outstanding wait on the same future.
+
+     If cacheFile is given, keys are also saved there, readable only by the
+     owner, and loaded again by the next KeyCache to use the file. Only the
+     maxStoredKeys most recently used keys are kept in the file: keys are
+     appended as they are fetched, and the file is rewritten with just those
+     keys when it is loaded with more lines, when it grows to twice as many,
+     and on close().
+    """
+    def __init__(self, face, decryptKey, maxKeys=256, cacheFile=None,
+            lifetime=2000, maxStoredKeys=4096):
+        super(KeyCache, self).__init__()
+        self.face = face
+        self.decryptKey = decryptKey
+        self.maxKeys = maxKeys
+        self.cacheFile = cacheFile
+        self.lifetime = lifetime
+        self.maxStoredKeys = maxStoredKeys
+
+        # key URI -> decrypted key
+        self._keys = OrderedDict()
+        # key URI -> future for the decrypted key, while it is fetched
+        self._pending = {}
+        # key URI -> decrypted key, for keys in the cache file, least
+        # recently used first; and the number of lines in the file
+        self._storedKeys = OrderedDict()
+        self._fileLines = 0
+        if cacheFile is not None:
+            self._loadCacheFile()
+
+        self.stats = {'hits':0, 'misses':0, 'coalesced':0, 'fetched':0,
+                'failed':0}
+
+    @asyncio.coroutine
+    def getKey(self, keyName):
+        """
+        :param keyName: The pyndn Name of the key Data
+        :return: The decrypted key, or None if it could not be fetched
+        """
+        keyUri = keyName.toUri()
+        symKey = self._keys.pop(keyUri, None)
+        if keyUri in self._storedKeys:
+            symKey = self._storedKeys.pop(keyUri)
+            self._storedKeys[keyUri] = symKey
+        if symKey is not None:
+            self.stats['hits'] += 1
+            self._keys[keyUri] = symKey
+            self._trim()
+            raise Return(symKey)
+
+        future = self._pending.get(keyUri)
+        if future is None:
+            self.stats['misses'] += 1
+            future = asyncio.Future()
+            self._pending[keyUri] = future
+            interest = Interest(keyName)
+            interest.setMustBeFresh(False)
+            interest.setInterestLifetimeMilliseconds(self.lifetime)
+            self.face.expressInterest(interest,
+                    lambda i, d: self._onKeyData(keyUri, d),
+                    lambda i: self._onKeyTimeout(keyUri))
+        else:
+            self.stats['coalesced'] += 1
+        symKey = yield From(asyncio.shield(future))
+        raise Return(symKey)
+
+    def _onKeyData(self, keyUri, keyData):
+        future = self._pending.pop(keyUri, None)
+        try:
+            symKey = self.decryptKey(str(keyData.getContent()))
+        except (ValueError, TypeError):
+            symKey = None
+        if symKey is None:
+            self.stats['failed'] += 1
+        else:
+            self.stats['fetched'] += 1
+            self._keys[keyUri] = symKey
+            self._trim()
+            self._storeKey(keyUri, symKey)
+        if future is not None and not future.done():
+            future.set_result(symKey)
+
+    def _onKeyTimeout(self, keyUri):
+        # forget the fetch, so the next request for the key tries again
+        future = self._pending.pop(keyUri, None)
+        self.stats['failed'] += 1
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    def _trim(self):
+        while len(self._keys) > self.maxKeys:
+            self._keys.popitem(last=False)
+
+    def _trimStoredKeys(self):
+        while len(self._storedKeys) > self.maxStoredKeys:
+            self._storedKeys.popitem(last=False)
+
+    def _loadCacheFile(self):
+        try:
+            with open(self.cacheFile, 'r') as cacheFile:
+                for line in cacheFile:
+                    self._fileLines += 1
+                    try:
+                        keyUri, symKeyHex = line.split()
+                        symKey = symKeyHex.decode('hex')
+                    except (ValueError, TypeError):
+                        continue # e.g. a line cut short by a crash
+                    # later lines are more recent
+                    self._storedKeys.pop(keyUri, None)
+                    self._storedKeys[keyUri] = symKey
+        except IOError:
+            pass # no keys saved yet
+        self._trimStoredKeys()
+        if self._fileLines > len(self._storedKeys):
+            self._rewriteCacheFile()
+
+    def _rewriteCacheFile(self):
+        """
+        Replace the cache file with one holding just the stored keys.
+        """
+        tempFile = self.cacheFile + '.tmp'
+        try:
+            fd = os.open(tempFile, os.O_WRONLY|os.O_TRUNC|os.O_CREAT, 0600)
+            with os.fdopen(fd, 'w') as cacheFile:
+                for (keyUri, symKey) in self._storedKeys.items():
+                    cacheFile.write('{} {}\n'.format(keyUri,
+                            symKey.encode('hex')))
+            os.rename(tempFile, self.cacheFile)
+        except (IOError, OSError):
+            return # keep appending to the old file
+        self._fileLines = len(self._storedKeys)
+
+    def _storeKey(self, keyUri, symKey):
+        if self.cacheFile is None:
+            return
+        self._storedKeys.pop(keyUri, None)
+        self._storedKeys[keyUri] = symKey
+        self._trimStoredKeys()
+        if self._fileLines >= 2*self.maxStoredKeys:
+            self._rewriteCacheFile()
+            return
+        fd = os.open(self.cacheFile, os.O_WRONLY|os.O_APPEND|os.O_CREAT,
+                0600)
+        with os.fdopen(fd, 'a') as cacheFile:
+            cacheFile.write('{} {}\n'.format(keyUri, symKey.encode('hex')))
+        self._fileLines += 1
+
+    def close(self):
+        """
+        Rewrite the cache file with the most recently used keys, if it has
+        others.
+        """
+        if self.cacheFile is not None and self._fileLines > len(
+                self._storedKeys):
+            self._rewriteCacheFile()
+
+    def getStats(self):
+        stats = dict(self.stats)
+        stats['keys'] = len(self._keys)
+        stats['storedKeys'] = len(self._storedKeys)
+        return stats
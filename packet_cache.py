@@ -0,0 +1,142 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+Caches the wire encoding of recently inserted or requested Data packets, so
+that Interests for them are answered without going to the database.
+"""
+
+from pyndn import Name
+from collections import OrderedDict
+
+class PacketCache(object):
+    """
+     An LRU cache of wire-encoded Data by name URI, holding at most maxBytes.
+
+     It also remembers which packet answered an Interest for a prefix, by
+     prefix URI and ChildSelector, for as long as that packet is cached.
+     Inserting Data under a prefix forgets the answers for that prefix, since
+     the new Data may be the one to give now. Each remembered answer counts
+     the length of its prefix URI towards maxBytes.
+    """
+    def __init__(self, maxBytes=8*1024*1024):
+        super(PacketCache, self).__init__()
+        self.maxBytes = maxBytes
+        self.currentBytes = 0
+
+        # name URI -> wire encoding
+        self._packets = OrderedDict()
+        # prefix URI -> {ChildSelector: name URI}
+        self._prefixes = {}
+        # name URI -> set of prefix URIs that it answers
+        self._answers = {}
+
+        self.stats = {'hits':0, 'misses':0, 'evictions':0}
+
+    def get(self, nameUri):
+        try:
+            wire = self._packets.pop(nameUri)
+        except KeyError:
+            self.stats['misses'] += 1
+            return None
+        self._packets[nameUri] = wire
+        self.stats['hits'] += 1
+        return wire
+
+    def getForPrefix(self, prefixUri, childSelector):
+        nameUri = self._prefixes.get(prefixUri, {}).get(childSelector)
+        if nameUri is None:
+            self.stats['misses'] += 1
+            return None
+        return self.get(nameUri)
+
+    def put(self, nameUri, wire):
+        if len(wire) > self.maxBytes:
+            return
+        if nameUri in self._packets:
+            self._packets[nameUri] = self._packets.pop(nameUri)
+            return
+        self._packets[nameUri] = wire
+        self.currentBytes += len(wire)
+        self._evict()
+
+    def putForPrefix(self, prefixUri, childSelector, nameUri, wire):
+        self.put(nameUri, wire)
+        if nameUri not in self._packets:
+            return
+        if childSelector in self._prefixes.get(prefixUri, {}):
+            self._removeAnswer(prefixUri, childSelector)
+        self._prefixes.setdefault(prefixUri, {})[childSelector] = nameUri
+        self._answers.setdefault(nameUri, set()).add(prefixUri)
+        self.currentBytes += len(prefixUri)
+        self._evict()
+
+    def invalidate(self, dataName):
+        """
+        Forget the answers for every prefix of a newly inserted Data name.
+        """
+        for i in range(dataName.size()+1):
+            prefixUri = dataName.getPrefix(i).toUri()
+            for childSelector in list(self._prefixes.get(prefixUri, ())):
+                self._removeAnswer(prefixUri, childSelector)
+
+    def invalidatePrefix(self, prefix):
+        """
+        Forget every packet under a prefix, and the answers they gave, as
+        when the Data under it is deleted.
+        """
+        for nameUri in [u for u in self._packets if prefix.match(Name(u))]:
+            self._removePacket(nameUri)
+
+    def _evict(self):
+        while self.currentBytes > self.maxBytes and len(self._packets) > 0:
+            oldestUri = next(iter(self._packets))
+            self._removePacket(oldestUri)
+            self.stats['evictions'] += 1
+
+    def _removeAnswer(self, prefixUri, childSelector):
+        answers = self._prefixes[prefixUri]
+        nameUri = answers.pop(childSelector)
+        self.currentBytes -= len(prefixUri)
+        if len(answers) == 0:
+            del self._prefixes[prefixUri]
+        if nameUri in answers.values():
+            # it still answers for the other ChildSelector
+            return
+        prefixUris = self._answers.get(nameUri)
+        if prefixUris is not None:
+            prefixUris.discard(prefixUri)
+            if len(prefixUris) == 0:
+                del self._answers[nameUri]
+
+    def _removePacket(self, nameUri):
+        wire = self._packets.pop(nameUri)
+        self.currentBytes -= len(wire)
+        for prefixUri in list(self._answers.get(nameUri, ())):
+            answers = self._prefixes.get(prefixUri, {})
+            for (childSelector, answerUri) in answers.items():
+                if answerUri == nameUri:
+                    self._removeAnswer(prefixUri, childSelector)
+
+    def getStats(self):
+        stats = dict(self.stats)
+        stats['packets'] = len(self._packets)
+        stats['bytes'] = self.currentBytes
+        stats['prefixes'] = len(self._prefixes)
+        return stats
@@ -0,0 +1,213 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+Polls a large set of names, each at an interval that follows how often it
+has new data, without sending the polls in bursts.
+"""
+
+import heapq
+import random
+
+import trollius as asyncio
+from trollius import From
+
+class TokenBucket(object):
+    """
+     Allows rate events per second on average, and up to burst at once.
+    """
+    def __init__(self, loop, rate, burst):
+        super(TokenBucket, self).__init__()
+        self.loop = loop
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.lastTime = loop.time()
+
+    def take(self):
+        """
+        Take a token if there is one.
+        :return: 0 if a token was taken, or else the seconds until there will
+            be one
+        """
+        now = self.loop.time()
+        self.tokens = min(self.burst,
+                self.tokens + (now - self.lastTime)*self.rate)
+        self.lastTime = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens)/self.rate
+
+class PollEntry(object):
+    def __init__(self, key, name, interval):
+        super(PollEntry, self).__init__()
+        self.key = key
+        self.name = name
+        self.interval = interval
+        self.lastPollTime = None
+        self.dueTime = None
+        self.newCount = 0
+        self.emptyCount = 0
+
+class PollScheduler(object):
+    """
+     Calls poll(name) for each name added, roughly every interval seconds
+     for that name. The caller reports the outcome of each poll with
+     onPollResult(): a poll that found new data halves the name's interval,
+     and one that found none makes it 1.5 times longer, within minInterval
+     and maxInterval. A name that publishes every P seconds is thus polled
+     about every P seconds.
+
+     Each wait is varied by up to jitter (a fraction of the interval), and
+     new names start at a random point in their first interval, so names
+     added together are not polled together. No more than rate polls are
+     sent per second, after an initial burst.
+
+     Names are kept by key (e.g. the name's URI), so membership checks and
+     removal do not depend on the number of names; due polls are kept in a
+     heap.
+    """
+    def __init__(self, loop, poll, initialInterval=900, minInterval=60,
+            maxInterval=3600, rate=10, burst=20, jitter=0.1):
+        super(PollScheduler, self).__init__()
+        self.loop = loop
+        self.poll = poll
+        self.initialInterval = initialInterval
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.jitter = jitter
+        self.tokenBucket = TokenBucket(loop, rate, burst)
+        self.isStopped = False
+
+        # key -> PollEntry
+        self._entries = {}
+        # (due time, key), including stale ones for rescheduled or removed
+        # entries, which are skipped when they come up
+        self._due = []
+        self._wakeup = None
+
+        self.stats = {'polls':0, 'new':0, 'empty':0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def add(self, key, name):
+        """
+        Start polling name, unless key is already being polled.
+        :return: True if the name was added
+        """
+        if key in self._entries:
+            return False
+        entry = PollEntry(key, name, self.initialInterval)
+        self._entries[key] = entry
+        self._schedule(entry,
+                self.loop.time() + random.uniform(0, entry.interval))
+        return True
+
+    def remove(self, key):
+        self._entries.pop(key, None)
+
+    def getEntry(self, key):
+        return self._entries.get(key)
+
+    def onPollResult(self, key, foundNew):
+        """
+        Adjust the interval of a name after a poll of it.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        if foundNew:
+            self.stats['new'] += 1
+            entry.newCount += 1
+            interval = max(self.minInterval, entry.interval/2.0)
+        else:
+            self.stats['empty'] += 1
+            entry.emptyCount += 1
+            interval = min(self.maxInterval, entry.interval*1.5)
+        if interval != entry.interval:
+            entry.interval = interval
+            self._schedule(entry, entry.lastPollTime + self._wait(entry))
+
+    def stop(self):
+        self.isStopped = True
+        self._wake()
+
+    @asyncio.coroutine
+    def run(self):
+        """
+        Poll names as they come due, until stop() is called.
+        """
+        while not self.isStopped:
+            delay = self._nextDelay()
+            if delay is None or delay > 0:
+                self._wakeup = asyncio.Future(loop=self.loop)
+                yield From(asyncio.wait([self._wakeup], timeout=delay,
+                        loop=self.loop))
+                self._wakeup = None
+                continue
+
+            delay = self.tokenBucket.take()
+            if delay > 0:
+                yield From(asyncio.sleep(delay, loop=self.loop))
+                continue
+
+            (dueTime, key) = heapq.heappop(self._due)
+            entry = self._entries[key]
+            now = self.loop.time()
+            entry.lastPollTime = now
+            self._schedule(entry, now + self._wait(entry))
+            self.stats['polls'] += 1
+            self.poll(entry.name)
+
+    def _wait(self, entry):
+        return entry.interval*(1 + random.uniform(-self.jitter, self.jitter))
+
+    def _schedule(self, entry, dueTime):
+        entry.dueTime = dueTime
+        heapq.heappush(self._due, (dueTime, entry.key))
+        if dueTime == self._due[0][0]:
+            self._wake()
+
+    def _wake(self):
+        if self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+
+    def _nextDelay(self):
+        """
+        :return: The seconds until the next poll is due, or None if there are
+            no names
+        """
+        while len(self._due) > 0:
+            (dueTime, key) = self._due[0]
+            entry = self._entries.get(key)
+            if entry is not None and entry.dueTime == dueTime:
+                return max(0, dueTime - self.loop.time())
+            heapq.heappop(self._due)
+        return None
+
+    def getStats(self):
+        stats = dict(self.stats)
+        stats['names'] = len(self._entries)
+        stats['queued'] = len(self._due)
+        return stats
@@ -0,0 +1,198 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+Caches encoded query responses, so repeated queries don't go back to the
+database until data they could match is inserted.
+"""
+
+import operator
+import time
+from collections import OrderedDict
+
+def freezeQuery(query):
+    """
+    Turn a query document into something hashable, so that equal queries
+    give equal keys no matter how their dicts are ordered.
+    """
+    if isinstance(query, dict):
+        return tuple(sorted((k, freezeQuery(v)) for (k, v) in query.items()))
+    if isinstance(query, (list, tuple)):
+        return tuple(freezeQuery(v) for v in query)
+    return query
+
+_COMPARISONS = {'$lt':operator.lt, '$lte':operator.le, '$gt':operator.gt,
+        '$gte':operator.ge}
+
+def documentMatches(query, document):
+    """
+    Whether a document could be returned by a query. Fields missing from the
+    document never match, except with $ne. Operators that aren't understood
+    are assumed to match, so nothing stale is kept.
+    """
+    for (k, v) in query.items():
+        if k == '$and':
+            if not all(documentMatches(q, document) for q in v):
+                return False
+        elif k == '$or':
+            if not any(documentMatches(q, document) for q in v):
+                return False
+        elif k.startswith('$'):
+            continue
+        elif isinstance(v, dict):
+            if not _operatorsMatch(v, k, document):
+                return False
+        elif k not in document or document[k] != v:
+            return False
+    return True
+
+def _operatorsMatch(operators, fieldName, document):
+    for (op, operand) in operators.items():
+        if op == '$ne':
+            if document.get(fieldName) == operand:
+                return False
+        elif fieldName not in document:
+            return False
+        elif op == '$in':
+            if document[fieldName] not in operand:
+                return False
+        elif op in _COMPARISONS:
+            try:
+                if not _COMPARISONS[op](document[fieldName], operand):
+                    return False
+            except TypeError:
+                pass # e.g. naive and aware datetimes
+    return True
+
+class QueryResultCache(object):
+    """
+     An LRU cache of encoded response segments, keyed by schema name, query and
+     a hashable segment key (e.g. the frozen continuation token the segment
+     was requested with), that holds at most maxBytes of content. Inserting a
+     document evicts every segment of the queries it matches.
+    """
+    def __init__(self, maxBytes=16*1024*1024):
+        super(QueryResultCache, self).__init__()
+        self.maxBytes = maxBytes
+        self.currentBytes = 0
+
+        # (schemaName, queryKey, segmentKey) -> encoded content
+        self._segments = OrderedDict()
+        # schemaName -> {queryKey: (query, set of segment keys)}
+        self._queries = {}
+
+        self.stats = {'hits':0, 'misses':0, 'evictions':0, 'invalidations':0}
+
+    def get(self, schemaName, query, segmentKey):
+        key = (schemaName, freezeQuery(query), segmentKey)
+        try:
+            encoded = self._segments.pop(key)
+        except KeyError:
+            self.stats['misses'] += 1
+            return None
+        # move to the most recently used end
+        self._segments[key] = encoded
+        self.stats['hits'] += 1
+        return encoded
+
+    def put(self, schemaName, query, segmentKey, encoded):
+        if len(encoded) > self.maxBytes:
+            return
+        queryKey = freezeQuery(query)
+        key = (schemaName, queryKey, segmentKey)
+        if key in self._segments:
+            self._removeSegment(key)
+        self._segments[key] = encoded
+        self.currentBytes += len(encoded)
+        schemaQueries = self._queries.setdefault(schemaName, {})
+        schemaQueries.setdefault(queryKey, (query, set()))[1].add(segmentKey)
+
+        while self.currentBytes > self.maxBytes:
+            oldestKey = next(iter(self._segments))
+            self._removeSegment(oldestKey)
+            self.stats['evictions'] += 1
+
+    def invalidate(self, schemaName, document):
+        """
+        Evict the cached segments of every query that could match the newly
+        written document.
+        """
+        schemaQueries = self._queries.get(schemaName)
+        if not schemaQueries:
+            return
+        for (queryKey, (query, segmentKeys)) in schemaQueries.items():
+            if documentMatches(query, document):
+                for segmentKey in list(segmentKeys):
+                    self._removeSegment((schemaName, queryKey, segmentKey))
+                self.stats['invalidations'] += 1
+
+    def invalidateSchema(self, schemaName):
+        """
+        Evict every cached segment for a schema.
+        """
+        for (queryKey, (query, segmentKeys)) in self._queries.get(schemaName, {}).items():
+            for segmentKey in list(segmentKeys):
+                self._removeSegment((schemaName, queryKey, segmentKey))
+            self.stats['invalidations'] += 1
+
+    def _removeSegment(self, key):
+        schemaName, queryKey, segmentKey = key
+        encoded = self._segments.pop(key)
+        self.currentBytes -= len(encoded)
+        schemaQueries = self._queries[schemaName]
+        segmentKeys = schemaQueries[queryKey][1]
+        segmentKeys.discard(segmentKey)
+        if len(segmentKeys) == 0:
+            del schemaQueries[queryKey]
+
+    def getStats(self):
+        stats = dict(self.stats)
+        stats['segments'] = len(self._segments)
+        stats['bytes'] = self.currentBytes
+        return stats
+
+class CountCache(object):
+    """
+     Remembers result counts for up to maxEntries queries, for ttl seconds.
+     A remembered count may be out of date by the inserts since it was taken.
+    """
+    def __init__(self, maxEntries=1024, ttl=30):
+        super(CountCache, self).__init__()
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        # (schemaName, queryKey) -> (count, expiry time)
+        self._counts = OrderedDict()
+
+    def get(self, schemaName, query):
+        key = (schemaName, freezeQuery(query))
+        try:
+            count, expiry = self._counts[key]
+        except KeyError:
+            return None
+        if expiry < time.time():
+            del self._counts[key]
+            return None
+        return count
+
+    def put(self, schemaName, query, count):
+        key = (schemaName, freezeQuery(query))
+        self._counts.pop(key, None)
+        self._counts[key] = (count, time.time()+self.ttl)
+        while len(self._counts) > self.maxEntries:
+            self._counts.popitem(last=False)
@@ -0,0 +1,198 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+Keeps track of how each query's results are split into segments, so that
+segment Interests can be answered without working the split out again.
+"""
+
+import time
+from collections import OrderedDict
+
+from query_cache import freezeQuery, documentMatches
+
+class QuerySession(object):
+    """
+     The results of one query at one version (snapshot), split into segments.
+     The results only include documents whose _id is below the snapshot bound
+     asOf, i.e. that had been written when the version was made; the version
+     number itself only names the snapshot.
+     segments[n] is (position of the first result, token to resume after,
+     number of results) for each segment found so far; the scan for more
+     segments resumes after scanToken. finalSegment is set once the scan has
+     reached the end of the results.
+
+     options holds the query parameters that shape the results rather than
+     choose them: 'fields', 'offset', 'limit', 'distinct' and 'aggregate' (see
+     repo_query.py). For aggregate and distinct queries, the results are the
+     groups or values, which are all found at once.
+    """
+    def __init__(self, schema, dataQuery, after, version, asOf,
+            options=None):
+        super(QuerySession, self).__init__()
+        if options is None:
+            options = {}
+        self.schema = schema
+        self.dataQuery = dataQuery
+        self.after = after
+        self.options = options
+        self.fields = options.get('fields')
+        self.offset = options.get('offset') or 0
+        self.limit = options.get('limit')
+        self.distinct = options.get('distinct')
+        self.aggregate = options.get('aggregate')
+        self.version = version
+        self.asOf = asOf
+        self.queryKey = (freezeQuery(dataQuery), freezeQuery(after),
+                freezeQuery(options))
+
+        # after any offset and limit are applied
+        self.totalCount = None
+        self.isCountExact = True
+        self.segments = []
+        self.finalSegment = None
+        self.scanToken = after
+        if after is None:
+            self.scanPos = 0
+        else:
+            self.scanPos = after['pos']
+
+    def isGrouped(self):
+        return self.aggregate is not None or self.distinct is not None
+
+    def getCacheKey(self, segmentNum):
+        # the version also fixes the count the segments report
+        return self.queryKey[1:] + (self.asOf, self.version, segmentNum)
+
+class QuerySessionTable(object):
+    """
+     The most recently used query sessions, up to maxSessions. Since a session
+     can always be rebuilt from its version's snapshot bound, forgetting one
+     only costs a scan; the bounds of the last maxVersions versions are kept
+     for that, with the result counts their sessions reported, so that a
+     rebuilt session reports them again. The table also remembers the latest
+     version of each query, which is the version given to Interests that
+     don't name one, until a matching document is inserted.
+    """
+    def __init__(self, maxSessions=256, maxVersions=4096):
+        super(QuerySessionTable, self).__init__()
+        self.maxSessions = maxSessions
+        self.maxVersions = maxVersions
+        # (schemaName, queryKey, version) -> session
+        self._sessions = OrderedDict()
+        # schemaName -> {queryKey: session}
+        self._latest = {}
+        # version -> (schemaName, snapshot bound, {queryKey: count})
+        self._versions = OrderedDict()
+        self._lastVersion = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def newVersion(self, schemaName, asOf):
+        """
+        Make a version number for a snapshot of the schema's documents: the
+        time in milliseconds, made larger than any given before.
+        """
+        version = max(int(time.time()*1000), self._lastVersion+1)
+        self._lastVersion = version
+        self._versions[version] = (schemaName, asOf, {})
+        while len(self._versions) > self.maxVersions:
+            self._versions.popitem(last=False)
+        return version
+
+    def getBound(self, schemaName, version):
+        """
+        :return: The snapshot bound of the version, or None if it is not a
+            version of the schema, or has been forgotten
+        """
+        (versionSchemaName, asOf, counts) = self._versions.get(version,
+                (None, None, None))
+        if versionSchemaName != schemaName:
+            return None
+        return asOf
+
+    def getCount(self, version, queryKey):
+        """
+        :return: The (count, whether the count is exact) reported for the
+            query at the version, or None
+        """
+        record = self._versions.get(version)
+        if record is None:
+            return None
+        return record[2].get(queryKey)
+
+    def putCount(self, version, queryKey, count):
+        record = self._versions.get(version)
+        if record is not None:
+            record[2][queryKey] = count
+
+    def get(self, schemaName, queryKey, version):
+        key = (schemaName, queryKey, version)
+        try:
+            session = self._sessions.pop(key)
+        except KeyError:
+            return None
+        self._sessions[key] = session
+        return session
+
+    def getLatest(self, schemaName, queryKey):
+        session = self._latest.get(schemaName, {}).get(queryKey)
+        if session is not None:
+            # keep it in the LRU order too
+            self.get(schemaName, queryKey, session.version)
+        return session
+
+    def add(self, session, isLatest=False):
+        schemaName = session.schema.name
+        self._sessions[(schemaName, session.queryKey, session.version)] = session
+        if isLatest:
+            self._latest.setdefault(schemaName, {})[session.queryKey] = session
+        while len(self._sessions) > self.maxSessions:
+            (schemaName, queryKey, version), oldSession = \
+                    self._sessions.popitem(last=False)
+            latest = self._latest.get(schemaName, {})
+            if latest.get(queryKey) is oldSession:
+                del latest[queryKey]
+
+    def invalidate(self, schemaName, document):
+        """
+        New Interests for queries that match the newly written document will
+        get a new version. Existing versions are unchanged.
+        """
+        latest = self._latest.get(schemaName)
+        if not latest:
+            return
+        for (queryKey, session) in latest.items():
+            # a session continuing from a token keeps the token's snapshot
+            if session.after is None and documentMatches(session.dataQuery,
+                    document):
+                del latest[queryKey]
+
+    def invalidateSchema(self, schemaName):
+        """
+        Every query for the schema will get a new version, and the existing
+        versions are forgotten, since their results may have changed.
+        """
+        self._latest.pop(schemaName, None)
+        for key in [k for k in self._sessions if k[0] == schemaName]:
+            del self._sessions[key]
+        for version in [v for (v, record) in self._versions.items()
+                if record[0] == schemaName]:
+            del self._versions[version]
@@ -0,0 +1,97 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+Decrypts and decodes BMS records in worker processes, so that large results
+don't hold up the event loop.
+"""
+
+import json
+import string
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from Crypto.Cipher import AES
+
+import trollius as asyncio
+from trollius import From, Return
+
+_PRINTABLE = frozenset(string.printable)
+
+def decryptRecords(symKey, records):
+    """
+    Decrypt and decode records that share a key. Runs in a worker process.
+    :param records: (encrypted value, parent document) pairs
+    :return: The decoded records, with the fields of their parent documents
+        added, in the same order. A record that can't be decoded becomes an
+        empty dict.
+    """
+    decoded = []
+    for (recordData, parentDoc) in records:
+        msg = recordData[8:]
+        iv = msg[:16]
+        cipherText = msg[16:]
+        try:
+            cipher = AES.new(key=symKey, IV=iv, mode=AES.MODE_CBC)
+            decData = ''.join(c for c in cipher.decrypt(cipherText)
+                    if c in _PRINTABLE)
+            fromJson = json.loads(decData)
+        except ValueError:
+            decoded.append({})
+            continue
+        fromJson.update(parentDoc)
+        decoded.append(fromJson)
+    return decoded
+
+class RecordDecoder(object):
+    """
+     Splits records into batches of up to batchSize, and decodes the batches
+     in a pool of maxWorkers processes (by default, one per core). Up to
+     inlineSize records are decoded on the event loop instead, since that
+     costs less than sending them to a worker.
+    """
+    def __init__(self, loop, maxWorkers=None, batchSize=256, inlineSize=8):
+        super(RecordDecoder, self).__init__()
+        if maxWorkers is None:
+            maxWorkers = multiprocessing.cpu_count()
+        self.loop = loop
+        self.maxWorkers = maxWorkers
+        self.batchSize = batchSize
+        self.inlineSize = inlineSize
+        self.pool = ProcessPoolExecutor(maxWorkers)
+
+    @asyncio.coroutine
+    def decryptRecords(self, symKey, records):
+        """
+        :return: The decoded records, as the module's decryptRecords returns
+            them
+        """
+        if len(records) <= self.inlineSize:
+            raise Return(decryptRecords(symKey, records))
+        batchFutures = [self.loop.run_in_executor(self.pool, decryptRecords,
+                symKey, records[i:i+self.batchSize])
+                for i in range(0, len(records), self.batchSize)]
+        decoded = []
+        for batchFuture in batchFutures:
+            batch = yield From(batchFuture)
+            decoded.extend(batch)
+        raise Return(decoded)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
@@ -23,24 +23,41 @@ retrieve data. It uses a similar protocol as repo-ng, except that message parts
 """
 
 #TODO:
-# - allow multiple schemata
 # - use config file to set signing key
 # - support deletion
 
-import pymongo as mongo
 from repo_command_pb2 import RepoCommandParameterMessage
 from repo_response_pb2 import RepoCommandResponseMessage
+from bulk_ingest import BulkIngestBuffer
+from segment_fetcher import SegmentFetcher
+from query_cache import QueryResultCache, CountCache, freezeQuery
+from query_session import QuerySession, QuerySessionTable
+from repo_query import encodeQueryParams, decodeQueryParams, isQueryParams
+from packet_cache import PacketCache
+from schema_trie import SchemaTrie
+from insert_process import InsertProcessTable, WatchProcess
+from poll_scheduler import PollScheduler
+from fetch_queue import FetchQueue
+from storage_engine import MongoStorageEngine, ASCENDING, DESCENDING
+from repo_metrics import RepoMetrics, MeteredStorage
 
-from pyndn import Name, Data, Interest, ThreadsafeFace
+from pyndn import Name, Data, Interest, Exclude, ThreadsafeFace
 from pyndn.security import KeyChain
 from pyndn.encoding import ProtobufTlv
 from bson.binary import Binary
 from bson import BSON
+from bson.son import SON
+from bson.objectid import ObjectId
 import trollius as asyncio
 import logging
 import struct
+import time
+import hashlib
+import json
+import os
+from functools import partial
 
-from datetime import datetime
+from datetime import datetime, timedelta
 class NdnSchema(object):
     #TODO: how do we include annotations, e.g units?
     # are these separate from data points (I think so...)
@@ -48,8 +65,26 @@ class NdnSchema(object):
     SCHEMA_INT = 'int'
     SCHEMA_BINARY = 'blob'
     SCHEMA_TIMESTAMP = 'time'
+    SCHEMA_FLOAT = 'float'
 
-    def __init__(self, nameSchema, schemaProps=None):
+    # every document has a digest of the name of the Data it came from,
+    # which identifies it for upserts
+    NAME_DIGEST_FIELD = 'nameDigest'
+    # and the wire encoding of the Data, to answer Interests for it
+    WIRE_FIELD = 'wire'
+
+    # accepted in queries for SCHEMA_TIMESTAMP fields
+    TIME_FORMATS = ['%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S',
+            '%Y-%m-%d %H:%M', '%Y-%m-%d']
+    QUERY_OPERATORS = {'!=':'$ne', '<':'$lt', '<=':'$lte', '>':'$gt',
+            '>=':'$gte', 'in':'$in'}
+    # the types each aggregate function accepts
+    AGGREGATE_TYPES = {'avg':(SCHEMA_INT, SCHEMA_FLOAT),
+            'sum':(SCHEMA_INT, SCHEMA_FLOAT),
+            'min':(SCHEMA_INT, SCHEMA_FLOAT, SCHEMA_TIMESTAMP),
+            'max':(SCHEMA_INT, SCHEMA_FLOAT, SCHEMA_TIMESTAMP)}
+
+    def __init__(self, nameSchema, schemaProps=None, schemaName=None):
         super(NdnSchema, self).__init__()
         self._extractKeysFromNameSchema(nameSchema)
         tableNames = self.fieldMappings.keys()
@@ -57,6 +92,10 @@ class NdnSchema(object):
             raise ValueError('Name schema has no keys')
         firstKeyIdx = sorted(self.fieldMappings.values())[0]
         self.dbPrefix = nameSchema[:firstKeyIdx]
+        if schemaName is None:
+            # e.g. /ndn/ucla.edu/bms/<building>/... is called 'bms'
+            schemaName = str(self.dbPrefix[-1].getValue())
+        self.name = schemaName
 
     def setSchemaTypes(self, **properties):
         """
@@ -93,6 +132,49 @@ class NdnSchema(object):
             else:
                 self.prototype.append(component)
 
+    def getKeyNames(self):
+        """
+        The schema keys, in the order they appear in the name.
+        """
+        return sorted(self.fieldMappings, key=self.fieldMappings.get)
+
+    def getIndexSpecs(self):
+        """
+        The indexes a collection for this schema should have, as lists of
+        (fieldName, direction) pairs. Results are returned in (ts, _id) order,
+        so every index ends with those: one compound index over all the keys
+        in name-component order, one per key so that a query constraining any
+        key can lead with it, and one for queries that only constrain time.
+        """
+        keyNames = self.getKeyNames()
+        orderSpec = [('ts', 1), ('_id', 1)]
+        indexSpecs = [[(k, 1) for k in keyNames] + orderSpec]
+        for k in keyNames:
+            spec = [(k, 1)] + orderSpec
+            if spec not in indexSpecs:
+                indexSpecs.append(spec)
+        indexSpecs.append(orderSpec)
+        indexSpecs.extend(self.getUniqueIndexSpecs())
+        return indexSpecs
+
+    def getUniqueIndexSpecs(self):
+        """
+        The indexes in getIndexSpecs() that are unique. The name digest index
+        is sparse as well, since documents written before there were digests
+        don't have one.
+        """
+        return [[(self.NAME_DIGEST_FIELD, 1)]]
+
+    def getCountedFieldSets(self):
+        """
+        The combinations of keys that the repo keeps a result count for: each
+        leading run of keys in name order (including none, which counts
+        everything). Queries constraining exactly one of these combinations
+        by equality don't have to count their results.
+        """
+        keyNames = self.getKeyNames()
+        return [tuple(keyNames[:i]) for i in range(len(keyNames)+1)]
+
     def matchNameToSchema(self, name):
         """
          Find the mapping between the name components and the 
@@ -102,6 +184,7 @@ class NdnSchema(object):
         foundDict = {}
         if len(name) > len(self.prototype):
             self.log.warn("Warning, data name is longer than schema")
+            name = name[:len(self.prototype)]
         if not self.dbPrefix.match(name):
             raise ValueError("Name is not under db prefix")
         else:
@@ -117,7 +200,7 @@ class NdnSchema(object):
     def sanitizeData(self, dataDict):
         """
         Convert each value to the schema type defined for it.
-        :raise: struct.error if a SCHEMA_INT value is invalid
+        :raise: struct.error if a SCHEMA_INT or SCHEMA_FLOAT value is invalid
         :raise: ValueError if a SCHEMA_TIMESTAMP is invalid
         """
         outputDict = {}
@@ -135,6 +218,12 @@ class NdnSchema(object):
                     except ValueError:
                         # raises struct.error if this doesn't work
                         outputDict[k] = struct.unpack("!Q", dataDict[k])
+                elif fieldType == self.SCHEMA_FLOAT:
+                    try:
+                        outputDict[k] = float(dataDict[k])
+                    except ValueError:
+                        # raises struct.error if this doesn't work
+                        outputDict[k] = struct.unpack("!d", dataDict[k])[0]
                 elif fieldType == self.SCHEMA_BINARY:
                     outputDict[k] = Binary(str(dataDict[k]))
                 elif fieldType == self.SCHEMA_TIMESTAMP:
@@ -149,19 +238,224 @@ class NdnSchema(object):
                     
         return outputDict
 
+    def convertQueryValue(self, fieldName, value):
+        """
+        Convert a value given in a query to the type stored for the field, so
+        that they compare correctly. Timestamps may be given in seconds, or
+        as local time in the form 'YYYY-MM-DD[ HH:MM[:SS[.ffffff]]]'.
+        :raise: KeyError if the field is not in the schema
+        :raise: ValueError if the value can't be converted
+        """
+        fieldType = self.fieldTypes[fieldName]
+        if fieldType == self.SCHEMA_STR:
+            return str(value)
+        elif fieldType == self.SCHEMA_INT:
+            return int(value)
+        elif fieldType == self.SCHEMA_FLOAT:
+            return float(value)
+        elif fieldType == self.SCHEMA_BINARY:
+            return Binary(str(value))
+        elif fieldType == self.SCHEMA_TIMESTAMP:
+            try:
+                return datetime.fromtimestamp(float(value))
+            except (TypeError, ValueError):
+                pass
+            for timeFormat in self.TIME_FORMATS:
+                try:
+                    return datetime.strptime(str(value).replace('T', ' '),
+                            timeFormat)
+                except ValueError:
+                    pass
+            raise ValueError('Bad time value: {}'.format(value))
+        else:
+            raise ValueError('Bad schema type: {}'.format(fieldType))
+
+    def makeQuery(self, predicate):
+        """
+        Turn a predicate (see repo_query.py) into a database query, with its
+        values converted to the schema types.
+        :raise: KeyError if a field is not in the schema
+        :raise: ValueError if an operator or value is invalid
+        """
+        if 'and' in predicate:
+            return mergeQueries([self.makeQuery(p) for p in predicate['and']])
+        if 'or' in predicate:
+            return {'$or':[self.makeQuery(p) for p in predicate['or']]}
+
+        fieldName = predicate['field']
+        op = predicate['op']
+        value = predicate['value']
+        if op == '=':
+            return {fieldName:self.convertQueryValue(fieldName, value)}
+        if op == 'in':
+            if not isinstance(value, list):
+                raise ValueError('IN needs a list of values')
+            value = [self.convertQueryValue(fieldName, v) for v in value]
+        elif op in self.QUERY_OPERATORS:
+            value = self.convertQueryValue(fieldName, value)
+        else:
+            raise ValueError('Bad operator: {}'.format(op))
+        return {fieldName:{self.QUERY_OPERATORS[op]:value}}
+
+    def makeGroupStage(self, aggregate):
+        """
+        Turn an aggregate query parameter (see repo_query.py) into a $group
+        pipeline stage. Each group's _id holds its key values, and the start
+        of its time bucket in milliseconds since the epoch.
+        :raise: KeyError if a field is not in the schema
+        :raise: ValueError if a function can't be applied to a field
+        """
+        groupId = SON()
+        for fieldName in aggregate.get('groupBy', []):
+            if self.fieldTypes[fieldName] == self.SCHEMA_BINARY:
+                raise ValueError('Cannot group by {}'.format(fieldName))
+            groupId[fieldName] = '$'+fieldName
+        bucket = aggregate.get('bucket')
+        if bucket is not None:
+            fieldName = bucket['field']
+            bucketSize = int(bucket['seconds'])*1000
+            if self.fieldTypes[fieldName] != self.SCHEMA_TIMESTAMP:
+                raise ValueError('{} is not a timestamp'.format(fieldName))
+            if bucketSize <= 0:
+                raise ValueError('Bad bucket size: {}'.format(bucket['seconds']))
+            sinceEpoch = {'$subtract':['$'+fieldName, datetime(1970, 1, 1)]}
+            groupId[fieldName] = {'$subtract':[sinceEpoch,
+                    {'$mod':[sinceEpoch, bucketSize]}]}
+
+        if len(groupId) == 0:
+            groupId = None # one group for everything
+        groupStage = {'_id':groupId, 'count':{'$sum':1}}
+        for function in aggregate.get('functions', []):
+            op = function['op']
+            fieldName = function['field']
+            if fieldName != '*' and fieldName not in self.fieldTypes:
+                raise KeyError(fieldName)
+            if op == 'count':
+                continue
+            if op not in self.AGGREGATE_TYPES:
+                raise ValueError('Bad aggregate function: {}'.format(op))
+            if self.fieldTypes[fieldName] not in self.AGGREGATE_TYPES[op]:
+                raise ValueError('Cannot apply {} to {}'.format(op, fieldName))
+            groupStage['{}_{}'.format(op, fieldName)] = {'$'+op:'$'+fieldName}
+        return {'$group':groupStage}
+
+def mergeQueries(queries):
+    """
+    AND database queries together. Conditions on different fields share one
+    document, so that an equality query still looks like the name fields it
+    came from (and can be counted from the maintained counts); conditions
+    that clash go in an $and.
+    """
+    merged = {}
+    leftOver = []
+    for query in queries:
+        for (k, v) in query.items():
+            if k not in merged:
+                merged[k] = v
+            elif (not k.startswith('$') and isinstance(v, dict) and
+                    isinstance(merged[k], dict) and
+                    not set(v).intersection(merged[k])):
+                # e.g. a range: {'ts':{'$gt':a}} and {'ts':{'$lt':b}}
+                merged[k] = dict(merged[k])
+                merged[k].update(v)
+            else:
+                leftOver.append({k:v})
+    if len(leftOver) > 0:
+        merged['$and'] = merged.get('$and', []) + leftOver
+    return merged
+
+
+def getExcludeEntries(exclude):
+    """
+    The entries of an Exclude, as (type, component) pairs, with None for the
+    component of an ANY entry. Exclude.get() doesn't return the entry in
+    some PyNDN releases, so then they are read back from toUri().
+    """
+    entries = [exclude.get(i) for i in range(exclude.size())]
+    if None not in entries:
+        return [(e.getType(), e.getComponent()) for e in entries]
+    entries = []
+    for part in exclude.toUri().split(','):
+        if part == '*':
+            entries.append((Exclude.ANY, None))
+        else:
+            entries.append((Exclude.COMPONENT, Name('/' + part)[0]))
+    return entries
 
 class NdnHierarchicalRepo(object):
-    def __init__(self, repoPrefix=None):
+    # query parameters that shape the results rather than choose them
+    QUERY_OPTIONS = ('fields', 'offset', 'limit', 'distinct', 'aggregate')
+
+    def __init__(self, repoPrefix=None, storage=None):
+        """
+        :param storage: The StorageEngine that holds the documents; by
+            default, the 'bms' database of a local MongoDB server
+        """
         super(NdnHierarchicalRepo, self).__init__()
         self.schemaList = []
+        self.schemaTrie = SchemaTrie()
+        # every schema's prefix is registered, once
+        self.dataPrefixes = {}
+        self.face = None
         if repoPrefix is None:
             self.repoPrefix = Name('/test/repo')
         else:
             self.repoPrefix = Name(repoPrefix)
         self.keyChain = KeyChain()
-        self.currentProcessId = 0
+        self.storage = storage
+        self.isDatabaseOpen = False
+        # every document written so far has an _id below this, and every
+        # document written after will have one above it
+        self.snapshotBound = None
+
+        # documents are written when this many are waiting, or when the
+        # oldest has waited this many seconds
+        self.maxBatchSize = 500
+        self.maxBatchDelay = 0.5
+        # encoded query responses are kept until a matching insert
+        self.queryCache = QueryResultCache(16*1024*1024)
+        # recently inserted or requested Data packets
+        self.packetCache = PacketCache(8*1024*1024)
+        self.querySessions = QuerySessionTable(256)
+        # counts for queries that don't use the maintained counts
+        self.countCache = CountCache(1024, 30)
+        # response segments hold this many bytes of results, and a segment
+        # Interest finds the boundaries of this many segments after it
+        self.maxSegmentBytes = 6000
+        self.segmentLookahead = 16
+
+        # limits for segmented insert fetching
+        self.maxFetchWindow = 32
+        self.maxFetchRetries = 3
+        # at most this many insert fetches run at once, and this many more
+        # wait; a publisher is named by this many components of the data
+        # name (e.g. /ndn/ucla.edu/bms/<building>), and publishers with
+        # fetches waiting take turns
+        self.fetchQueue = FetchQueue(32, 1024)
+        self.publisherPrefixLength = 4
 
-        self.pendingProcesses = {}
+        # watched names are polled every watchMinInterval to
+        # watchMaxInterval seconds, following how often they have new Data,
+        # and at most watchPollRate times a second in all
+        self.watchInitialInterval = 10
+        self.watchMinInterval = 1
+        self.watchMaxInterval = 300
+        self.watchPollRate = 50
+        self.watchScheduler = None
+        # process id -> watch, and watched name URI -> watch
+        self.watches = {}
+        self._watchedNames = {}
+
+        # insert processes are kept for 'insert check' until this long after
+        # they finish, and at most this many at once
+        self.processTable = InsertProcessTable(4096, 300)
+
+        # latency histograms and counters, answered to <repoPrefix>/status
+        # and, if metricsFile is set, written to it every metricsInterval
+        # seconds
+        self.metrics = RepoMetrics()
+        self.metricsFile = None
+        self.metricsInterval = 60
         self.log = logging.getLogger(str(self.__class__))
         s = logging.StreamHandler()
         formatter = logging.Formatter(
@@ -171,25 +465,173 @@ class NdnHierarchicalRepo(object):
         self.log.addHandler(s)
         self.log.setLevel(logging.INFO)
 
-    def addSchema(self, schema):
+    def addSchema(self, schema, schemaName=None):
+        """
+        Add a schema to the repo. Each schema is stored separately (in
+        MongoDB, in its own collection), named after the schema.
+        :raise: ValueError if another schema already uses the same name
+        """
         if not isinstance(schema, NdnSchema):
-            schema = NdnSchema(schema)
+            schema = NdnSchema(schema, schemaName=schemaName)
             schema.addField('value', NdnSchema.SCHEMA_BINARY)
             schema.addField('ts', NdnSchema.SCHEMA_TIMESTAMP)
+        elif schemaName is not None:
+            schema.name = schemaName
+        if any(s.name == schema.name for s in self.schemaList):
+            raise ValueError('Duplicate schema name: {}'.format(schema.name))
+        self.schemaTrie.addSchema(schema)
         schema.log = self.log
         self.schemaList.append(schema)
-        self.dataPrefix = schema.dbPrefix
+        prefixUri = schema.dbPrefix.toUri()
+        if prefixUri not in self.dataPrefixes:
+            self.dataPrefixes[prefixUri] = schema.dbPrefix
+            if self.face is not None:
+                self._register(schema.dbPrefix, self.handleDataInterests)
+        if self.isDatabaseOpen:
+            self._ensureIndexes(schema)
+            self._checkCounts(schema)
 
     def initializeDatabase(self):
-        self.dbClient = mongo.MongoClient()
-        # TODO: different DB name for different schemata?
-        self.db = self.dbClient['bms']
+        if self.storage is None:
+            self.storage = MongoStorageEngine('bms')
+        if not isinstance(self.storage, MeteredStorage):
+            self.storage = MeteredStorage(self.storage, self.metrics)
+        self.storage.open()
+        self.snapshotBound = ObjectId()
+        self.isDatabaseOpen = True
+        if len(self.schemaList) > 0:
+            self._adoptLegacyDocuments(self.schemaList[0])
+        for schema in self.schemaList:
+            self._ensureIndexes(schema)
+            self._checkCounts(schema)
+
+    def _adoptLegacyDocuments(self, schema):
+        """
+        Earlier versions of the repo stored every document together (in
+        MongoDB, in the 'data' collection), and queried them with the first
+        schema, so they are given to the first schema.
+        """
+        adoptedCount = self.storage.adoptLegacyDocuments(schema)
+        if adoptedCount is None:
+            self.log.warn('Documents from an earlier version of the repo '
+                    'were left alone, since {} already has documents; move '
+                    'them into it by hand'.format(schema.name))
+        elif adoptedCount > 0:
+            self.log.info('Moved {} documents from an earlier version of the '
+                    'repo to {}'.format(adoptedCount, schema.name))
+
+    def _ensureIndexes(self, schema):
+        """
+        Check that the schema's documents have all the indexes they need, and
+        build any that are missing. Indexes the schema no longer asks for are
+        dropped, since the documents belong to the repo and every index
+        slows down inserts.
+        :return: The index specs that had to be built
+        """
+        (builtSpecs, droppedNames) = self.storage.ensureIndexes(schema)
+        for indexName in droppedNames:
+            self.log.info('Dropped obsolete index {} on {}'.format(
+                    indexName, schema.name))
+        if len(builtSpecs) > 0:
+            self.log.info('Built {} index(es) on {}:\n\t{}'.format(
+                    len(builtSpecs), schema.name,
+                    '\n\t'.join(str(spec) for spec in builtSpecs)))
+        else:
+            self.log.info('All indexes present on {}'.format(schema.name))
+        return builtSpecs
+
+    def _countsByFieldSet(self, schema, seriesCounts):
+        """
+        Add up counts for every counted combination of keys.
+        :param seriesCounts: (key values dict, count) pairs
+        :return: A dict of counter ids to counts
+        """
+        counts = {}
+        for fieldSet in schema.getCountedFieldSets():
+            for (keyValues, n) in seriesCounts:
+                if not all(k in keyValues for k in fieldSet):
+                    continue
+                counterId = tuple((k, keyValues[k]) for k in fieldSet)
+                counts[counterId] = counts.get(counterId, 0) + n
+        return counts
+
+    def _checkCounts(self, schema):
+        """
+        Rebuild the maintained result counts if they are missing, e.g. for
+        data inserted before counting was added.
+        """
+        if self.storage.getCount(schema, ()) is not None:
+            return
+        if self.storage.isEmpty(schema):
+            return
+        self.log.info('Rebuilding result counts for {}'.format(schema.name))
+        seriesCounts = self.storage.countSeries(schema, {})
+        self.storage.addCounts(schema,
+                self._countsByFieldSet(schema, seriesCounts))
+
+    def _getResultCount(self, schema, dataQuery, asOf):
+        """
+        Count a query's results, from the maintained counts if it constrains
+        one of the counted combinations of keys, or else from a recent count
+        of the same query. The maintained counts include every document
+        written, so they are only exact for the snapshot asOf if it is the
+        current one and no write is under way.
+        :return: (count, whether the count is exact)
+        """
+        keyNames = schema.getKeyNames()
+        fieldSet = tuple(k for k in keyNames if k in dataQuery)
+        isEquality = all(not isinstance(v, dict) for v in dataQuery.values())
+        if (isEquality and len(fieldSet) == len(dataQuery) 
+                and fieldSet in schema.getCountedFieldSets()):
+            counterId = tuple((k, dataQuery[k]) for k in fieldSet)
+            isExact = (asOf == self.snapshotBound and
+                    not self.ingestBuffer.isWriting())
+            count = self.storage.getCount(schema, counterId)
+            if count is None:
+                return (0, isExact)
+            return (count, isExact)
+
+        count = self.countCache.get(schema.name, dataQuery)
+        if count is not None:
+            return (count, False)
+        count = self.storage.count(schema,
+                {'$and':[dataQuery, {'_id':{'$lt':asOf}}]})
+        self.countCache.put(schema.name, dataQuery, count)
+        return (count, True)
+
+    def deleteData(self, schema, dataQuery):
+        """
+        Remove every document matching a query, and update the result counts.
+        This is done in the ingest buffer's executor between batches, so that
+        no batch changes the counts while they are worked out.
+        :return: A future for the number of documents removed
+        """
+        future = self.ingestBuffer.call(self._removeDocuments, schema,
+                dataQuery)
+        future.add_done_callback(partial(self._onDocumentsRemoved, schema))
+        return future
+
+    def _removeDocuments(self, schema, dataQuery):
+        # runs in the ingest buffer's executor
+        removedCount = self.storage.remove(schema, dataQuery,
+                partial(self._countRemovedDocuments, schema))
+        self.snapshotBound = ObjectId()
+        return removedCount
+
+    def _countRemovedDocuments(self, schema, seriesCounts):
+        counts = self._countsByFieldSet(schema, seriesCounts)
+        return {k:-n for (k,n) in counts.items()}
+
+    def _onDocumentsRemoved(self, schema, future):
+        self.queryCache.invalidateSchema(schema.name)
+        self.packetCache.invalidatePrefix(schema.dbPrefix)
+        self.querySessions.invalidateSchema(schema.name)
 
     def _registerFailed(self, prefix):
         self.log.info('Registration failure')
-        if prefix == self.dataPrefix:
+        if prefix.toUri() in self.dataPrefixes:
             callback = self.handleDataInterests
-        elif prefix == self.repoPrefix:
+        elif prefix.toUri() == self.repoPrefix.toUri():
             callback = self.handleCommandInterests
 
         self.loop.call_later(5, self._register, prefix, callback)
@@ -197,140 +639,1022 @@ class NdnHierarchicalRepo(object):
     def _register(self, prefix, callback):
         self.face.registerPrefix(prefix, callback, self._registerFailed) 
         
-    def insertData(self, data):
+    def insertData(self, data, processId=None, segmentNum=None):
+        """
+        Match the data name to a schema and queue the document for writing.
+        If processId is given, the process counts the document as inserted
+        once it is durable. Segmented data (segmentNum given) is named
+        <timestamp>/<segment> and is stored with a 'segment' field.
+        :return: Whether the document was queued; if not, no schema matches
+            the name, or it has no timestamp
+        """
         dataName = data.getName()
-        self.log.info('Inserting {}'.format(dataName))
-        useSchema = (s for s in self.schemaList 
-                if s.dbPrefix.match(dataName)).next()
-        
-        #exclude timestamp...
-        dataFields = useSchema.matchNameToSchema(dataName[:-1])
+        self.log.debug('Inserting %s', dataName)
+        self.metrics.increment('inserts')
+        # the timestamp (and segment) come after the schema's components
+        matchStartTime = time.time()
+        (useSchema, dataFields) = self.schemaTrie.match(dataName)
+        self.metrics.observe('schemaMatch', time.time() - matchStartTime)
+        if useSchema is None:
+            self.log.error('No schema for {}'.format(dataName))
+            return False
         if len(dataFields) == 0:
             self.log.error('Invalid data name for schema')
+
+        if segmentNum is not None:
+            dataName = dataName[:-1]
+        try:
+            if len(dataName) <= len(useSchema.prototype):
+                raise struct.error('no timestamp component')
+            tsComponent = str(dataName[-1].getValue())
+            tsConverted = float(struct.unpack("!Q", tsComponent)[0])/1000
+        except struct.error:
+            self.log.error('No timestamp in {}'.format(data.getName()))
+            return False
    
         dataValue = Binary(str(data.getContent()))
-        tsComponent = str(dataName[-1].getValue())
-        tsConverted = float(struct.unpack("!Q", tsComponent)[0])/1000
         dataFields.update({'value':dataValue, 'ts':tsConverted})
+        if segmentNum is not None:
+            dataFields['segment'] = segmentNum
         dataFields = useSchema.sanitizeData(dataFields)
-        dataCollection = self.db['data']
-        new_id = dataCollection.update(dataFields, dataFields, upsert=True)
-        self.log.debug('Inserted object {}'.format(new_id))
+        fullName = data.getName()
+        nameDigest = hashlib.sha1(fullName.wireEncode().toRawStr())
+        dataFields[NdnSchema.NAME_DIGEST_FIELD] = Binary(nameDigest.digest())
+        wire = data.wireEncode().toRawStr()
+        dataFields[NdnSchema.WIRE_FIELD] = Binary(wire)
 
-    def start(self):
+        process = self.watches.get(processId)
+        if process is None:
+            process = self.processTable.get(processId)
+        if process is not None:
+            process.pendingWrites += 1
+        self.ingestBuffer.add(useSchema, dataFields, 
+                partial(self._onDocumentWritten, useSchema, dataFields,
+                fullName, process))
+        return True
+
+    def _onDocumentWritten(self, schema, document, dataName, process,
+            success):
+        # even a failed bulk write may have written some documents
+        self.queryCache.invalidate(schema.name, document)
+        self.querySessions.invalidate(schema.name, document)
+        self.packetCache.invalidate(dataName)
+        if success:
+            # only Data that is stored is answered from the cache
+            self.packetCache.put(dataName.toUri(),
+                    str(document[NdnSchema.WIRE_FIELD]))
+        if process is not None:
+            process.onWriteDone(success)
+
+    def _bulkUpsert(self, schema, documents):
+        """
+        Write a batch of documents, matched on their name digest through its
+        unique index. A document that is already stored (the same Data
+        inserted again) is left as it is, and so is a second copy in the same
+        batch; both are counted in nDuplicates. Runs in the ingest buffer's
+        executor.
+
+        The documents' _ids are given here, since writes are made one batch
+        at a time, and a new snapshot bound is made once they are written.
+        ObjectIds made in one process increase, so snapshots taken from the
+        bound include exactly the documents written before it.
+        """
+        for document in documents:
+            document['_id'] = ObjectId()
+        # the counts are updated in the same transaction as the write
+        result = self.storage.bulkUpsert(schema, documents,
+                partial(self._countNewDocuments, schema))
+        self.snapshotBound = ObjectId()
+        return result
+
+    def _countNewDocuments(self, schema, newDocuments):
+        # only newly inserted documents change the counts
+        keyNames = schema.getKeyNames()
+        seriesCounts = [({k:d[k] for k in keyNames if k in d}, 1) 
+                for d in newDocuments]
+        return self._countsByFieldSet(schema, seriesCounts)
+
+    def getIngestStats(self):
+        """
+        Insert throughput counters from the ingest buffer.
+        """
+        return self.ingestBuffer.getStats()
+
+    def getCacheStats(self):
+        """
+        Hit, miss and eviction counters from the query result cache.
+        """
+        return self.queryCache.getStats()
+
+    def getPacketCacheStats(self):
+        """
+        Hit, miss and eviction counters from the Data packet cache.
+        """
+        return self.packetCache.getStats()
+
+    def getProcessStats(self):
+        """
+        Counts of insert processes created, shared, expired and evicted.
+        """
+        return self.processTable.getStats()
+
+    def getFetchStats(self):
+        """
+        In-flight and queued insert fetches, and how long fetches waited.
+        """
+        return self.fetchQueue.getStats()
+
+    def getWatchStats(self):
+        """
+        Counts of watch polls, and of those that found new Data.
+        """
+        if self.watchScheduler is None:
+            return {'names':0}
+        return self.watchScheduler.getStats()
+
+    def getStatus(self):
+        """
+        The metrics, and the stats of each part of the repo, including the
+        depths of its buffers and queues.
+        """
+        return {'metrics':self.metrics.getStats(),
+                'ingest':self.getIngestStats(),
+                'queryCache':self.getCacheStats(),
+                'packetCache':self.getPacketCacheStats(),
+                'processes':self.getProcessStats(),
+                'fetches':self.getFetchStats(),
+                'watches':self.getWatchStats(),
+                'querySessions':len(self.querySessions)}
+
+    def _sendStatus(self, interest, transport):
+        """
+        Answer a <repoPrefix>/status Interest with the status as JSON, under
+        a version for the current time, fresh for one second.
+        """
+        statusName = Name(interest.getName()).appendVersion(
+                int(time.time()*1000))
+        statusData = Data(statusName)
+        statusData.getMetaInfo().setFreshnessPeriod(1000)
+        statusData.setContent(json.dumps(self.getStatus(), sort_keys=True,
+                default=str))
+        self._send(transport, statusData.wireEncode().buf())
+
+    def _dumpMetrics(self):
+        """
+        Write the status to metricsFile, replacing it whole, and do it again
+        after metricsInterval.
+        """
+        try:
+            tempFile = self.metricsFile + '.tmp'
+            with open(tempFile, 'w') as statusFile:
+                json.dump(self.getStatus(), statusFile, indent=2,
+                        sort_keys=True, default=str)
+            os.rename(tempFile, self.metricsFile)
+        except (IOError, OSError) as e:
+            self.log.warn('Could not write metrics to {}: {}'.format(
+                    self.metricsFile, e))
+        self.loop.call_later(self.metricsInterval, self._dumpMetrics)
+
+    def _send(self, transport, wire):
+        sendStartTime = time.time()
+        transport.send(wire)
+        self.metrics.observe('send', time.time() - sendStartTime)
+        self.metrics.increment('bytesSent', len(wire))
+
+    def setUp(self, loop, face, insertFace):
+        """
+        Open the database and register the repo's prefixes on face, ready to
+        handle Interests once loop runs. Insert fetches go out on insertFace.
+        start() does this with faces to the forwarders; a benchmark can pass
+        in-process ones (see repo_benchmark.py).
+        """
         self.initializeDatabase()
-        self.loop = asyncio.get_event_loop()
-        self.face = ThreadsafeFace(self.loop, '')
-        self.face.setCommandSigningInfo(self.keyChain, 
-                self.keyChain.getDefaultCertificateName())
-        self._register(self.dataPrefix, self.handleDataInterests)
+        self.loop = loop
+        self.ingestBuffer = BulkIngestBuffer(self.loop, self._bulkUpsert,
+                self.maxBatchSize, self.maxBatchDelay)
+        self.face = face
+        for dataPrefix in self.dataPrefixes.values():
+            self._register(dataPrefix, self.handleDataInterests)
         self._register(self.repoPrefix, self.handleCommandInterests)
+        self._insertFace = insertFace
+        if self.metricsFile is not None:
+            self.loop.call_later(self.metricsInterval, self._dumpMetrics)
 
+    def start(self):
+        loop = asyncio.get_event_loop()
+        face = ThreadsafeFace(loop, '')
+        face.setCommandSigningInfo(self.keyChain, 
+                self.keyChain.getDefaultCertificateName())
         #TODO: figure out why nfdc doesn't forward to borges
-        self._insertFace = ThreadsafeFace(self.loop, 'borges.metwi.ucla.edu')
+        insertFace = ThreadsafeFace(loop, 'borges.metwi.ucla.edu')
+        self.setUp(loop, face, insertFace)
 
         try:
             self.loop.run_forever()
         except Exception as e:
             self.log.exception(e, exc_info=True)
-            self.face.shutdown()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        """
+        Stop the watches and close the faces, so that nothing more is
+        fetched or inserted, then write out the documents still buffered and
+        close the database. This runs the loop until the writes are done, so
+        it is called once the loop has stopped (e.g. on KeyboardInterrupt).
+        """
+        if self.watchScheduler is not None:
+            self.watchScheduler.stop()
+        for watch in self.watches.values():
+            # so that fetches under way or queued don't go on
+            watch.stop()
+        self.face.shutdown()
+        if self._insertFace is not self.face:
+            self._insertFace.shutdown()
+        self.loop.run_until_complete(self.ingestBuffer.drain())
+        self.storage.close()
+        self.isDatabaseOpen = False
+
+    def _findResults(self, schema, dataQuery, asOf, after=None, limit=0,
+            fields=None, skip=0):
+        """
+        Find results in (ts, _id) order. Instead of skipping over earlier
+        results, a scan continues from the last ts and _id returned before,
+        which is an indexed range scan. Only documents created before the
+        snapshot bound asOf are returned, so segments stay consistent while
+        new data arrives.
+        :param after: A continuation token, as made by _makeToken
+        :param fields: The fields to return, or None for the whole document.
+            ts and _id are always returned, since tokens are made from them.
+        """
+        if after is None:
+            findQuery = {'$and':[dataQuery, {'_id':{'$lt':asOf}}]}
+        else:
+            # the ts bound is what the index scan uses; the $or only
+            # filters out what was already returned at that ts
+            findQuery = {'$and':[dataQuery, {'_id':{'$lt':asOf}},
+                    {'ts':{'$gte':after['ts']}},
+                    {'$or':[{'ts':{'$gt':after['ts']}}, {'_id':{'$gt':after['id']}}]}]}
+        if fields is None:
+            projection = {NdnSchema.NAME_DIGEST_FIELD:False,
+                    NdnSchema.WIRE_FIELD:False}
+        else:
+            projection = {fieldName:True for fieldName in fields}
+            projection['ts'] = True
+        return self.storage.find(schema, findQuery, projection,
+                [('ts', ASCENDING), ('_id', ASCENDING)], skip, limit)
+
+    def _findSessionResults(self, session, token, limit=0):
+        """
+        Find a session's results from a token, or from the start, with its
+        projection, offset and limit applied.
+        :param limit: The most results wanted, or 0 for as many as there are
+        """
+        if token is None:
+            position = 0
+            skip = session.offset
+        else:
+            position = token['pos']
+            skip = 0
+        if session.limit is not None:
+            remaining = session.limit - position
+            if remaining <= 0:
+                return []
+            if limit == 0 or limit > remaining:
+                limit = remaining
+        return self._findResults(session.schema, session.dataQuery,
+                session.asOf, token, limit, session.fields, skip)
+
+    def _makeToken(self, session, lastResult, position):
+        return {'ts':lastResult['ts'], 'id':lastResult['_id'], 
+                'asOf':session.asOf, 'pos':position}
+
+    def _encodeSegment(self, session, segmentNum, results):
+        startPos, startToken, resultCount = session.segments[segmentNum]
+        if segmentNum == session.finalSegment or session.isGrouped():
+            # grouped results are only fetched by segment number
+            nextToken = None
+        else:
+            nextToken = self._makeToken(session, results[-1], 
+                    startPos+len(results))
+        responseObject = {'count':session.totalCount, 
+                'countExact':session.isCountExact, 'skip':startPos,
+                'results':results, 'next':nextToken}
+        encodeStartTime = time.time()
+        encoded = BSON.encode(responseObject)
+        self.metrics.observe('bsonEncode', time.time() - encodeStartTime)
+        self.queryCache.put(session.schema.name, session.dataQuery,
+                session.getCacheKey(segmentNum), encoded)
+        return encoded
+
+    def _scanSegments(self, session, wantedSegment, lastSegment):
+        """
+        Continue splitting the session's results into segments until
+        lastSegment has been found or the results run out. Each segment holds
+        as many results as fit in maxSegmentBytes (but at least one).
+        :return: The encoded wantedSegment, or None if the results ran out
+            before it
+        """
+        wantedEncoded = None
+        # room for count, skip and next
+        budget = self.maxSegmentBytes - 200
+        results = []
+        resultsSize = 0
+        startToken = session.scanToken
+        cursor = self._findSessionResults(session, session.scanToken)
+        for result in cursor:
+            # each array element also has a type byte and its index as a key
+            resultSize = len(BSON.encode(result)) + len(str(len(results))) + 2
+            if len(results) > 0 and resultsSize + resultSize > budget:
+                session.segments.append((session.scanPos, startToken, 
+                        len(results)))
+                session.scanPos += len(results)
+                startToken = self._makeToken(session, results[-1], 
+                        session.scanPos)
+                session.scanToken = startToken
+                encoded = self._encodeSegment(session, 
+                        len(session.segments)-1, results)
+                if len(session.segments)-1 == wantedSegment:
+                    wantedEncoded = encoded
+                results = []
+                resultsSize = 0
+                if len(session.segments) > lastSegment:
+                    # we know there is more, because we have a result
+                    break
+            results.append(result)
+            resultsSize += resultSize
+        else:
+            # the last segment may be empty, if there are no results at all
+            session.segments.append((session.scanPos, startToken, len(results)))
+            session.scanPos += len(results)
+            session.finalSegment = len(session.segments)-1
+            encoded = self._encodeSegment(session, session.finalSegment, results)
+            if session.finalSegment == wantedSegment:
+                wantedEncoded = encoded
+        return wantedEncoded
+
+    def _findGroups(self, schema, dataQuery, asOf, aggregate):
+        """
+        Run an aggregate query in the database.
+        :return: A list of groups, each with its key values, time bucket,
+            count and the values of the aggregate functions
+        """
+        bucket = aggregate.get('bucket')
+        groups = []
+        for (groupKey, group) in self.storage.group(schema,
+                {'$and':[dataQuery, {'_id':{'$lt':asOf}}]}, aggregate):
+            if bucket is not None:
+                bucketStart = groupKey[bucket['field']]
+                if bucketStart is not None:
+                    groupKey[bucket['field']] = (datetime(1970, 1, 1) +
+                            timedelta(milliseconds=bucketStart))
+            group.update(groupKey)
+            groups.append(group)
+        return groups
+
+    def _findDistinct(self, schema, dataQuery, asOf, fieldName):
+        """
+        Find the distinct values of a field among a query's results.
+        :return: A list of {fieldName: value} in value order
+        """
+        values = self.storage.distinct(schema,
+                {'$and':[dataQuery, {'_id':{'$lt':asOf}}]}, fieldName)
+        return [{fieldName:value} for value in sorted(values)]
+
+    def _groupSegments(self, session, wantedSegment):
+        """
+        Find all the groups of an aggregate query, or the values of a
+        distinct query, and split them into segments as _scanSegments does.
+        :return: The encoded wantedSegment, or None if there is no such segment
+        """
+        if session.distinct is not None:
+            groups = self._findDistinct(session.schema, session.dataQuery,
+                    session.asOf, session.distinct)
+        else:
+            groups = self._findGroups(session.schema, session.dataQuery,
+                    session.asOf, session.aggregate)
+        if session.limit is not None:
+            groups = groups[session.offset:session.offset+session.limit]
+        else:
+            groups = groups[session.offset:]
+        session.totalCount = len(groups)
+        session.isCountExact = True
+        budget = self.maxSegmentBytes - 200
+        segmentGroups = [[]]
+        resultsSize = 0
+        for group in groups:
+            results = segmentGroups[-1]
+            resultSize = len(BSON.encode(group)) + len(str(len(results))) + 2
+            if len(results) > 0 and resultsSize + resultSize > budget:
+                results = []
+                segmentGroups.append(results)
+                resultsSize = 0
+            results.append(group)
+            resultsSize += resultSize
+
+        session.segments = []
+        session.finalSegment = len(segmentGroups)-1
+        wantedEncoded = None
+        position = 0
+        for (segmentNum, results) in enumerate(segmentGroups):
+            session.segments.append((position, None, len(results)))
+            position += len(results)
+            encoded = self._encodeSegment(session, segmentNum, results)
+            if segmentNum == wantedSegment:
+                wantedEncoded = encoded
+        return wantedEncoded
+
+    def _getSegment(self, session, segmentNum):
+        """
+        :return: The encoded segment, or None if there is no such segment
+        """
+        encoded = self.queryCache.get(session.schema.name, session.dataQuery,
+                session.getCacheKey(segmentNum))
+        if encoded is not None:
+            return encoded
+
+        if session.isGrouped():
+            if (session.finalSegment is not None and 
+                    segmentNum > session.finalSegment):
+                return None
+            return self._groupSegments(session, segmentNum)
+
+        if segmentNum >= len(session.segments):
+            if session.finalSegment is not None:
+                return None
+            return self._scanSegments(session, segmentNum, 
+                    segmentNum + self.segmentLookahead)
+
+        # the segment is known, but was evicted from the cache
+        startPos, startToken, resultCount = session.segments[segmentNum]
+        results = []
+        if resultCount > 0:
+            results = list(self._findSessionResults(session, startToken,
+                    resultCount))
+        return self._encodeSegment(session, segmentNum, results)
+
+    def _getQuerySession(self, schema, dataQuery, after, version,
+            options=None):
+        """
+        Find the session for a query, or start one. If no version is given,
+        the latest version of the query is used, or a new one is made from
+        the current snapshot bound (or the token's, continuing from a token).
+        :param options: The query parameters that shape the results (see 
+            QuerySession)
+        :return: The session, or None if the version is unknown (so its
+            results can't be found again)
+        """
+        queryKey = (freezeQuery(dataQuery), freezeQuery(after),
+                freezeQuery(options))
+        if version is not None:
+            asOf = self.querySessions.getBound(schema.name, version)
+            if asOf is None:
+                return None
+        elif after is not None:
+            # continuing from a token: use its snapshot, which must be one
+            # the repo could have made
+            asOf = after['asOf']
+            if not isinstance(asOf, ObjectId) or asOf > self.snapshotBound:
+                raise TypeError('Bad snapshot bound: {}'.format(asOf))
+        else:
+            asOf = self.snapshotBound
+
+        if version is None:
+            session = self.querySessions.getLatest(schema.name, queryKey)
+        else:
+            session = self.querySessions.get(schema.name, queryKey, version)
+
+        if session is None:
+            isLatest = version is None
+            if isLatest:
+                version = self.querySessions.newVersion(schema.name, asOf)
+            session = QuerySession(schema, dataQuery, after, version, asOf,
+                    options)
+            if not session.isGrouped():
+                # grouped queries count their groups as they find them;
+                # other counts are kept with the version, as they are not
+                # all limited to the snapshot
+                reported = self.querySessions.getCount(version, queryKey)
+                if reported is None:
+                    (count, isCountExact) = self._getResultCount(schema,
+                            dataQuery, asOf)
+                    count = max(count - session.offset, 0)
+                    if session.limit is not None:
+                        count = min(count, session.limit)
+                    reported = (count, isCountExact)
+                    self.querySessions.putCount(version, queryKey, reported)
+                (session.totalCount, session.isCountExact) = reported
+            self.querySessions.add(session, isLatest)
+        return session
+
+    def _checkQueryOptions(self, schema, options, after):
+        """
+        :raise: KeyError if a field is not in the schema
+        :raise: ValueError if the options can't be used together
+        """
+        for fieldName in options.get('fields', []):
+            if fieldName not in schema.fieldTypes:
+                raise KeyError(fieldName)
+        for k in ('offset', 'limit'):
+            if k in options and (not isinstance(options[k], (int, long)) or
+                    options[k] < 0):
+                raise ValueError('Bad {}: {}'.format(k, options[k]))
+        if 'distinct' in options:
+            if schema.fieldTypes[options['distinct']] == NdnSchema.SCHEMA_BINARY:
+                raise ValueError('Cannot find distinct values of {}'.format(
+                        options['distinct']))
+            if 'aggregate' in options:
+                raise ValueError('A query cannot be both distinct and aggregate')
+        if 'aggregate' in options:
+            schema.makeGroupStage(options['aggregate'])
+        if after is not None and ('distinct' in options or 
+                'aggregate' in options):
+            raise ValueError('Grouped queries are fetched by segment')
+
+    def _componentToTime(self, schema, component):
+        """
+        Convert a timestamp component (milliseconds, as in Data names) to
+        the value stored in ts.
+        :raise: struct.error if the component is not a timestamp
+        """
+        milliseconds = struct.unpack("!Q", str(component.getValue()))[0]
+        return schema.sanitizeData({'ts':float(milliseconds)/1000})['ts']
+
+    def _findPacket(self, schema, nameFields, interest):
+        """
+        Find the stored Data that answers an Interest: the Data with exactly
+        the Interest's name, or else the first in (ts, segment) order under
+        it, or with ChildSelector 1, the last. Only names that give every
+        schema key, and at most a timestamp and segment after them, can have
+        Data under them. An Exclude of everything up to some timestamp (as a
+        watch sends) is part of the search; other Excludes are only checked
+        against the Data found.
+        :return: The wire encoding, or None
+        """
+        interestName = interest.getName()
+        nameUri = interestName.toUri()
+        childSelector = interest.getChildSelector()
+        exclude = interest.getExclude()
+        if exclude.size() == 0:
+            wire = self.packetCache.get(nameUri)
+            if wire is None:
+                wire = self.packetCache.getForPrefix(nameUri, childSelector)
+            if wire is not None:
+                return wire
+
+        wireField = NdnSchema.WIRE_FIELD
+        nameDigest = hashlib.sha1(interestName.wireEncode().toRawStr())
+        document = self.storage.findOne(schema,
+                {NdnSchema.NAME_DIGEST_FIELD:Binary(nameDigest.digest()),
+                wireField:{'$exists':True}}, {wireField:True})
+        if document is not None:
+            wire = str(document[wireField])
+            self.packetCache.put(nameUri, wire)
+            return wire
+
+        keyNames = schema.getKeyNames()
+        extraComponents = interestName[len(schema.prototype):]
+        if (any(k not in nameFields for k in keyNames) or 
+                len(extraComponents) > 2):
+            return None
+        try:
+            queries = [schema.makeQuery({'field':k, 'op':'=',
+                    'value':nameFields[k]}) for k in keyNames]
+            queries.append({wireField:{'$exists':True}})
+            if len(extraComponents) > 0:
+                queries.append({'ts':self._componentToTime(schema,
+                        extraComponents[0])})
+            excludeEntries = getExcludeEntries(exclude)
+            if (len(extraComponents) == 0 and
+                    [t for (t, c) in excludeEntries] ==
+                    [Exclude.ANY, Exclude.COMPONENT]):
+                lastTime = self._componentToTime(schema,
+                        excludeEntries[1][1])
+                queries.append({'ts':{'$gt':lastTime}})
+            if len(extraComponents) > 1:
+                queries.append({'segment':extraComponents[1].toSegment()})
+        except (ValueError, RuntimeError, struct.error):
+            return None
+        dataQuery = mergeQueries(queries)
 
-    def _segmentResponseData(self, dataQuery, segmentNum=0):
-        limit = 10
-        startPos = segmentNum*limit
-        results = self.db['data'].find(dataQuery).skip(segmentNum*limit).limit(limit)
-        return(startPos, results)
+        if childSelector == 1:
+            direction = DESCENDING
+        else:
+            direction = ASCENDING
+        # the index gives the ts; segments of that ts are few
+        projection = {wireField:True, 'ts':True, 'segment':True}
+        document = self.storage.findOne(schema, dataQuery, projection,
+                [('ts', direction), ('_id', direction)])
+        if document is None:
+            return None
+        if 'segment' in document and len(extraComponents) < 2:
+            dataQuery['ts'] = document['ts']
+            document = self.storage.findOne(schema, dataQuery, projection,
+                    [('segment', direction)])
+        wire = str(document[wireField])
 
+        data = Data()
+        data.wireDecode(bytearray(wire))
+        if exclude.size() > 0:
+            if not interest.matchesName(data.getName()):
+                return None
+        else:
+            self.packetCache.putForPrefix(nameUri, childSelector,
+                    data.getName().toUri(), wire)
+        return wire
 
     def handleDataInterests(self, prefix, interest, transport, prefixId):
+        startTime = time.time()
+        self._handleDataInterest(interest, transport)
+        self.metrics.observe('dataInterest', time.time() - startTime)
+
+    def _handleDataInterest(self, interest, transport):
         # TODO: verification
         
         # we match the components to the name, and any '_' components
-        # are discarded. Then we run a MongoDB query and append the
-        # object id to allow for excludes
-
-        chosenSchema = (s for s in self.schemaList 
-                if s.dbPrefix.match(prefix)).next()
+        # are discarded. The name may go on with query parameters, then the
+        # version and segment number of a response that has been started.
+        # Then we find the segment, continuing the query from the token in 
+        # the parameters, if there is one
 
         interestName = interest.getName()
-        responseName = Name(interestName)
-        nameFields = chosenSchema.matchNameToSchema(interestName)
-        self.log.info("Data requested with params:\n\t{}".format(nameFields))
-        allResults = []
-        segment = 0
+        matchStartTime = time.time()
+        (chosenSchema, nameFields) = self.schemaTrie.match(interestName)
+        self.metrics.observe('schemaMatch', time.time() - matchStartTime)
+        if chosenSchema is None:
+            self.log.debug('No schema for %s', interestName)
+            return
+        schemaLength = len(chosenSchema.prototype)
+        extraComponents = interestName[schemaLength:]
+
+        # a name that goes on with something other than query parameters
+        # (e.g. a timestamp), or a series name (every key given) with a
+        # ChildSelector, asks for Data
+        isSeriesName = all(k in nameFields
+                for k in chosenSchema.getKeyNames())
+        if ((len(extraComponents) > 0 and 
+                not isQueryParams(extraComponents[0])) or
+                (len(extraComponents) == 0 and isSeriesName and
+                interest.getChildSelector() is not None)):
+            self.metrics.increment('dataInterests')
+            wire = self._findPacket(chosenSchema, nameFields, interest)
+            if wire is None:
+                self.log.debug('No Data for %s', interestName)
+            else:
+                self._send(transport, wire)
+            return
+
+        queryParams = {}
+        paramsComponent = None
+        version = None
+        segmentNum = 0
         try:
-            segmentComponent = interest.getName()[-4]
-            segment = segmentComponent.toSegment()
-        except RuntimeError:
-            pass
-        
-        (startPos, results) = self._segmentResponseData(nameFields, segment)
-        for result in results:
-            dataId = result[u'_id']
-            self.log.debug("Found object {}".format(dataId))
-            allResults.append(result)
-
-        #responseName.append(str(dataId))
-        totalCount = results.count(False)
-        responseObject = {'count':totalCount, 'skip':startPos, 'results':allResults}
+            i = 0
+            if len(extraComponents) > i:
+                queryParams = decodeQueryParams(extraComponents[i])
+                if queryParams is None:
+                    raise ValueError('Bad query parameters')
+                paramsComponent = extraComponents[i]
+                i += 1
+            if len(extraComponents) > i:
+                version = extraComponents[i].toVersion()
+                i += 1
+            if len(extraComponents) > i:
+                segmentNum = extraComponents[i].toSegment()
+        except (ValueError, RuntimeError):
+            self.log.info('Bad query Interest {}'.format(interestName))
+            self._sendQueryError(interest, transport, 400,
+                    'Bad query parameters, version or segment')
+            return
+        after = queryParams.get('after')
+        self.log.debug("Data requested with params:\n\t%s", nameFields)
+        self.metrics.increment('queryInterests')
+
+        # the predicates go into the query alongside the name fields, so 
+        # the indexes, counts and caches treat them the same way
+        try:
+            queries = [chosenSchema.makeQuery({'field':k, 'op':'=', 'value':v})
+                    for (k, v) in nameFields.items()]
+            where = queryParams.get('where')
+            if where is not None:
+                queries.append(chosenSchema.makeQuery(where))
+            dataQuery = mergeQueries(queries)
+            options = {k:queryParams[k] for k in self.QUERY_OPTIONS
+                    if queryParams.get(k) is not None}
+            self._checkQueryOptions(chosenSchema, options, after)
+        except KeyError as e:
+            self.log.info('Bad query in {}: {}'.format(interestName, e))
+            self._sendQueryError(interest, transport, 400,
+                    'Unknown field: {}'.format(e.args[0]))
+            return
+        except (ValueError, TypeError, AttributeError) as e:
+            self.log.info('Bad query in {}: {}'.format(interestName, e))
+            self._sendQueryError(interest, transport, 400,
+                    'Bad query: {}'.format(e))
+            return
+
+        try:
+            session = self._getQuerySession(chosenSchema, dataQuery, after,
+                    version, options)
+            if session is None:
+                self.log.info('Unknown version in {}'.format(interestName))
+                self._sendQueryError(interest, transport, 404,
+                        'Unknown version: send the query again without one')
+                return
+            resultEncoded = self._getSegment(session, segmentNum)
+        except (KeyError, TypeError, AttributeError):
+            self.log.info('Bad continuation token in {}'.format(interestName))
+            self._sendQueryError(interest, transport, 400,
+                    'Bad continuation token')
+            return
+        if resultEncoded is None:
+            self.log.info('No segment {} for {}'.format(segmentNum, interestName))
+            self._sendQueryError(interest, transport, 404,
+                    'No segment {}'.format(segmentNum))
+            return
+
+        if paramsComponent is None:
+            paramsComponent = encodeQueryParams(queryParams)
+        responseName = Name(interestName[:schemaLength]).append(paramsComponent)
+        responseName.appendVersion(session.version).appendSegment(segmentNum)
         responseData = Data(responseName)
-        resultEncoded = BSON.encode(responseObject)
+        if session.finalSegment is not None:
+            finalBlockId = Name().appendSegment(session.finalSegment)[0]
+            responseData.getMetaInfo().setFinalBlockID(finalBlockId)
         responseData.setContent(resultEncoded)
-        transport.send(responseData.wireEncode().buf())
+        self._send(transport, responseData.wireEncode().buf())
 
 
-    def _onInsertionDataReceived(self, interest, data):
-        # TODO: update status in processingList
-        self.log.debug("Got {} in response to {}".format(data.getName(), 
-                interest.getName()))
-        self.insertData(data)
-        
+    def _sendQueryError(self, interest, transport, statusCode, reason):
+        """
+        Answer a query Interest that can't be answered with a BSON document
+        of the status code (as for commands) and the reason, under the
+        Interest's name, fresh for one second.
+        """
+        self.metrics.increment('queryErrors')
+        errorData = Data(interest.getName())
+        errorData.getMetaInfo().setFreshnessPeriod(1000)
+        errorData.setContent(BSON.encode({'status':statusCode,
+                'error':reason}))
+        self._send(transport, errorData.wireEncode().buf())
+
+    def _onInsertionDataReceived(self, process, sentTime, interest, data):
+        self.metrics.observe('fetchRtt', time.time() - sentTime)
+        self.log.debug("Got %s in response to %s", data.getName(),
+                interest.getName())
+        if self.insertData(data, process.processId):
+            self._onInsertFetchDone(process)
+        else:
+            self._onInsertFetchDone(process, 403)
+
 
-    def _onInsertionDataTimeout(self, interest):
+    def _onInsertionDataTimeout(self, process, interest):
+        self.metrics.increment('fetchTimeouts')
         self.log.warn("Timeout on {}".format(interest.getName()))
+        self._onInsertFetchDone(process, 408)
+
+    def _onInsertionSegmentReceived(self, process, segmentNum, data):
+        self.log.debug("Got segment %s of %s", segmentNum, process.dataName)
+        if not self.insertData(data, process.processId, segmentNum):
+            # the rest of the segments would not fit the schema either
+            process.fetcher.cancel()
+            self._onInsertFetchDone(process, 403)
+
+    def _onInsertionSegmentFailed(self, process, segmentNum):
+        self.log.warn("Gave up on segment {} of {}".format(segmentNum,
+                process.dataName))
+        self._onInsertFetchDone(process, 408)
+
+    def _onFetchRttSample(self, milliseconds):
+        self.metrics.observe('fetchRtt', milliseconds/1000.0)
+
+    def _onInsertFetchDone(self, process, statusCode=None):
+        if process.isFetching():
+            process.onFetchDone(statusCode)
+            self.fetchQueue.onFetchDone()
+
+    def _startInsertFetch(self, process):
+        """
+        Fetch the data for an insert process: the latest Data under the name,
+        or each segment in the requested block range.
+        """
+        if process.isSegmented():
+            fetcher = SegmentFetcher(self._insertFace, process.dataName,
+                    process.startBlockId, process.endBlockId,
+                    partial(self._onInsertionSegmentReceived, process),
+                    partial(self._onInsertFetchDone, process),
+                    partial(self._onInsertionSegmentFailed, process),
+                    maxWindow=self.maxFetchWindow,
+                    maxRetries=self.maxFetchRetries)
+            fetcher.onRttSample = self._onFetchRttSample
+            process.fetcher = fetcher
+            fetcher.start()
+        else:
+            fetchInterest = Interest(process.dataName)
+            fetchInterest.setChildSelector(1)
+            fetchInterest.setInterestLifetimeMilliseconds(4000)
+            self._insertFace.expressInterest(fetchInterest, 
+                    partial(self._onInsertionDataReceived, process,
+                    time.time()),
+                    partial(self._onInsertionDataTimeout, process))
+
+    def _decodeCommandParams(self, prefix, interestName):
+        commandParams = interestName[len(prefix)+1].getValue()
+        commandMessage = RepoCommandParameterMessage()
+        ProtobufTlv.decode(commandMessage, commandParams)
+        return commandMessage
+
+    def _getCommandDataName(self, commandMessage):
+        # '_' stands for a component left out of the data name
+        dataName = Name()
+        for component in commandMessage.command.name.components:
+            if component == '_':
+                continue
+            dataName.append(component)
+        return dataName
+
+    def _startWatch(self, dataName):
+        """
+        Start polling dataName for new Data, unless it is already watched.
+        :return: The watch process
+        """
+        watch = self._watchedNames.get(dataName.toUri())
+        if watch is not None:
+            return watch
+        if self.watchScheduler is None:
+            self.watchScheduler = PollScheduler(self.loop, self._pollWatch,
+                    self.watchInitialInterval, self.watchMinInterval,
+                    self.watchMaxInterval, self.watchPollRate,
+                    self.watchPollRate)
+            asyncio.async(self.watchScheduler.run(), loop=self.loop)
+        watch = WatchProcess(self.processTable.newProcessId(), dataName)
+        self.watches[watch.processId] = watch
+        self._watchedNames[dataName.toUri()] = watch
+        self.watchScheduler.add(watch.processId, watch)
+        return watch
+
+    def _stopWatch(self, watch):
+        self.log.info("Stopping watch of {}".format(watch.dataName))
+        watch.stop()
+        self.watchScheduler.remove(watch.processId)
+        del self.watches[watch.processId]
+        del self._watchedNames[watch.dataName.toUri()]
+
+    def _pollWatch(self, watch):
+        if not watch.isWatching() or watch.isPolling:
+            return
+        watch.isPolling = True
+        watch.foundNew = False
+        self._fetchWatch(watch)
+
+    def _fetchWatch(self, watch):
+        publisher = watch.dataName[:self.publisherPrefixLength]
+        if not self.fetchQueue.submit(publisher.toUri(),
+                partial(self._expressWatchInterest, watch)):
+            self._onWatchPollDone(watch)
+
+    def _expressWatchInterest(self, watch):
+        """
+        Ask for the newest Data under the watched name at first, and after
+        that for the oldest Data newer than the last timestamp fetched, so
+        that readings are fetched in order and none are skipped.
+        """
+        if not watch.isWatching():
+            self.fetchQueue.onFetchDone()
+            return
+        fetchInterest = Interest(watch.dataName)
+        fetchInterest.setInterestLifetimeMilliseconds(4000)
+        if watch.lastTimestamp is None:
+            fetchInterest.setChildSelector(1)
+        else:
+            fetchInterest.setChildSelector(0)
+            exclude = Exclude()
+            exclude.appendAny()
+            exclude.appendComponent(watch.lastTimestamp)
+            fetchInterest.setExclude(exclude)
+        self._insertFace.expressInterest(fetchInterest,
+                partial(self._onWatchDataReceived, watch, time.time()),
+                partial(self._onWatchDataTimeout, watch))
+
+    def _onWatchDataReceived(self, watch, sentTime, interest, data):
+        self.metrics.observe('fetchRtt', time.time() - sentTime)
+        self.fetchQueue.onFetchDone()
+        if not watch.isWatching():
+            return
+        dataName = data.getName()
+        if dataName.size() > watch.dataName.size():
+            timestamp = dataName[watch.dataName.size()]
+            if (watch.lastTimestamp is None or
+                    timestamp.compare(watch.lastTimestamp) > 0):
+                watch.lastTimestamp = timestamp
+                watch.foundNew = True
+                if not self.insertData(data, watch.processId):
+                    watch.failedWrites += 1
+                # there may be more: ask again straight away
+                self._fetchWatch(watch)
+                return
+        self._onWatchPollDone(watch)
+
+    def _onWatchDataTimeout(self, watch, interest):
+        self.fetchQueue.onFetchDone()
+        self._onWatchPollDone(watch)
+
+    def _onWatchPollDone(self, watch):
+        watch.isPolling = False
+        if watch.isWatching():
+            self.watchScheduler.onPollResult(watch.processId, watch.foundNew)
 
     def handleCommandInterests(self, prefix, interest, transport, prefixId):
         # TODO: verification
+        startTime = time.time()
         interestName = interest.getName()
+        if (len(interestName) == len(prefix)+1 and
+                str(interestName[len(prefix)].getValue()) == 'status'):
+            self._sendStatus(interest, transport)
+            return
         if len(interestName) <= len(prefix)+4:
             self.log.info("Bad command interest")
         commandName = str(interestName[len(prefix)].getValue())
+        self.metrics.increment('commands')
         responseMessage =  RepoCommandResponseMessage()
+        newProcess = None
         if commandName == 'insert':
-            commandParams = interestName[len(prefix)+1].getValue()
-            commandMessage = RepoCommandParameterMessage()
-            ProtobufTlv.decode(commandMessage, commandParams)
-            dataName = Name()
-            fullSchemaName = Name()
-            for component in commandMessage.command.name.components:
-                fullSchemaName.append(component)
-                if component == '_':
-                    continue
-                dataName.append(component)
-            self.log.info("Insert request for {}".format(dataName))
-            responseMessage.response.status_code = 100
-            processId = self.currentProcessId
-            self.currentProcessId += 1
-            responseMessage.response.process_id = processId
+            commandMessage = self._decodeCommandParams(prefix, interestName)
+            dataName = self._getCommandDataName(commandMessage)
+            self.log.debug("Insert request for %s", dataName)
+
+            # as in repo-ng, giving either block id asks for segments, and a
+            # missing end block id means 'up to the FinalBlockId'
+            command = commandMessage.command
+            startBlockId = endBlockId = None
+            if command.HasField('end_block_id'):
+                endBlockId = command.end_block_id
+            if command.HasField('start_block_id'):
+                startBlockId = command.start_block_id
+            elif endBlockId is not None:
+                startBlockId = 0
+
+            if endBlockId is not None and endBlockId < startBlockId:
+                responseMessage.response.status_code = 403
+            elif self.schemaTrie.match(dataName)[0] is None:
+                # the data could not be stored
+                self.log.info("No schema for insert of {}".format(dataName))
+                responseMessage.response.status_code = 403
+            elif (self.fetchQueue.isFull() and self.processTable.findFetching(
+                    dataName, startBlockId, endBlockId) is None):
+                # too many fetches waiting: the publisher should try later
+                self.log.warn("Busy, refusing insert of {}".format(dataName))
+                self.fetchQueue.reject()
+                responseMessage.response.status_code = 503
+            else:
+                # a command for data that is already being fetched gets the
+                # existing process
+                (process, isNew) = self.processTable.findOrCreate(dataName,
+                        startBlockId, endBlockId)
+                if isNew:
+                    newProcess = process
+                process.fillResponse(responseMessage.response)
+        elif commandName == 'insert check':
+            commandMessage = self._decodeCommandParams(prefix, interestName)
+            processId = commandMessage.command.process_id
+            process = self.processTable.get(processId)
+            if process is None:
+                responseMessage.response.process_id = processId
+                responseMessage.response.status_code = 404
+            else:
+                process.fillResponse(responseMessage.response)
+        elif commandName == 'watch start':
+            commandMessage = self._decodeCommandParams(prefix, interestName)
+            dataName = self._getCommandDataName(commandMessage)
+            self.log.info("Watch request for {}".format(dataName))
+            if self.schemaTrie.match(dataName)[0] is None:
+                responseMessage.response.status_code = 403
+            else:
+                watch = self._startWatch(dataName)
+                watch.fillResponse(responseMessage.response)
+        elif commandName in ('watch check', 'watch stop'):
+            commandMessage = self._decodeCommandParams(prefix, interestName)
+            processId = commandMessage.command.process_id
+            watch = self.watches.get(processId)
+            if watch is None:
+                responseMessage.response.process_id = processId
+                responseMessage.response.status_code = 404
+            else:
+                if commandName == 'watch stop':
+                    self._stopWatch(watch)
+                watch.fillResponse(responseMessage.response)
         else:
             responseMessage.response.status_code = 403
         responseData = Data(interestName)
         responseData.setContent(ProtobufTlv.encode(responseMessage))
-        transport.send(responseData.wireEncode().buf())
+        self._send(transport, responseData.wireEncode().buf())
+        self.metrics.observe('command', time.time() - startTime)
 
-        # now send the interest out to the publisher
-        # TODO: pendingProcesses becomes list of all processes as objects
-        i = Interest(dataName)
-        i.setChildSelector(1)
-        i.setInterestLifetimeMilliseconds(4000)
-        try:
-            self.pendingProcesses[processId] = (dataName, 100)
-        except NameError:
-            pass # wasn't valid insert request
-        else:
-            self._insertFace.expressInterest(i, 
-                    self._onInsertionDataReceived,
-                    self._onInsertionDataTimeout)
+        # now send the interest(s) out to the publisher, or wait for a turn
+        if newProcess is not None:
+            publisher = newProcess.dataName[:self.publisherPrefixLength]
+            self.fetchQueue.submit(publisher.toUri(),
+                    partial(self._startInsertFetch, newProcess))
 
 if __name__ == '__main__':
     logging.getLogger('trollius').addHandler(logging.StreamHandler())
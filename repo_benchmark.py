@@ -0,0 +1,446 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+Measures the repo's throughput and latency on synthetic BMS workloads, with
+an in-process stand-in for the forwarder and the publishers, and a scratch
+SQLite database. The results are written as JSON, so that runs of different
+versions can be compared.
+"""
+
+from pyndn import Name, Data, Interest
+from pyndn.encoding import ProtobufTlv
+from repo_command_pb2 import RepoCommandParameterMessage
+from repo_response_pb2 import RepoCommandResponseMessage
+from repo_query import encodeQueryParams
+from bson import BSON
+from repo import NdnHierarchicalRepo
+from sqlite_storage import SQLiteStorageEngine
+
+import trollius as asyncio
+from trollius import From
+import logging
+import math
+import os
+import random
+import shutil
+import struct
+import tempfile
+import time
+
+BMS_SCHEMA = ('/ndn/ucla.edu/bms/<building>/data/<room>/electrical/panel/'
+        '<panel_name>/<quantity>/<quantity_type>/')
+BMS_KEYS = ('building', 'room', 'panel_name', 'quantity', 'quantity_type')
+QUANTITIES = ('voltage', 'current', 'power')
+
+def summarizeLatencies(samples):
+    """
+    :param samples: Latencies in seconds
+    :return: A dict of the count, mean, median, 90th and 99th percentiles and
+        maximum, in milliseconds
+    """
+    if len(samples) == 0:
+        return {'count':0}
+    ordered = sorted(samples)
+    def percentile(p):
+        rank = int(math.ceil(p/100.0*len(ordered)))
+        return ordered[max(rank-1, 0)]*1000
+    return {'count':len(ordered), 'mean':sum(ordered)*1000/len(ordered),
+            'p50':percentile(50), 'p90':percentile(90),
+            'p99':percentile(99), 'max':ordered[-1]*1000}
+
+class LoopbackTransport(object):
+    """
+     Stands in for the transport an Interest arrived on, keeping whatever is
+     sent on it.
+    """
+    def __init__(self):
+        super(LoopbackTransport, self).__init__()
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(data)
+
+class LoopbackFace(object):
+    """
+     Stands in for both of the repo's faces. Interests given to
+     deliverInterest() go to the callback of the longest prefix registered
+     for them. Interests expressed on the face are answered on the loop, as
+     by a forwarder, with the Data that the publishers have put there: Data
+     with the Interest's name, or else the first or last under it, by
+     ChildSelector. Interests with no Data time out right away.
+    """
+    def __init__(self, loop):
+        super(LoopbackFace, self).__init__()
+        self.loop = loop
+        # (prefix, onInterest, prefix id)
+        self._prefixes = []
+        # name URI -> Data
+        self._data = {}
+        self.stats = {'expressed':0, 'answered':0, 'timedOut':0}
+
+    def registerPrefix(self, prefix, onInterest, onRegisterFailed, flags=None):
+        prefixId = len(self._prefixes)
+        self._prefixes.append((Name(prefix), onInterest, prefixId))
+        return prefixId
+
+    def deliverInterest(self, interest):
+        """
+        :return: The packets sent in answer to the Interest, as it was handled
+        """
+        interestName = interest.getName()
+        handler = None
+        for entry in self._prefixes:
+            if entry[0].match(interestName) and (handler is None or
+                    len(entry[0]) > len(handler[0])):
+                handler = entry
+        transport = LoopbackTransport()
+        if handler is not None:
+            (prefix, onInterest, prefixId) = handler
+            onInterest(prefix, interest, transport, prefixId)
+        return transport.sent
+
+    def putData(self, data):
+        self._data[data.getName().toUri()] = data
+
+    def shutdown(self):
+        pass
+
+    def expressInterest(self, interest, onData, onTimeout):
+        self.stats['expressed'] += 1
+        data = self._data.get(interest.getName().toUri())
+        if data is None:
+            candidates = [d for d in self._data.values()
+                    if interest.matchesName(d.getName())]
+            if len(candidates) > 0:
+                candidates.sort(cmp=lambda a, b:
+                        a.getName().compare(b.getName()))
+                if interest.getChildSelector() == 1:
+                    data = candidates[-1]
+                else:
+                    data = candidates[0]
+        if data is None:
+            self.stats['timedOut'] += 1
+            self.loop.call_soon(onTimeout, interest)
+        else:
+            self.stats['answered'] += 1
+            self.loop.call_soon(onData, interest, data)
+        return self.stats['expressed']
+
+class RepoBenchmark(object):
+    """
+     Runs workloads against a repo set up on a LoopbackFace, storing into
+     the given storage engine, or else an SQLite database in a scratch
+     directory. The readings are made up from a seeded random generator, so
+     runs with the same options insert and query the same data.
+
+     Readings come from buildings*rooms*panels series of each quantity, one
+     a minute, each with valueSize bytes of content (as an encrypted
+     reading would be).
+    """
+    def __init__(self, storage=None, seed=1, buildings=4, rooms=3, panels=4,
+            valueSize=48):
+        super(RepoBenchmark, self).__init__()
+        self.random = random.Random(seed)
+        self.valueSize = valueSize
+        self._tempDir = None
+        if storage is None:
+            self._tempDir = tempfile.mkdtemp(prefix='repo-benchmark')
+            storage = SQLiteStorageEngine(os.path.join(self._tempDir,
+                    'bms.db'))
+        self.loop = asyncio.get_event_loop()
+        self.repo = NdnHierarchicalRepo('/test/repo', storage)
+        self.repo.log.setLevel(logging.WARNING)
+        self.repo.addSchema(Name(BMS_SCHEMA))
+        self.schema = self.repo.schemaList[0]
+        self.face = LoopbackFace(self.loop)
+        self.repo.setUp(self.loop, self.face, self.face)
+
+        self.series = []
+        for building in range(buildings):
+            for room in range(rooms):
+                for panel in range(panels):
+                    for quantity in QUANTITIES:
+                        self.series.append(Name(
+                                '/ndn/ucla.edu/bms/B{}/data/{}/electrical/'
+                                'panel/P{}/{}/hist'.format(building,
+                                1400+room, panel, quantity)))
+        # series URI -> timestamp of its next reading, in milliseconds
+        self._nextTimes = {s.toUri():1400000000000 for s in self.series}
+        self._nextSeries = 0
+
+    def close(self):
+        self.repo.shutdown()
+        if self._tempDir is not None:
+            shutil.rmtree(self._tempDir, ignore_errors=True)
+
+    def makeReading(self):
+        """
+        :return: The next reading of the next series, in turn
+        """
+        series = self.series[self._nextSeries]
+        self._nextSeries = (self._nextSeries + 1) % len(self.series)
+        timestamp = self._nextTimes[series.toUri()]
+        self._nextTimes[series.toUri()] = timestamp + 60000
+        data = Data(Name(series).append(struct.pack('!Q', timestamp)))
+        data.setContent(''.join(chr(self.random.getrandbits(8))
+                for i in range(self.valueSize)))
+        return data
+
+    def sendCommand(self, verb, dataName=None, processId=None,
+            startBlockId=None, endBlockId=None):
+        """
+        :return: The repo's response message, or None if it didn't answer
+        """
+        commandMessage = RepoCommandParameterMessage()
+        if dataName is not None:
+            for component in dataName:
+                commandMessage.command.name.components.append(
+                        str(component.getValue()))
+        if processId is not None:
+            commandMessage.command.process_id = processId
+        if startBlockId is not None:
+            commandMessage.command.start_block_id = startBlockId
+        if endBlockId is not None:
+            commandMessage.command.end_block_id = endBlockId
+        commandName = Name(self.repo.repoPrefix).append(verb).append(
+                ProtobufTlv.encode(commandMessage))
+        # where a signed command's timestamp, nonce and signature would be
+        for i in range(4):
+            commandName.append('sig{}'.format(i))
+        sent = self.face.deliverInterest(Interest(commandName))
+        if len(sent) == 0:
+            return None
+        responseData = Data()
+        responseData.wireDecode(bytearray(sent[0]))
+        responseMessage = RepoCommandResponseMessage()
+        ProtobufTlv.decode(responseMessage, responseData.getContent())
+        return responseMessage.response
+
+    def makeQueryName(self, keyValues, params=None):
+        """
+        :param keyValues: Values for some of BMS_KEYS; the others are '_'
+        :param params: Query parameters to append, if any
+        """
+        components = [keyValues.get(k, '_') for k in BMS_KEYS]
+        queryName = Name('/ndn/ucla.edu/bms/{}/data/{}/electrical/panel/{}/'
+                '{}/{}'.format(*components))
+        if params is not None:
+            queryName.append(encodeQueryParams(params))
+        return queryName
+
+    def runIngest(self, bursts=10, burstSize=200, checkInterval=0.01,
+            timeout=30):
+        """
+        Insert bursts of readings with insert commands, each burst once the
+        one before it is written. The latency of an insert is from its
+        command until insert check reports it done (to within
+        checkInterval); the latency of the command itself is in
+        'commandLatency'.
+        """
+        commandLatencies = []
+        insertLatencies = []
+        counts = {'rejected':0, 'failed':0}
+        startTime = time.time()
+        for burst in range(bursts):
+            self.loop.run_until_complete(self._ingestBurst(burstSize,
+                    checkInterval, timeout, commandLatencies,
+                    insertLatencies, counts))
+        seconds = time.time() - startTime
+        results = {'operations':len(insertLatencies), 'seconds':seconds,
+                'throughput':len(insertLatencies)/seconds,
+                'latency':summarizeLatencies(insertLatencies),
+                'commandLatency':summarizeLatencies(commandLatencies)}
+        results.update(counts)
+        return results
+
+    @asyncio.coroutine
+    def _ingestBurst(self, burstSize, checkInterval, timeout,
+            commandLatencies, insertLatencies, counts):
+        readings = [self.makeReading() for i in range(burstSize)]
+        for data in readings:
+            self.face.putData(data)
+        # process id -> time its insert command was sent
+        pending = {}
+        for data in readings:
+            sentTime = time.time()
+            response = self.sendCommand('insert', data.getName())
+            commandLatencies.append(time.time() - sentTime)
+            if response is None or response.status_code >= 400:
+                counts['rejected'] += 1
+            else:
+                pending[response.process_id] = sentTime
+        giveUpTime = time.time() + timeout
+        while len(pending) > 0 and time.time() < giveUpTime:
+            yield From(asyncio.sleep(checkInterval))
+            for processId in list(pending):
+                response = self.sendCommand('insert check',
+                        processId=processId)
+                if response is None or response.status_code == 100:
+                    continue
+                sentTime = pending.pop(processId)
+                if response.status_code == 200:
+                    insertLatencies.append(time.time() - sentTime)
+                else:
+                    counts['failed'] += 1
+        counts['failed'] += len(pending)
+
+    @asyncio.coroutine
+    def _runQueries(self, interests, count, insertEvery, latencies, counts):
+        for i in range(count):
+            interest = self.random.choice(interests)
+            sentTime = time.time()
+            sent = self.face.deliverInterest(interest)
+            latencies.append(time.time() - sentTime)
+            if len(sent) == 0:
+                counts['unanswered'] += 1
+            if insertEvery > 0 and i % insertEvery == insertEvery-1:
+                self.repo.insertData(self.makeReading())
+                counts['inserted'] += 1
+            # let batches be written, and caches invalidated, meanwhile
+            yield From(asyncio.sleep(0))
+
+    def runDashboard(self, queries=2000, insertEvery=50):
+        """
+        Send Interests drawn at random from a small hot set, as dashboards
+        refreshing would: the latest reading of some series, the last hour
+        of each building, and hourly counts by panel for each building.
+        A new reading is inserted every insertEvery queries, which
+        invalidates cached answers as live data would.
+        """
+        interests = []
+        for series in self.series[:8]:
+            interest = Interest(series)
+            interest.setChildSelector(1)
+            interests.append(interest)
+        latestTime = max(self._nextTimes.values())/1000.0
+        buildings = sorted(set(str(s[3].getValue()) for s in self.series))
+        for building in buildings:
+            interests.append(Interest(self.makeQueryName(
+                    {'building':building}, {'where':{'field':'ts', 'op':'>=',
+                    'value':latestTime - 3600}})))
+            interests.append(Interest(self.makeQueryName(
+                    {'building':building}, {'aggregate':{'groupBy':
+                    ['panel_name'], 'bucket':{'field':'ts', 'seconds':3600},
+                    'functions':[{'op':'count', 'field':'*'}]}})))
+
+        latencies = []
+        counts = {'unanswered':0, 'inserted':0}
+        startTime = time.time()
+        self.loop.run_until_complete(self._runQueries(interests, queries,
+                insertEvery, latencies, counts))
+        seconds = time.time() - startTime
+        # so that the readings inserted are counted as written
+        self.loop.run_until_complete(self.repo.ingestBuffer.drain())
+        results = {'operations':len(latencies), 'seconds':seconds,
+                'throughput':len(latencies)/seconds,
+                'latency':summarizeLatencies(latencies)}
+        results.update(counts)
+        return results
+
+    def runPaging(self, passes=3):
+        """
+        Page through every stored reading, one segment after another, as a
+        client exporting the data would. Each pass starts from an empty
+        query cache, so that every segment is found in the database.
+        """
+        latencies = []
+        resultCount = 0
+        segmentCount = 0
+        startTime = time.time()
+        for i in range(passes):
+            self.repo.queryCache.invalidateSchema(self.schema.name)
+            self.repo.querySessions.invalidateSchema(self.schema.name)
+            interest = Interest(self.makeQueryName({}))
+            segmentNum = 0
+            finalSegment = None
+            while finalSegment is None or segmentNum <= finalSegment:
+                sentTime = time.time()
+                sent = self.face.deliverInterest(interest)
+                latencies.append(time.time() - sentTime)
+                if len(sent) == 0:
+                    break
+                responseData = Data()
+                responseData.wireDecode(bytearray(sent[0]))
+                segmentCount += 1
+                resultCount += len(BSON(str(responseData.getContent())
+                        ).decode()['results'])
+                finalBlockId = responseData.getMetaInfo().getFinalBlockID()
+                if finalBlockId.getValue().size() > 0:
+                    finalSegment = finalBlockId.toSegment()
+                segmentNum += 1
+                # later segments are asked for by version and number
+                interest = Interest(responseData.getName().getPrefix(-1)
+                        .appendSegment(segmentNum))
+        seconds = time.time() - startTime
+        return {'operations':segmentCount, 'seconds':seconds,
+                'throughput':segmentCount/seconds,
+                'resultsPerSecond':resultCount/seconds,
+                'results':resultCount, 'latency':summarizeLatencies(latencies)}
+
+    def getRepoStats(self):
+        stats = self.repo.getStatus()
+        stats['face'] = dict(self.face.stats)
+        return stats
+
+def main():
+    import argparse
+    import json
+    import sys
+
+    parser = argparse.ArgumentParser(
+            description='Benchmark the repo on synthetic BMS workloads.')
+    parser.add_argument('-o', '--output',
+            help='write the results to this file instead of stdout')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--bursts', type=int, default=10,
+            help='ingest bursts of insert commands')
+    parser.add_argument('--burst-size', type=int, default=200,
+            help='insert commands in each burst')
+    parser.add_argument('--queries', type=int, default=2000,
+            help='dashboard Interests to send')
+    parser.add_argument('--insert-every', type=int, default=50,
+            help='insert a reading every this many dashboard Interests '
+            '(0 for none)')
+    parser.add_argument('--passes', type=int, default=3,
+            help='times to page through all the readings')
+    args = parser.parse_args()
+
+    benchmark = RepoBenchmark(seed=args.seed)
+    try:
+        workloads = {}
+        workloads['ingest'] = benchmark.runIngest(args.bursts,
+                args.burst_size)
+        workloads['dashboard'] = benchmark.runDashboard(args.queries,
+                args.insert_every)
+        workloads['paging'] = benchmark.runPaging(args.passes)
+        report = {'options':vars(args), 'workloads':workloads,
+                'repo':benchmark.getRepoStats(), 'time':time.time()}
+    finally:
+        benchmark.close()
+
+    if args.output is not None:
+        with open(args.output, 'w') as outFile:
+            json.dump(report, outFile, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+Counters and latency histograms for the repo's hot paths, cheap enough to
+keep on all the time.
+"""
+
+import bisect
+import threading
+import time
+
+class LatencyHistogram(object):
+    """
+     Counts latencies in buckets that double in width, from 10us up to about
+     20s, with one more for anything longer. Percentiles are estimated as the
+     upper bound of the bucket they fall in (or the largest latency seen).
+    """
+    BUCKET_BOUNDS = [0.00001*2**i for i in range(22)]
+
+    def __init__(self):
+        super(LatencyHistogram, self).__init__()
+        self.bucketCounts = [0]*(len(self.BUCKET_BOUNDS)+1)
+        self.count = 0
+        self.totalSeconds = 0.0
+        self.maxSeconds = 0.0
+
+    def add(self, seconds):
+        self.bucketCounts[bisect.bisect_left(self.BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.totalSeconds += seconds
+        if seconds > self.maxSeconds:
+            self.maxSeconds = seconds
+
+    def getPercentile(self, p):
+        """
+        :return: An upper bound on the p'th percentile, in seconds
+        """
+        wanted = p/100.0*self.count
+        seen = 0
+        for (i, bucketCount) in enumerate(self.bucketCounts):
+            seen += bucketCount
+            if seen >= wanted and bucketCount > 0:
+                if i < len(self.BUCKET_BOUNDS):
+                    return min(self.BUCKET_BOUNDS[i], self.maxSeconds)
+                break
+        return self.maxSeconds
+
+    def getStats(self):
+        """
+        :return: The count, and the mean, percentiles and maximum in
+            milliseconds
+        """
+        if self.count == 0:
+            return {'count':0}
+        return {'count':self.count,
+                'mean':self.totalSeconds*1000/self.count,
+                'p50':self.getPercentile(50)*1000,
+                'p90':self.getPercentile(90)*1000,
+                'p99':self.getPercentile(99)*1000,
+                'max':self.maxSeconds*1000}
+
+class RepoMetrics(object):
+    """
+     Named counters and latency histograms. Database writes are timed in the
+     ingest buffer's executor thread, so updates are made under a lock.
+    """
+    def __init__(self):
+        super(RepoMetrics, self).__init__()
+        self.startTime = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram()
+            histogram.add(seconds)
+
+    def getStats(self):
+        with self._lock:
+            return {'uptime':time.time() - self.startTime,
+                    'counters':dict(self.counters),
+                    'latency':{name:histogram.getStats() for (name, histogram)
+                    in self.histograms.items()}}
+
+class MeteredStorage(object):
+    """
+     Wraps a StorageEngine, timing its reads as 'dbRead' and its writes as
+     'dbWrite'. A find() is timed over the iteration of its results, so a
+     scan that stops early only counts what it read. Everything else is
+     passed through to the engine.
+    """
+    READ_METHODS = ('isEmpty', 'findOne', 'count', 'distinct', 'group',
+            'countSeries', 'getCount')
+    WRITE_METHODS = ('insert', 'bulkUpsert', 'remove', 'addCounts')
+
+    def __init__(self, storage, metrics):
+        super(MeteredStorage, self).__init__()
+        self.storage = storage
+        self.metrics = metrics
+        for methodName in self.READ_METHODS:
+            setattr(self, methodName, self._makeTimed(methodName, 'dbRead'))
+        for methodName in self.WRITE_METHODS:
+            setattr(self, methodName, self._makeTimed(methodName, 'dbWrite'))
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def _makeTimed(self, methodName, histogramName):
+        method = getattr(self.storage, methodName)
+        def timed(*args, **kwargs):
+            startTime = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.metrics.observe(histogramName, time.time() - startTime)
+        return timed
+
+    def find(self, *args, **kwargs):
+        startTime = time.time()
+        cursor = self.storage.find(*args, **kwargs)
+        return self._timeResults(iter(cursor), time.time() - startTime)
+
+    def _timeResults(self, results, elapsed):
+        try:
+            while True:
+                startTime = time.time()
+                try:
+                    document = next(results)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += time.time() - startTime
+                yield document
+        finally:
+            self.metrics.observe('dbRead', elapsed)
@@ -0,0 +1,106 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+The query parameter name component shared by the repo and its clients.
+
+A query Interest is the schema name with keys filled in (or '_'), optionally
+followed by one component holding a BSON document of query parameters:
+    'after': the continuation token from the 'next' field of a response
+    'where': a predicate on the schema's fields, for conditions that can't be
+        written into the name
+    'aggregate': {'functions': [{'op': count|avg|min|max|sum, 'field': name
+        or '*'}, ...], 'groupBy': [key name, ...], 'bucket': None or
+        {'field': timestamp field, 'seconds': bucket width}}, to get one
+        result per group (with its 'count') instead of the documents
+    'fields': [field name, ...], to return only those fields (and 'ts' and
+        '_id') of each document
+    'offset', 'limit': how many results to leave out at the start, and the
+        most results to return after that
+    'distinct': a field name, to get its distinct values instead of the
+        documents
+
+A predicate is one of
+    {'field': name, 'op': one of = != < <= > >= in, 'value': value}
+    {'and': [predicate, ...]}
+    {'or': [predicate, ...]}
+where the value for 'in' is a list.
+"""
+
+from bson import BSON
+from bson.errors import BSONError
+
+# not one of the NDN naming convention markers
+QUERY_MARKER = '\xc1'
+
+def encodeQueryParams(params):
+    """
+    :return: The value of a query parameter component
+    """
+    return QUERY_MARKER + BSON.encode(params)
+
+def isQueryParams(component):
+    """
+    Whether a name component is meant as query parameters, as opposed to e.g.
+    the timestamp of a Data name.
+    """
+    return str(component.getValue()).startswith(QUERY_MARKER)
+
+def decodeQueryParams(component):
+    """
+    :param component: A pyndn Name.Component
+    :return: The query parameters, or None if this is not a query parameter
+        component
+    """
+    value = str(component.getValue())
+    if not value.startswith(QUERY_MARKER):
+        return None
+    try:
+        return BSON(value[len(QUERY_MARKER):]).decode()
+    except BSONError:
+        return None
+
+def splitKeyEqualities(predicate, keyNames):
+    """
+    Pull the equality conditions on name keys out of the top level of a
+    predicate, so they can be written into the name.
+    :return: (dict of key values, the rest of the predicate or None)
+    """
+    if predicate is None:
+        return ({}, None)
+    if 'and' in predicate:
+        terms = predicate['and']
+    else:
+        terms = [predicate]
+
+    keyValues = {}
+    remaining = []
+    for term in terms:
+        field = term.get('field')
+        if (term.get('op') == '=' and field in keyNames and
+                field not in keyValues):
+            keyValues[field] = str(term['value'])
+        else:
+            remaining.append(term)
+
+    if len(remaining) == 0:
+        return (keyValues, None)
+    if len(remaining) == 1:
+        return (keyValues, remaining[0])
+    return (keyValues, {'and':remaining})
@@ -0,0 +1,192 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+Fetches all the segments of a query response from the repo, and hands them
+out in order.
+"""
+
+import trollius as asyncio
+from trollius import From, Return
+
+from pyndn import Name, Interest
+from bson import BSON
+from bson.errors import BSONError
+
+from segment_fetcher import SegmentFetcher
+
+class ResultStream(object):
+    """
+     The first Interest, for the query name, finds the version of the results
+     (and the final segment, if the repo knows it yet). The other segments of
+     that version are fetched in parallel by a SegmentFetcher, with at most
+     window Interests outstanding. The window should not be larger than the
+     repo's segmentLookahead, so that the final segment is found before
+     Interests are sent past it.
+
+     Use it from a coroutine:
+        stream = ResultStream(face, queryName)
+        stream.start()
+        while True:
+            response = yield From(stream.next())
+            if response is None:
+                break
+            ...
+     Each response is the decoded content of one segment. If a segment could
+     not be fetched, or the repo answered with an error, the stream ends
+     early and error is set.
+    """
+    def __init__(self, face, queryName, window=16, maxRetries=3,
+            lifetime=4000):
+        super(ResultStream, self).__init__()
+        self.face = face
+        self.queryName = Name(queryName)
+        self.window = window
+        self.maxRetries = maxRetries
+        self.lifetime = lifetime
+
+        self.baseName = None
+        self.finalSegment = None
+        self.error = None
+        self.isDone = False
+
+        self._fetcher = None
+        self._firstRetries = 0
+        # segment number -> response, for segments that arrived early
+        self._received = {}
+        self._nextSegment = 0
+        self._responses = asyncio.Queue()
+
+    def start(self):
+        self._expressFirstInterest()
+
+    def cancel(self):
+        if self._fetcher is not None:
+            self._fetcher.cancel()
+        self._finish()
+
+    @asyncio.coroutine
+    def next(self):
+        """
+        :return: The next response in segment order, or None after the last
+        """
+        response = yield From(self._responses.get())
+        raise Return(response)
+
+    def _expressFirstInterest(self):
+        interest = Interest(self.queryName)
+        interest.setInterestLifetimeMilliseconds(self.lifetime)
+        self.face.expressInterest(interest, self._onFirstSegment,
+                self._onFirstTimeout)
+
+    def _onFirstSegment(self, interest, data):
+        if self.isDone:
+            return
+        dataName = data.getName()
+        try:
+            segmentNum = dataName[-1].toSegment()
+        except RuntimeError:
+            # the repo answers a query it can't run under the query's name
+            try:
+                response = BSON(str(data.getContent())).decode()
+            except BSONError:
+                response = {}
+            if not self._failOnError(response, dataName):
+                self._fail('{} is not a segment'.format(dataName.toUri()))
+            return
+        self.baseName = dataName.getPrefix(-1)
+
+        finalBlockId = data.getMetaInfo().getFinalBlockID()
+        if finalBlockId.getValue().size() > 0:
+            self.finalSegment = finalBlockId.toSegment()
+        self._onSegment(segmentNum, data)
+
+        if self.finalSegment is None or self.finalSegment > segmentNum:
+            self._fetcher = SegmentFetcher(self.face, self.baseName,
+                    segmentNum+1, self.finalSegment, self._onSegment,
+                    self._onFetchComplete, self._onSegmentFailed,
+                    initialWindow=min(4, self.window), maxWindow=self.window,
+                    maxRetries=self.maxRetries)
+            self._fetcher.start()
+
+    def _onFirstTimeout(self, interest):
+        if self.isDone:
+            return
+        self._firstRetries += 1
+        if self._firstRetries > self.maxRetries:
+            self._fail('Timed out on {}'.format(self.queryName.toUri()))
+        else:
+            self._expressFirstInterest()
+
+    def _onSegment(self, segmentNum, data):
+        if self.isDone:
+            return
+        finalBlockId = data.getMetaInfo().getFinalBlockID()
+        if finalBlockId.getValue().size() > 0:
+            self.finalSegment = finalBlockId.toSegment()
+        try:
+            response = BSON(str(data.getContent())).decode()
+        except BSONError:
+            self._fail('Bad response in {}'.format(data.getName().toUri()))
+            return
+
+        if self._failOnError(response, data.getName()):
+            return
+
+        # hand out responses in order, holding on to any that arrive early
+        self._received[segmentNum] = response
+        while self._nextSegment in self._received:
+            self._responses.put_nowait(self._received.pop(self._nextSegment))
+            self._nextSegment += 1
+        if (self.finalSegment is not None and
+                self._nextSegment > self.finalSegment):
+            self._finish()
+
+    def _failOnError(self, response, dataName):
+        """
+        :return: Whether the response is an error from the repo, in which
+            case the stream fails with its reason
+        """
+        if 'error' not in response:
+            return False
+        self._fail('{} (status {}) for {}'.format(response['error'],
+                response.get('status'), dataName.toUri()))
+        return True
+
+    def _onFetchComplete(self):
+        # every segment has been handed out by now, unless one was invalid
+        if not self.isDone:
+            self._onSegmentFailed(self._nextSegment)
+
+    def _onSegmentFailed(self, segmentNum):
+        self._fail('Could not fetch segment {} of {}'.format(segmentNum,
+                self.baseName.toUri()))
+
+    def _fail(self, error):
+        if self.isDone:
+            return
+        self.error = error
+        if self._fetcher is not None:
+            self._fetcher.cancel()
+        self._finish()
+
+    def _finish(self):
+        if not self.isDone:
+            self.isDone = True
+            self._responses.put_nowait(None)
@@ -0,0 +1,115 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+Writes query results to a file as they arrive, so that exports don't have to
+hold the whole result in memory.
+"""
+
+import csv
+import json
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from bson.binary import Binary
+
+def _encodeValue(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Binary):
+        return str(value).encode('hex')
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def _encodeJsonValue(value):
+    """
+    Convert the values that json can't write itself.
+    :raise: TypeError if the value is of a type that can't be written
+    """
+    encoded = _encodeValue(value)
+    if encoded is value:
+        raise TypeError('Cannot write {} as JSON: {!r}'.format(
+                type(value).__name__, value))
+    return encoded
+
+class CsvResultWriter(object):
+    """
+     Writes one CSV row per record. The columns are the given ones, or else
+     those of the first record, with ts first; fields that a later record
+     adds are left out.
+    """
+    def __init__(self, outFile, columns=None):
+        super(CsvResultWriter, self).__init__()
+        self.outFile = outFile
+        self.columns = columns
+        self._writer = None
+        self.recordCount = 0
+
+    def writeRecords(self, records):
+        for record in records:
+            if len(record) == 0:
+                continue # could not be decoded
+            if self._writer is None:
+                self._startWriter(record)
+            self._writer.writerow({k:_encodeValue(v)
+                    for (k, v) in record.iteritems()})
+            self.recordCount += 1
+        self.outFile.flush()
+
+    def _startWriter(self, firstRecord):
+        columns = self.columns
+        if columns is None:
+            columns = sorted(k for k in firstRecord if k not in ('ts', '_id'))
+            if 'ts' in firstRecord:
+                columns.insert(0, 'ts')
+        self._writer = csv.DictWriter(self.outFile,
+                [_encodeValue(c) for c in columns], extrasaction='ignore')
+        self._writer.writeheader()
+
+    def close(self):
+        self.outFile.flush()
+
+class JsonLinesResultWriter(object):
+    """
+     Writes each record as a JSON object on its own line.
+    """
+    def __init__(self, outFile):
+        super(JsonLinesResultWriter, self).__init__()
+        self.outFile = outFile
+        self.recordCount = 0
+
+    def writeRecords(self, records):
+        for record in records:
+            if len(record) == 0:
+                continue # could not be decoded
+            # Binary is a str, so json would write its bytes as they are
+            self.outFile.write(json.dumps({k:_encodeValue(v)
+                    for (k, v) in record.iteritems()}, sort_keys=True,
+                    default=_encodeJsonValue))
+            self.outFile.write('\n')
+            self.recordCount += 1
+        self.outFile.flush()
+
+    def close(self):
+        self.outFile.flush()
+
+RESULT_WRITERS = {'csv':CsvResultWriter, 'jsonl':JsonLinesResultWriter}
@@ -0,0 +1,117 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+Finds the schema for a name, and the values of its keys, in one walk down the
+name.
+"""
+
+class _SchemaTrieNode(object):
+    def __init__(self):
+        super(_SchemaTrieNode, self).__init__()
+        # fixed component value -> node
+        self.children = {}
+        # the node for a key component, if any schema has one here
+        self.keyChild = None
+        # the schema whose prototype ends here
+        self.schema = None
+        # the only schema at or below this node, if there is just one
+        self.onlySchema = None
+        self.schemaCount = 0
+
+class SchemaTrie(object):
+    """
+     A trie of schema prototypes. Fixed components are matched exactly, and key
+     components match anything; where both are possible, fixed components are
+     tried first.
+    """
+    def __init__(self):
+        super(SchemaTrie, self).__init__()
+        self._root = _SchemaTrieNode()
+
+    def addSchema(self, schema):
+        """
+        :raise: ValueError if a schema with the same prototype was added
+        """
+        fieldNames = [None]*len(schema.prototype)
+        for (fieldName, i) in schema.fieldMappings.items():
+            fieldNames[i] = fieldName
+
+        path = [self._root]
+        for (i, component) in enumerate(schema.prototype):
+            node = path[-1]
+            if fieldNames[i] is not None:
+                if node.keyChild is None:
+                    node.keyChild = _SchemaTrieNode()
+                path.append(node.keyChild)
+            else:
+                path.append(node.children.setdefault(component,
+                        _SchemaTrieNode()))
+
+        if path[-1].schema is not None:
+            raise ValueError('Schema {} has the same name layout as {}'.format(
+                    schema.name, path[-1].schema.name))
+        path[-1].schema = schema
+        for node in path:
+            node.schemaCount += 1
+            if node.schemaCount == 1:
+                node.onlySchema = schema
+            else:
+                node.onlySchema = None
+
+    def match(self, name):
+        """
+        Find the schema for a name and the values of its keys. Components past
+        the end of the schema are ignored. A name that ends partway through a
+        prototype matches if only one schema could follow it, and its
+        missing keys are left out. Keys whose component is '_' are also left
+        out.
+        :return: (schema, dict of key values), or (None, None) if no schema
+            matches
+        """
+        values = [str(component.getValue()) for component in name]
+        node = self._matchFrom(self._root, values, 0)
+        if node is None:
+            return (None, None)
+        schema = node.schema or node.onlySchema
+        foundDict = {}
+        for (fieldName, i) in schema.fieldMappings.items():
+            if i < len(values):
+                value = values[i].strip()
+                if value != '_':
+                    foundDict[fieldName] = value
+        return (schema, foundDict)
+
+    def _matchFrom(self, node, values, i):
+        if i == len(values):
+            if node.schema is not None or node.onlySchema is not None:
+                return node
+            return None
+        child = node.children.get(values[i])
+        if child is not None:
+            found = self._matchFrom(child, values, i+1)
+            if found is not None:
+                return found
+        if node.keyChild is not None:
+            found = self._matchFrom(node.keyChild, values, i+1)
+            if found is not None:
+                return found
+        # a whole prototype matched, and the rest of the name is e.g. a
+        # timestamp or query parameters
+        return node if node.schema is not None else None
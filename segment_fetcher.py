@@ -0,0 +1,213 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+Fetches a range of segments under a name, keeping several Interests
+outstanding at once.
+"""
+
+import time
+from functools import partial
+
+from pyndn import Name, Interest
+
+class SegmentFetcher(object):
+    """
+     Fetches segments startSegment..endSegment of baseName with a sliding
+     window of outstanding Interests. The window grows by one segment per
+     window's worth of Data (by one per Data while below the threshold) and is
+     halved on a timeout. Interest lifetimes follow a smoothed RTT estimate,
+     as a TCP retransmission timer would.
+
+     If endSegment is None, segments are fetched until one carries a
+     FinalBlockId, or until setEndSegment() is called. Failing both, a
+     segment past the last one received that times out more than maxRetries
+     times is taken to be past the end, and segments before it are still
+     fetched.
+
+     onSegment(segmentNum, data) is called for each segment as it arrives, in
+     no particular order. onComplete() is called once every segment has
+     arrived, and onFailed(segmentNum) if a segment times out more than
+     maxRetries times, after which nothing more is fetched.
+    """
+    def __init__(self, face, baseName, startSegment, endSegment,
+            onSegment, onComplete, onFailed=None, initialWindow=4,
+            maxWindow=64, maxRetries=3, minLifetime=500, maxLifetime=8000):
+        super(SegmentFetcher, self).__init__()
+        self.face = face
+        self.baseName = Name(baseName)
+        self.endSegment = endSegment
+        self.onSegment = onSegment
+        self.onComplete = onComplete
+        self.onFailed = onFailed
+
+        self.window = float(initialWindow)
+        self.windowThreshold = float(maxWindow)
+        self.maxWindow = maxWindow
+        self.maxRetries = maxRetries
+        self.minLifetime = minLifetime
+        self.maxLifetime = maxLifetime
+
+        self.smoothedRtt = None
+        self.rttVariation = None
+        self.lifetime = 4000
+        # called with each RTT sample, in milliseconds
+        self.onRttSample = None
+
+        self.nextSegment = startSegment
+        self.receivedCount = 0
+        self.lastReceived = None
+        # whether endSegment was given or found, rather than guessed
+        self.isEndKnown = endSegment is not None
+        self.isDone = False
+
+        # segment number -> (time sent, retry count)
+        self._outstanding = {}
+        # segments that timed out and wait for room in the window
+        self._retransmitQueue = []
+
+    def start(self):
+        self._fillWindow()
+
+    def cancel(self):
+        self.isDone = True
+        self._outstanding.clear()
+
+    def setEndSegment(self, endSegment):
+        """
+        Stop fetching after endSegment. Segments past it that are already
+        outstanding are ignored when they arrive.
+        """
+        self.isEndKnown = True
+        self._limitEndSegment(endSegment)
+        self._checkComplete()
+
+    def _limitEndSegment(self, endSegment):
+        if self.endSegment is None or endSegment < self.endSegment:
+            self.endSegment = endSegment
+        for segmentNum in list(self._outstanding):
+            if segmentNum > self.endSegment:
+                del self._outstanding[segmentNum]
+        self._retransmitQueue = [(s, r) for (s, r) in self._retransmitQueue
+                if s <= self.endSegment]
+
+    def _fillWindow(self):
+        while not self.isDone and len(self._outstanding) < int(self.window):
+            if len(self._retransmitQueue) > 0:
+                segmentNum, retryCount = self._retransmitQueue.pop(0)
+            elif self.endSegment is None or self.nextSegment <= self.endSegment:
+                segmentNum, retryCount = self.nextSegment, 0
+                self.nextSegment += 1
+            else:
+                break
+            self._expressSegmentInterest(segmentNum, retryCount)
+
+    def _expressSegmentInterest(self, segmentNum, retryCount):
+        interest = Interest(Name(self.baseName).appendSegment(segmentNum))
+        interest.setInterestLifetimeMilliseconds(self.lifetime)
+        self._outstanding[segmentNum] = (time.time(), retryCount)
+        self.face.expressInterest(interest,
+                partial(self._onData, segmentNum),
+                partial(self._onTimeout, segmentNum))
+
+    def _updateRtt(self, sample):
+        # RFC 6298, in milliseconds
+        if self.smoothedRtt is None:
+            self.smoothedRtt = sample
+            self.rttVariation = sample/2
+        else:
+            self.rttVariation = (0.75*self.rttVariation +
+                    0.25*abs(self.smoothedRtt - sample))
+            self.smoothedRtt = 0.875*self.smoothedRtt + 0.125*sample
+        lifetime = self.smoothedRtt + 4*self.rttVariation
+        self.lifetime = int(min(max(lifetime, self.minLifetime),
+                self.maxLifetime))
+
+    def _onData(self, segmentNum, interest, data):
+        try:
+            sentTime, retryCount = self._outstanding.pop(segmentNum)
+        except KeyError:
+            return # cancelled, or past the end
+        if self.isDone:
+            return
+
+        # Karn's algorithm: retransmitted segments give ambiguous samples
+        if retryCount == 0:
+            sample = (time.time() - sentTime)*1000
+            self._updateRtt(sample)
+            if self.onRttSample is not None:
+                self.onRttSample(sample)
+
+        if self.window < self.windowThreshold:
+            self.window += 1
+        else:
+            self.window += 1/self.window
+        self.window = min(self.window, self.maxWindow)
+
+        finalBlockId = data.getMetaInfo().getFinalBlockID()
+        if finalBlockId.getValue().size() > 0:
+            try:
+                self._limitEndSegment(finalBlockId.toSegment())
+                self.isEndKnown = True
+            except RuntimeError:
+                pass # not a segment number
+
+        self.receivedCount += 1
+        if self.lastReceived is None or segmentNum > self.lastReceived:
+            self.lastReceived = segmentNum
+        self.onSegment(segmentNum, data)
+        if not self._checkComplete():
+            self._fillWindow()
+
+    def _onTimeout(self, segmentNum, interest):
+        try:
+            sentTime, retryCount = self._outstanding.pop(segmentNum)
+        except KeyError:
+            return
+        if self.isDone:
+            return
+
+        self.windowThreshold = max(self.window/2, 1.0)
+        self.window = self.windowThreshold
+        self.lifetime = min(self.lifetime*2, self.maxLifetime)
+
+        if (retryCount >= self.maxRetries and not self.isEndKnown and
+                self.lastReceived is not None and
+                segmentNum > self.lastReceived):
+            # no end was given: this is past it
+            self._limitEndSegment(segmentNum-1)
+            if not self._checkComplete():
+                self._fillWindow()
+        elif retryCount >= self.maxRetries:
+            self.cancel()
+            if self.onFailed is not None:
+                self.onFailed(segmentNum)
+        else:
+            self._retransmitQueue.append((segmentNum, retryCount+1))
+            self._fillWindow()
+
+    def _checkComplete(self):
+        if self.isDone or self.endSegment is None:
+            return self.isDone
+        if (self.nextSegment > self.endSegment and
+                len(self._outstanding) == 0 and
+                len(self._retransmitQueue) == 0):
+            self.isDone = True
+            self.onComplete()
+        return self.isDone
@@ -7,19 +7,22 @@
 #
 # Modified by Adeola Bannis, 2014
 # Added LIMIT and OFFSET clauses
+# Added aggregate functions, GROUP BY and DISTINCT
 #
 from pyparsing import Literal, CaselessLiteral, Word,  delimitedList, Optional, \
     Combine, Group, alphas, nums, alphanums, ParseException, Forward, oneOf, quotedString, \
-    ZeroOrMore, restOfLine, Keyword
+    ZeroOrMore, restOfLine, Keyword, Suppress
 
 def test( str ):
     print str,"->"
     try:
         tokens = simpleSQL.parseString( str )
         print "tokens = ",        tokens
+        print "tokens.distinct =", tokens.distinct
         print "tokens.columns =", tokens.columns
         print "tokens.table =",  tokens.table
         print "tokens.where =", tokens.where
+        print "tokens.groupBy =", tokens.groupBy
         print "tokens.limit = ", tokens.limit
         print "tokens.offset = ", tokens.offset
     except ParseException, err:
@@ -34,7 +37,11 @@ selectToken = Keyword("select", caseless=True)
 
 ident          = Word( alphas, alphanums + "_$" ).setName("identifier")
 columnName     = delimitedList( ident, ".", combine=True ) 
-columnNameList = Group( delimitedList( columnName ) )
+aggregateName  = ( Keyword("count", caseless=True) | Keyword("avg", caseless=True) |
+                   Keyword("min", caseless=True) | Keyword("max", caseless=True) |
+                   Keyword("sum", caseless=True) )
+aggregateCall  = Group( aggregateName + Suppress("(") + ( "*" | columnName ) + Suppress(")") )
+columnNameList = Group( delimitedList( aggregateCall | columnName ) )
 
 
 tableName      =  delimitedList( ident, ".", combine=True ) 
@@ -53,6 +60,10 @@ realNum = Combine( Optional(arithSign) + ( Word( nums ) + "." + Optional( Word(n
 intNum = Combine( Optional(arithSign) + Word( nums ) + 
             Optional( E + Optional("+") + Word(nums) ) )
 
+bucketCall = Group( Keyword("bucket", caseless=True) + Suppress("(") + columnName +
+                   Suppress(",") + intNum + Suppress(")") )
+groupByList = delimitedList( bucketCall | columnName )
+
 columnRval = realNum | intNum | quotedString | columnName # need to add support for alg expressions
 whereCondition = Group(
     ( columnName + binop + columnRval ) |
@@ -64,9 +75,12 @@ whereExpression << whereCondition + ZeroOrMore( ( and_ | or_ ) + whereExpression
 
 # define the grammar
 selectStmt      << ( selectToken + 
+                   Optional( Keyword("distinct", caseless=True), "" ).setResultsName( "distinct" ) +
                    ( '*' | columnNameList ).setResultsName( "columns" ) + 
                    Optional( Group ( CaselessLiteral("from") + tableName), "").setResultsName("table")+
                    Optional( Group( CaselessLiteral("where") + whereExpression ), "" ).setResultsName("where") +
+                   Optional( Group( Keyword("group", caseless=True) + Keyword("by", caseless=True) + 
+                                    groupByList ), "" ).setResultsName("groupBy") +
                    Optional( Group( CaselessLiteral("limit") + intNum), "").setResultsName("limit") +
                    Optional( Group( CaselessLiteral("offset") + intNum), "").setResultsName("offset") )
 
@@ -76,9 +90,113 @@ simpleSQL = selectStmt
 oracleSqlComment = "--" + restOfLine
 simpleSQL.ignore( oracleSqlComment )
 
-test("select * where quantity='current'")
-test("select * from bms where quantity='voltage'")
-test("select panel_name, ts where room='1451' and building='melnitz'")
-test("select * from bms where quantity='voltage' limit 10")
-test("select room, panel_name from bms where quantity='current' offset 10")
-test("select ts, val limit 10 offset 20")
+_OPERATORS = {'eq':'=', 'ne':'!=', 'lt':'<', 'le':'<=', 'gt':'>', 'ge':'>='}
+
+def _parseValue(token):
+    if token[0] in '"\'':
+        return token[1:-1]
+    try:
+        return int(token)
+    except ValueError:
+        pass
+    try:
+        return float(token)
+    except ValueError:
+        return token # an identifier
+
+def _parseCondition(condition):
+    if condition[0] == '(':
+        return _parseWhereTokens(condition[1:-1])
+    field = condition[0]
+    op = condition[1].lower()
+    if op == 'in':
+        values = condition[3:-1]
+        if len(values) > 0 and values[0].lower() == 'select':
+            raise ValueError('Subqueries are not supported')
+        return {'field':field, 'op':'in', 'value':[_parseValue(v) for v in values]}
+    op = _OPERATORS.get(op, op)
+    return {'field':field, 'op':op, 'value':_parseValue(condition[2])}
+
+def _parseWhereTokens(tokens):
+    # AND binds more tightly than OR
+    orTerms = [[]]
+    for token in tokens:
+        if isinstance(token, basestring) and token.lower() == 'or':
+            orTerms.append([])
+        elif isinstance(token, basestring) and token.lower() == 'and':
+            pass
+        else:
+            orTerms[-1].append(_parseCondition(token))
+    predicates = []
+    for andTerms in orTerms:
+        if len(andTerms) == 1:
+            predicates.append(andTerms[0])
+        else:
+            predicates.append({'and':andTerms})
+    if len(predicates) == 1:
+        return predicates[0]
+    return {'or':predicates}
+
+def _makeAggregate(columns, aggregates, groupBy):
+    aggregate = {'functions':aggregates, 'groupBy':[], 'bucket':None}
+    for item in groupBy:
+        if isinstance(item, basestring):
+            aggregate['groupBy'].append(item)
+        elif aggregate['bucket'] is not None:
+            raise ValueError('Only one BUCKET is allowed')
+        else:
+            aggregate['bucket'] = {'field':item[1], 'seconds':int(item[2])}
+    for column in columns:
+        if column not in aggregate['groupBy'] and (aggregate['bucket'] is None
+                or column != aggregate['bucket']['field']):
+            raise ValueError('{} must be in GROUP BY'.format(column))
+    return aggregate
+
+def parseSelect( statement ):
+    """
+    Parse a SELECT statement into a dict with 'columns' (a list of column
+    names, or ['*']), 'table' (or None), 'where' (a predicate tree, as
+    described in repo_query.py, or None), 'aggregate' (as described in
+    repo_query.py, or None), 'distinct' (a bool) and 'limit' and 'offset'
+    (ints, or None).
+    :raise: ParseException if the statement is malformed
+    :raise: ValueError if a condition is not supported
+    """
+    tokens = simpleSQL.parseString( statement, parseAll=True )
+    columns = tokens.columns.asList()
+    aggregates = []
+    if columns != ['*']:
+        columns = [c for c in columns[0] if isinstance(c, basestring)]
+        aggregates = [{'op':c[0].lower(), 'field':c[1]}
+                for c in tokens.columns[0] if not isinstance(c, basestring)]
+    parsed = {'columns':columns, 'table':None, 'where':None,
+            'limit':None, 'offset':None, 'aggregate':None,
+            'distinct':bool(tokens.distinct)}
+    if parsed['distinct'] and (columns == ['*'] or len(aggregates) > 0):
+        raise ValueError('DISTINCT needs a list of key names')
+    if tokens.table and tokens.table[0]:
+        parsed['table'] = tokens.table[0][1]
+    if tokens.where and tokens.where[0]:
+        parsed['where'] = _parseWhereTokens(tokens.where[0].asList()[1:])
+    if tokens.groupBy and tokens.groupBy[0]:
+        groupBy = tokens.groupBy[0].asList()[2:]
+    else:
+        groupBy = []
+    if len(aggregates) > 0 or len(groupBy) > 0:
+        parsed['aggregate'] = _makeAggregate(columns, aggregates, groupBy)
+    if tokens.limit and tokens.limit[0]:
+        parsed['limit'] = int(tokens.limit[0][1])
+    if tokens.offset and tokens.offset[0]:
+        parsed['offset'] = int(tokens.offset[0][1])
+    return parsed
+
+if __name__ == '__main__':
+    test("select * where quantity='current'")
+    test("select * from bms where quantity='voltage'")
+    test("select panel_name, ts where room='1451' and building='melnitz'")
+    test("select * from bms where quantity='voltage' limit 10")
+    test("select room, panel_name from bms where quantity='current' offset 10")
+    test("select ts, val limit 10 offset 20")
+    test("select * where ts >= '2014-10-01 10:00' and (room='1451' or room='1452')")
+    test("select room, avg(val), max(val) where building='melnitz' group by room, bucket(ts, 900)")
+    test("select distinct room where building='melnitz'")
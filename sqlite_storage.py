@@ -0,0 +1,480 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+Stores the repo's documents in an SQLite database file, so that a repo can
+run without a database server.
+"""
+
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from bson import BSON
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from bson.son import SON
+
+from storage_engine import StorageEngine, DESCENDING
+
+_EPOCH = datetime(1970, 1, 1)
+
+# kinds of column, by how their values are stored
+_ID = 'id'          # ObjectId, as its 12 bytes
+_TEXT = 'text'
+_INT = 'int'
+_REAL = 'real'
+_BLOB = 'blob'
+_TIME = 'time'      # naive datetime, as microseconds since the epoch
+
+_SQL_TYPES = {_ID:'BLOB', _TEXT:'TEXT', _INT:'INTEGER', _REAL:'REAL',
+        _BLOB:'BLOB', _TIME:'INTEGER'}
+
+_COMPARISONS = {'$lt':'<', '$lte':'<=', '$gt':'>', '$gte':'>=', '$ne':'!='}
+
+_AGGREGATE_FUNCTIONS = {'avg':'AVG', 'sum':'SUM', 'min':'MIN', 'max':'MAX'}
+
+def _quote(identifier):
+    return '"{}"'.format(identifier.replace('"', '""'))
+
+def _encodeValue(kind, value):
+    if value is None:
+        return None
+    if isinstance(value, ObjectId):
+        return buffer(value.binary)
+    if isinstance(value, datetime):
+        delta = value - _EPOCH
+        return (delta.days*86400 + delta.seconds)*1000000 + delta.microseconds
+    if kind in (_BLOB, _ID):
+        return buffer(str(value))
+    return value
+
+def _decodeValue(kind, value):
+    if value is None:
+        return None
+    if kind == _ID:
+        return ObjectId(str(value))
+    if kind == _TIME:
+        return _EPOCH + timedelta(microseconds=value)
+    if kind == _BLOB:
+        return Binary(str(value))
+    return value
+
+class SQLiteStorageEngine(StorageEngine):
+    """
+     Keeps each schema's documents in a table named after the schema, with a
+     column per schema field (and for _id, segment, the name digest and the
+     wire encoding), and its counters in '<schema name>.counts'. Fields that
+     are not in the schema are not stored. The indexes are the schema's, as
+     for MongoDB.
+
+     The database is in WAL mode, so queries are not blocked by the writes
+     of the ingest buffer, which use their own connection. An in-memory
+     database (path ':memory:') has just the one connection, so queries take
+     the write lock too, and read all their rows at once. With synchronous
+     'FULL', a write is on disk before it is reported done, like a journaled
+     MongoDB write; 'NORMAL' is faster, but may lose the last writes if the
+     machine (not just the repo) goes down.
+    """
+    def __init__(self, path, synchronous='FULL'):
+        super(SQLiteStorageEngine, self).__init__()
+        self.path = path
+        self.synchronous = synchronous
+        self._readConnection = None
+        self._writeConnection = None
+        self._writeLock = threading.Lock()
+        # schema name -> column name -> kind
+        self._columns = {}
+
+    def open(self):
+        self._writeConnection = self._connect()
+        if self.path == ':memory:':
+            # another connection would be another database
+            self._readConnection = self._writeConnection
+        else:
+            self._readConnection = self._connect()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous={}'.format(self.synchronous))
+        return connection
+
+    def close(self):
+        for connection in set([self._readConnection, self._writeConnection]):
+            if connection is not None:
+                connection.close()
+        self._readConnection = None
+        self._writeConnection = None
+
+    def _getColumns(self, schema):
+        columns = self._columns.get(schema.name)
+        if columns is None:
+            columns = OrderedDict([('_id', _ID)])
+            kinds = {schema.SCHEMA_STR:_TEXT, schema.SCHEMA_INT:_INT,
+                    schema.SCHEMA_FLOAT:_REAL, schema.SCHEMA_BINARY:_BLOB,
+                    schema.SCHEMA_TIMESTAMP:_TIME}
+            for (fieldName, fieldType) in sorted(schema.fieldTypes.items()):
+                columns[fieldName] = kinds[fieldType]
+            columns['segment'] = _INT
+            columns[schema.NAME_DIGEST_FIELD] = _BLOB
+            columns[schema.WIRE_FIELD] = _BLOB
+            self._columns[schema.name] = columns
+        return columns
+
+    def _getColumn(self, columns, fieldName):
+        if fieldName not in columns:
+            raise ValueError('No field {}'.format(fieldName))
+        return _quote(fieldName)
+
+    def ensureIndexes(self, schema):
+        # a field may have been added to the schema since it was created
+        self._columns.pop(schema.name, None)
+        columns = self._getColumns(schema)
+        table = _quote(schema.name)
+        indexPrefix = schema.name + '__'
+        with self._writeLock:
+            connection = self._writeConnection
+            connection.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(
+                    table, ', '.join('{} {}{}'.format(_quote(c), _SQL_TYPES[k],
+                    ' PRIMARY KEY' if c == '_id' else '')
+                    for (c, k) in columns.items())))
+            existingColumns = set(row[1] for row in
+                    connection.execute('PRAGMA table_info({})'.format(table)))
+            for (c, k) in columns.items():
+                if c not in existingColumns:
+                    connection.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                            table, _quote(c), _SQL_TYPES[k]))
+            connection.execute('CREATE TABLE IF NOT EXISTS {} '
+                    '(counterId BLOB PRIMARY KEY, n INTEGER)'.format(
+                    _quote(schema.name+'.counts')))
+
+            uniqueSpecs = schema.getUniqueIndexSpecs()
+            wantedIndexes = OrderedDict()
+            for spec in schema.getIndexSpecs():
+                indexName = indexPrefix + '_'.join('{}_{}'.format(k, d)
+                        for (k, d) in spec)
+                if spec in uniqueSpecs:
+                    indexName += '_unique'
+                wantedIndexes[indexName] = spec
+            existingIndexes = [row[0] for row in connection.execute(
+                    "SELECT name FROM sqlite_master WHERE type='index' AND "
+                    "tbl_name=? AND sql IS NOT NULL", (schema.name,))]
+            droppedNames = []
+            for indexName in existingIndexes:
+                if indexName not in wantedIndexes:
+                    connection.execute('DROP INDEX {}'.format(
+                            _quote(indexName)))
+                    droppedNames.append(indexName)
+            builtSpecs = []
+            for (indexName, spec) in wantedIndexes.items():
+                if indexName in existingIndexes:
+                    continue
+                connection.execute('CREATE {}INDEX {} ON {} ({})'.format(
+                        'UNIQUE ' if spec in uniqueSpecs else '',
+                        _quote(indexName), table, ', '.join('{} {}'.format(
+                        self._getColumn(columns, k),
+                        'DESC' if d == DESCENDING else 'ASC')
+                        for (k, d) in spec)))
+                builtSpecs.append(spec)
+            connection.commit()
+        return (builtSpecs, droppedNames)
+
+    def _makeWhere(self, columns, query):
+        """
+        Translate a query into an SQL condition.
+        :return: (condition, parameters)
+        :raise: ValueError if the query uses an unknown field or operator
+        """
+        conditions = []
+        parameters = []
+        for (fieldName, value) in query.items():
+            if fieldName in ('$and', '$or'):
+                parts = [self._makeWhere(columns, q) for q in value]
+                if len(parts) == 0:
+                    continue
+                joiner = ' AND ' if fieldName == '$and' else ' OR '
+                conditions.append('(' + joiner.join(
+                        '({})'.format(c) for (c, p) in parts) + ')')
+                for (c, p) in parts:
+                    parameters.extend(p)
+                continue
+            if fieldName.startswith('$'):
+                raise ValueError('Unknown operator {}'.format(fieldName))
+            column = self._getColumn(columns, fieldName)
+            kind = columns[fieldName]
+            if not isinstance(value, dict):
+                if value is None:
+                    conditions.append('{} IS NULL'.format(column))
+                else:
+                    conditions.append('{} = ?'.format(column))
+                    parameters.append(_encodeValue(kind, value))
+                continue
+            for (op, operand) in value.items():
+                if op == '$ne':
+                    # as in MongoDB, documents without the field match
+                    conditions.append('({0} IS NULL OR {0} != ?)'.format(
+                            column))
+                    parameters.append(_encodeValue(kind, operand))
+                elif op in _COMPARISONS:
+                    conditions.append('{} {} ?'.format(column,
+                            _COMPARISONS[op]))
+                    parameters.append(_encodeValue(kind, operand))
+                elif op == '$in':
+                    if len(operand) == 0:
+                        conditions.append('0')
+                        continue
+                    conditions.append('{} IN ({})'.format(column,
+                            ', '.join('?'*len(operand))))
+                    parameters.extend(_encodeValue(kind, v) for v in operand)
+                elif op == '$exists':
+                    conditions.append('{} IS {}NULL'.format(column,
+                            'NOT ' if operand else ''))
+                else:
+                    raise ValueError('Unknown operator {}'.format(op))
+        if len(conditions) == 0:
+            return ('1', [])
+        return (' AND '.join(conditions), parameters)
+
+    def _decodeRow(self, columnNames, kinds, row):
+        document = {}
+        for (columnName, kind, value) in zip(columnNames, kinds, row):
+            if value is not None:
+                document[columnName] = _decodeValue(kind, value)
+        return document
+
+    def isEmpty(self, schema):
+        return self.findOne(schema, {}, {'_id':True}) is None
+
+    def _read(self, statement, parameters):
+        """
+        Run a query on the read connection.
+        :return: An iterable of the rows
+        """
+        if self._readConnection is self._writeConnection:
+            with self._writeLock:
+                return self._readConnection.execute(statement,
+                        parameters).fetchall()
+        return self._readConnection.execute(statement, parameters)
+
+    def bulkUpsert(self, schema, documents, getCounts=None):
+        columns = self._getColumns(schema)
+        (writtenDocuments, repeatCount) = self._uniqueDocuments(documents,
+                schema.NAME_DIGEST_FIELD)
+        newDocuments = []
+        with self._writeLock:
+            connection = self._writeConnection
+            try:
+                for document in writtenDocuments:
+                    columnNames = ['_id']
+                    values = [_encodeValue(_ID, document.get('_id', ObjectId()))]
+                    for (fieldName, value) in document.items():
+                        if fieldName in columns and fieldName != '_id':
+                            columnNames.append(_quote(fieldName))
+                            values.append(_encodeValue(columns[fieldName],
+                                    value))
+                    cursor = connection.execute(
+                            'INSERT OR IGNORE INTO {} ({}) VALUES ({})'.format(
+                            _quote(schema.name), ', '.join(columnNames),
+                            ', '.join('?'*len(values))), values)
+                    if cursor.rowcount == 1:
+                        newDocuments.append(document)
+                if getCounts is not None:
+                    self._addCounts(connection, schema,
+                            getCounts(newDocuments))
+                connection.commit()
+            except:
+                connection.rollback()
+                raise
+        matchedCount = len(writtenDocuments) - len(newDocuments)
+        return {'nUpserted':len(newDocuments), 'nMatched':matchedCount,
+                'nDuplicates':repeatCount + matchedCount,
+                'newDocuments':newDocuments}
+
+    def find(self, schema, query, projection=None, sort=None, skip=0,
+            limit=0):
+        columns = self._getColumns(schema)
+        if projection is None:
+            columnNames = list(columns)
+        elif any(projection.values()):
+            columnNames = ['_id'] + [c for c in columns
+                    if projection.get(c) and c != '_id']
+        else:
+            columnNames = [c for c in columns if c not in projection]
+        (where, parameters) = self._makeWhere(columns, query)
+        statement = 'SELECT {} FROM {} WHERE {}'.format(
+                ', '.join(_quote(c) for c in columnNames), _quote(schema.name),
+                where)
+        if sort:
+            statement += ' ORDER BY ' + ', '.join('{} {}'.format(
+                    self._getColumn(columns, k),
+                    'DESC' if d == DESCENDING else 'ASC') for (k, d) in sort)
+        if limit > 0 or skip > 0:
+            statement += ' LIMIT ? OFFSET ?'
+            parameters = parameters + [limit if limit > 0 else -1, skip]
+        rows = self._read(statement, parameters)
+        kinds = [columns[c] for c in columnNames]
+        return self._iterateRows(rows, columnNames, kinds)
+
+    def _iterateRows(self, rows, columnNames, kinds):
+        for row in rows:
+            yield self._decodeRow(columnNames, kinds, row)
+
+    def count(self, schema, query):
+        (where, parameters) = self._makeWhere(self._getColumns(schema), query)
+        rows = self._read('SELECT COUNT(*) FROM {} WHERE {}'.format(
+                _quote(schema.name), where), parameters)
+        return list(rows)[0][0]
+
+    def distinct(self, schema, query, fieldName):
+        columns = self._getColumns(schema)
+        column = self._getColumn(columns, fieldName)
+        (where, parameters) = self._makeWhere(columns, query)
+        rows = self._read(
+                'SELECT DISTINCT {0} FROM {1} WHERE {2} AND {0} IS NOT NULL'
+                .format(column, _quote(schema.name), where), parameters)
+        return [_decodeValue(columns[fieldName], row[0]) for row in rows]
+
+    def group(self, schema, query, aggregate):
+        columns = self._getColumns(schema)
+        # (name in the group key, SQL expression, kind)
+        keyExpressions = []
+        for fieldName in aggregate.get('groupBy', []):
+            keyExpressions.append((fieldName,
+                    self._getColumn(columns, fieldName), columns[fieldName]))
+        bucket = aggregate.get('bucket')
+        if bucket is not None:
+            fieldName = bucket['field']
+            bucketSize = int(bucket['seconds'])*1000
+            sinceEpoch = '({}/1000)'.format(self._getColumn(columns, fieldName))
+            keyExpressions.append((fieldName, '({0} - {0} % {1})'.format(
+                    sinceEpoch, bucketSize), _INT))
+        valueExpressions = [('count', 'COUNT(*)', _INT)]
+        for function in aggregate.get('functions', []):
+            op = function['op']
+            fieldName = function['field']
+            if op == 'count':
+                continue
+            kind = columns[fieldName]
+            if op in ('avg', 'sum'):
+                kind = _REAL if op == 'avg' else kind
+            valueExpressions.append(('{}_{}'.format(op, fieldName),
+                    '{}({})'.format(_AGGREGATE_FUNCTIONS[op],
+                    self._getColumn(columns, fieldName)), kind))
+
+        (where, parameters) = self._makeWhere(columns, query)
+        statement = 'SELECT {} FROM {} WHERE {}'.format(', '.join(e for
+                (n, e, k) in keyExpressions + valueExpressions),
+                _quote(schema.name), where)
+        if len(keyExpressions) > 0:
+            groupColumns = ', '.join(str(i+1)
+                    for i in range(len(keyExpressions)))
+            statement += ' GROUP BY {0} ORDER BY {0}'.format(groupColumns)
+        groups = []
+        for row in self._read(statement, parameters):
+            groupKey = {}
+            for ((name, e, kind), value) in zip(keyExpressions, row):
+                groupKey[name] = _decodeValue(kind, value)
+            values = {}
+            for ((name, e, kind), value) in zip(valueExpressions,
+                    row[len(keyExpressions):]):
+                values[name] = _decodeValue(kind, value)
+            if values['count'] > 0:
+                # with no GROUP BY, there is a row even if nothing matched
+                groups.append((groupKey, values))
+        return groups
+
+    def countSeries(self, schema, query):
+        (statement, parameters) = self._makeCountSeries(schema, query)
+        return self._decodeSeriesCounts(schema, self._read(statement,
+                parameters))
+
+    def _makeCountSeries(self, schema, query):
+        """
+        :return: (statement, parameters) counting the matching documents of
+            each combination of key values
+        """
+        columns = self._getColumns(schema)
+        keyColumns = ', '.join(self._getColumn(columns, k)
+                for k in schema.getKeyNames())
+        (where, parameters) = self._makeWhere(columns, query)
+        return ('SELECT {0}, COUNT(*) FROM {1} WHERE {2} GROUP BY {0}'.format(
+                keyColumns, _quote(schema.name), where), parameters)
+
+    def _decodeSeriesCounts(self, schema, rows):
+        keyNames = schema.getKeyNames()
+        return [({k:v for (k, v) in zip(keyNames, row) if v is not None},
+                row[-1]) for row in rows]
+
+    def remove(self, schema, query, getCounts=None):
+        (where, parameters) = self._makeWhere(self._getColumns(schema), query)
+        with self._writeLock:
+            connection = self._writeConnection
+            try:
+                if getCounts is not None:
+                    # on the write connection, which nothing else writes on
+                    # while the lock is held, so the counts are of exactly
+                    # the documents deleted
+                    (statement, countParameters) = self._makeCountSeries(
+                            schema, query)
+                    counts = getCounts(self._decodeSeriesCounts(schema,
+                            connection.execute(statement,
+                            countParameters).fetchall()))
+                cursor = connection.execute('DELETE FROM {} WHERE {}'.format(
+                        _quote(schema.name), where), parameters)
+                if getCounts is not None:
+                    self._addCounts(connection, schema, counts)
+                connection.commit()
+            except:
+                connection.rollback()
+                raise
+        return cursor.rowcount
+
+    def _encodeCounterId(self, counterId):
+        return buffer(BSON.encode(SON(counterId)))
+
+    def getCount(self, schema, counterId):
+        for row in self._read('SELECT n FROM {} WHERE counterId = ?'.format(
+                _quote(schema.name+'.counts')),
+                (self._encodeCounterId(counterId),)):
+            return row[0]
+        return None
+
+    def addCounts(self, schema, counts):
+        if len(counts) == 0:
+            return
+        with self._writeLock:
+            connection = self._writeConnection
+            try:
+                self._addCounts(connection, schema, counts)
+                connection.commit()
+            except:
+                connection.rollback()
+                raise
+
+    def _addCounts(self, connection, schema, counts):
+        # in the caller's transaction, with the write lock held
+        table = _quote(schema.name+'.counts')
+        for (counterId, n) in counts.items():
+            encodedId = self._encodeCounterId(counterId)
+            connection.execute('INSERT OR IGNORE INTO {} VALUES (?, 0)'
+                    .format(table), (encodedId,))
+            connection.execute('UPDATE {} SET n = n + ? WHERE '
+                    'counterId = ?'.format(table), (n, encodedId))
@@ -0,0 +1,352 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+The interface between the repo and the database that holds its documents,
+and the MongoDB implementation of it.
+"""
+
+import pymongo as mongo
+from bson.son import SON
+
+ASCENDING = 1
+DESCENDING = -1
+
+class StorageEngine(object):
+    """
+     Stores the documents of each schema, and the result counts the repo
+     maintains for them.
+
+     Queries are documents in the MongoDB query language, as
+     NdnSchema.makeQuery() and mergeQueries() make them: field equalities,
+     $ne, $lt, $lte, $gt, $gte, $in and $exists conditions, and $and and $or.
+     Every document has an ObjectId _id, which orders documents by when they
+     were written; the repo sets it before writing a document. Documents are
+     identified by their name digest, which is unique.
+
+     A projection is either {fieldName: True, ...}, to return only those
+     fields (and _id), or {fieldName: False, ...}, to return all but those.
+     A sort is a list of (fieldName, ASCENDING or DESCENDING).
+
+     Counters are identified by tuples of (key name, value) pairs, and count
+     the documents with those key values.
+
+     bulkUpsert(), remove() and addCounts() may be called from a thread other
+     than the one making queries; what they read for themselves (e.g. the
+     series counts in remove()) is read as part of the write.
+    """
+    def open(self):
+        raise NotImplementedError()
+
+    def close(self):
+        raise NotImplementedError()
+
+    def ensureIndexes(self, schema):
+        """
+        Make sure the schema's documents have all the indexes in
+        schema.getIndexSpecs(), and drop any others.
+        :return: (specs of the indexes built, names of the indexes dropped)
+        """
+        raise NotImplementedError()
+
+    def isEmpty(self, schema):
+        raise NotImplementedError()
+
+    def adoptLegacyDocuments(self, schema):
+        """
+        Make the documents an earlier version of the repo stored (all in one
+        place, whatever their schema) the schema's own.
+        :return: The number of documents adopted, or None if there are some
+            but the schema already has documents, so they were left alone
+        """
+        return 0
+
+    def insert(self, schema, document):
+        """
+        :return: Whether the document was new
+        """
+        return self.bulkUpsert(schema, [document])['nUpserted'] == 1
+
+    def bulkUpsert(self, schema, documents, getCounts=None):
+        """
+        Write the documents that are not stored yet, by name digest; stored
+        documents are left as they are.
+        :param getCounts: If given, called with the documents written, to get
+            changes to the counters (as for addCounts()) that are made with
+            them, in the same transaction if the engine has transactions
+        :return: A dict with the number of documents written in 'nUpserted',
+            of those already stored in 'nMatched', of those already stored or
+            repeated in the batch in 'nDuplicates', and the documents written
+            in 'newDocuments'
+        :raise: An exception if the write failed
+        """
+        raise NotImplementedError()
+
+    def find(self, schema, query, projection=None, sort=None, skip=0,
+            limit=0):
+        """
+        :param limit: The most documents to return, or 0 for all of them
+        :return: An iterable of the matching documents
+        """
+        raise NotImplementedError()
+
+    def findOne(self, schema, query, projection=None, sort=None):
+        """
+        :return: A matching document (the first in sort order), or None
+        """
+        for document in self.find(schema, query, projection, sort, limit=1):
+            return document
+        return None
+
+    def count(self, schema, query):
+        raise NotImplementedError()
+
+    def distinct(self, schema, query, fieldName):
+        """
+        :return: A list of the distinct values of the field among the matching
+            documents
+        """
+        raise NotImplementedError()
+
+    def group(self, schema, query, aggregate):
+        """
+        Run an aggregate query parameter (see repo_query.py) over the matching
+        documents.
+        :return: A list of (group key, values) in group key order. The group
+            key is a dict of the groupBy key values, and the bucket field, as
+            the start of its time bucket in milliseconds since the epoch. The
+            values are the group's count and, for each aggregate function,
+            '<op>_<field>'.
+        """
+        raise NotImplementedError()
+
+    def countSeries(self, schema, query):
+        """
+        Count the matching documents for each distinct combination of key
+        values.
+        :return: A list of (key values dict, count)
+        """
+        raise NotImplementedError()
+
+    def remove(self, schema, query, getCounts=None):
+        """
+        :param getCounts: If given, called with the series counts (as from
+            countSeries()) of the documents to be removed, to get changes to
+            the counters (as for addCounts()) that are made with the removal,
+            in the same transaction if the engine has transactions
+        :return: The number of documents removed
+        """
+        raise NotImplementedError()
+
+    def getCount(self, schema, counterId):
+        """
+        :return: The counter's value, or None if there is no such counter
+        """
+        raise NotImplementedError()
+
+    def addCounts(self, schema, counts):
+        """
+        :param counts: A dict of counter ids to amounts to add to them,
+            creating them if needed
+        """
+        raise NotImplementedError()
+
+    def _uniqueDocuments(self, documents, digestField):
+        """
+        :return: (documents with different name digests, number left out)
+        """
+        uniqueDocuments = []
+        seenDigests = set()
+        for document in documents:
+            nameDigest = document[digestField]
+            if nameDigest in seenDigests:
+                continue
+            seenDigests.add(nameDigest)
+            uniqueDocuments.append(document)
+        return (uniqueDocuments, len(documents) - len(uniqueDocuments))
+
+class MongoStorageEngine(StorageEngine):
+    """
+     Keeps each schema's documents in a collection named after the schema, in
+     the dbName database, and its counters in '<schema name>.counts'. Writes
+     use writeConcern; by default, they are only done once in the journal.
+
+     Earlier versions of the repo kept every document in the 'data'
+     collection; adoptLegacyDocuments() renames it for a schema.
+    """
+    LEGACY_COLLECTION = 'data'
+
+    def __init__(self, dbName='bms', host=None, port=None, writeConcern=None):
+        super(MongoStorageEngine, self).__init__()
+        if writeConcern is None:
+            writeConcern = {'w':1, 'j':True}
+        self.dbName = dbName
+        self.host = host
+        self.port = port
+        self.writeConcern = writeConcern
+        self.client = None
+        self.db = None
+
+    def open(self):
+        self.client = mongo.MongoClient(self.host, self.port)
+        self.db = self.client[self.dbName]
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+        self.client = None
+        self.db = None
+
+    def _getCollection(self, schema):
+        return self.db[schema.name]
+
+    def _getCountCollection(self, schema):
+        return self.db[schema.name+'.counts']
+
+    def adoptLegacyDocuments(self, schema):
+        collectionNames = self.db.collection_names()
+        if (self.LEGACY_COLLECTION not in collectionNames or
+                schema.name == self.LEGACY_COLLECTION):
+            return 0
+        legacyCollection = self.db[self.LEGACY_COLLECTION]
+        legacyCount = legacyCollection.count()
+        if legacyCount == 0:
+            return 0
+        if schema.name in collectionNames and not self.isEmpty(schema):
+            return None
+        if schema.name in collectionNames:
+            self._getCollection(schema).drop()
+        legacyCollection.rename(schema.name)
+        return legacyCount
+
+    def ensureIndexes(self, schema):
+        collection = self._getCollection(schema)
+        wantedSpecs = schema.getIndexSpecs()
+        uniqueSpecs = schema.getUniqueIndexSpecs()
+        existingSpecs = []
+        droppedNames = []
+        for (indexName, indexInfo) in collection.index_information().items():
+            spec = [(k, int(d)) for (k, d) in indexInfo['key']]
+            isUnique = indexInfo.get('unique', False)
+            if indexName == '_id_' or (spec in wantedSpecs and
+                    isUnique == (spec in uniqueSpecs)):
+                existingSpecs.append(spec)
+            else:
+                collection.drop_index(indexName)
+                droppedNames.append(indexName)
+
+        builtSpecs = []
+        for spec in wantedSpecs:
+            if spec not in existingSpecs:
+                if spec in uniqueSpecs:
+                    # sparse, since documents written before there were
+                    # name digests don't have one
+                    collection.create_index(spec, unique=True, sparse=True,
+                            background=True)
+                else:
+                    collection.create_index(spec, background=True)
+                builtSpecs.append(spec)
+        return (builtSpecs, droppedNames)
+
+    def isEmpty(self, schema):
+        return self._getCollection(schema).find_one() is None
+
+    def bulkUpsert(self, schema, documents, getCounts=None):
+        digestField = schema.NAME_DIGEST_FIELD
+        (writtenDocuments, repeatCount) = self._uniqueDocuments(documents,
+                digestField)
+        bulk = self._getCollection(schema).initialize_unordered_bulk_op()
+        for document in writtenDocuments:
+            bulk.find({digestField:document[digestField]}).upsert().update_one(
+                    {'$setOnInsert':document})
+        result = bulk.execute(self.writeConcern)
+        newDocuments = [writtenDocuments[upserted['index']]
+                for upserted in result.get('upserted', [])]
+        if getCounts is not None:
+            # there are no transactions over several documents
+            self.addCounts(schema, getCounts(newDocuments))
+        return {'nUpserted':result.get('nUpserted', 0),
+                'nMatched':result.get('nMatched', 0),
+                'nDuplicates':repeatCount + result.get('nMatched', 0),
+                'newDocuments':newDocuments}
+
+    def find(self, schema, query, projection=None, sort=None, skip=0,
+            limit=0):
+        cursor = self._getCollection(schema).find(query, projection)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+        return cursor.skip(skip).limit(limit)
+
+    def findOne(self, schema, query, projection=None, sort=None):
+        return self._getCollection(schema).find_one(query, projection,
+                sort=sort)
+
+    def count(self, schema, query):
+        return self._getCollection(schema).find(query).count()
+
+    def distinct(self, schema, query, fieldName):
+        # the database can answer this from the field's index
+        return self._getCollection(schema).find(query).distinct(fieldName)
+
+    def _aggregate(self, schema, pipeline):
+        aggregateResult = self._getCollection(schema).aggregate(pipeline)
+        if isinstance(aggregateResult, dict):
+            # older servers answer with a document rather than a cursor
+            aggregateResult = aggregateResult['result']
+        return aggregateResult
+
+    def group(self, schema, query, aggregate):
+        pipeline = [{'$match':query}, schema.makeGroupStage(aggregate),
+                {'$sort':{'_id':ASCENDING}}]
+        groups = []
+        for group in self._aggregate(schema, pipeline):
+            groupKey = group.pop('_id') or {}
+            groups.append((groupKey, group))
+        return groups
+
+    def countSeries(self, schema, query):
+        keyNames = schema.getKeyNames()
+        pipeline = [{'$match':query},
+                {'$group':{'_id':{k:'$'+k for k in keyNames}, 'n':{'$sum':1}}}]
+        return [(group['_id'], group['n'])
+                for group in self._aggregate(schema, pipeline)]
+
+    def remove(self, schema, query, getCounts=None):
+        if getCounts is not None:
+            counts = getCounts(self.countSeries(schema, query))
+        result = self._getCollection(schema).remove(query, **self.writeConcern)
+        if getCounts is not None:
+            self.addCounts(schema, counts)
+        return result['n']
+
+    def getCount(self, schema, counterId):
+        counter = self._getCountCollection(schema).find_one(
+                {'_id':SON(counterId)})
+        if counter is None:
+            return None
+        return counter['n']
+
+    def addCounts(self, schema, counts):
+        if len(counts) == 0:
+            return
+        bulk = self._getCountCollection(schema).initialize_unordered_bulk_op()
+        for (counterId, n) in counts.items():
+            bulk.find({'_id':SON(counterId)}).upsert().update_one(
+                    {'$inc':{'n':n}})
+        bulk.execute(self.writeConcern)
@@ -0,0 +1,79 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+Tests for the cache of Data packets and of the answers to prefix Interests:
+
+    python -m unittest test_packet_cache
+"""
+
+from pyndn import Name
+from packet_cache import PacketCache
+
+import unittest
+
+class PacketCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = PacketCache(1000)
+        self.seriesUri = '/bms/A/1'
+        for i in range(3):
+            self.cache.put('/bms/A/1/{}'.format(i), 'x'*100)
+        self.cache.putForPrefix(self.seriesUri, 1, '/bms/A/1/2', 'x'*100)
+        self.cache.putForPrefix('/bms', 0, '/bms/A/1/0', 'x'*100)
+
+    def testGet(self):
+        self.assertEqual(self.cache.get('/bms/A/1/0'), 'x'*100)
+        self.assertIsNone(self.cache.get('/bms/A/1/9'))
+        self.assertEqual(self.cache.getForPrefix(self.seriesUri, 1), 'x'*100)
+        self.assertIsNone(self.cache.getForPrefix(self.seriesUri, 0))
+        self.assertEqual(self.cache.getStats()['bytes'],
+                300 + len(self.seriesUri) + len('/bms'))
+
+    def testEvictsLeastRecentlyUsed(self):
+        self.cache.get('/bms/A/1/0')
+        for i in range(8):
+            self.cache.put('/bms/B/1/{}'.format(i), 'y'*100)
+        # 1 was used least recently, then 2, which answered the series
+        self.assertIsNone(self.cache.get('/bms/A/1/1'))
+        self.assertIsNone(self.cache.get('/bms/A/1/2'))
+        self.assertIsNone(self.cache.getForPrefix(self.seriesUri, 1))
+        self.assertIsNotNone(self.cache.get('/bms/A/1/0'))
+        self.assertLessEqual(self.cache.getStats()['bytes'], 1000)
+
+    def testInsertForgetsPrefixAnswers(self):
+        self.cache.invalidate(Name('/bms/A/1/3'))
+        self.assertIsNone(self.cache.getForPrefix(self.seriesUri, 1))
+        self.assertIsNone(self.cache.getForPrefix('/bms', 0))
+        # the packets themselves are still right
+        self.assertIsNotNone(self.cache.get('/bms/A/1/2'))
+
+    def testDeleteForgetsPacketsUnderPrefix(self):
+        self.cache.put('/bms/B/1/0', 'y'*100)
+        self.cache.invalidatePrefix(Name('/bms/A'))
+        for i in range(3):
+            self.assertIsNone(self.cache.get('/bms/A/1/{}'.format(i)))
+        self.assertIsNone(self.cache.getForPrefix(self.seriesUri, 1))
+        self.assertIsNone(self.cache.getForPrefix('/bms', 0))
+        self.assertIsNotNone(self.cache.get('/bms/B/1/0'))
+        stats = self.cache.getStats()
+        self.assertEqual((stats['packets'], stats['prefixes'],
+                stats['bytes']), (1, 0, 100))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,300 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+Regression tests for the repo, run on the benchmark's LoopbackFace and a
+scratch SQLite database:
+
+    python -m unittest test_repo
+"""
+
+from pyndn import Name, Data, Interest
+from bson import BSON
+from repo_benchmark import RepoBenchmark
+from sqlite_storage import SQLiteStorageEngine
+
+import trollius as asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+class RepoTestCase(unittest.TestCase):
+    """
+     Runs a repo of BMS readings from 2 buildings, 2 rooms and 2 panels (24
+     series), stored in a scratch database.
+    """
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp(prefix='repo-test')
+        self.storagePath = os.path.join(self.tempDir, 'bms.db')
+        self.benchmark = RepoBenchmark(SQLiteStorageEngine(self.storagePath),
+                buildings=2, rooms=2, panels=2)
+        self.repo = self.benchmark.repo
+        self.schema = self.benchmark.schema
+        self.loop = self.benchmark.loop
+
+    def tearDown(self):
+        if self.repo.isDatabaseOpen:
+            self.benchmark.close()
+        shutil.rmtree(self.tempDir, ignore_errors=True)
+
+    def insertReadings(self, count):
+        """
+        :return: The readings inserted, once they are written
+        """
+        readings = [self.benchmark.makeReading() for i in range(count)]
+        for data in readings:
+            self.assertTrue(self.repo.insertData(data))
+        self.loop.run_until_complete(self.repo.ingestBuffer.drain())
+        return readings
+
+    def expressInterest(self, interest):
+        """
+        :return: The repo's answer, decoded, or None if it didn't answer
+        """
+        sent = self.benchmark.face.deliverInterest(interest)
+        if len(sent) == 0:
+            return None
+        data = Data()
+        data.wireDecode(bytearray(sent[0]))
+        return data
+
+    def query(self, keyValues, params=None):
+        """
+        :return: (the name of segment 0 of the query's results, its content)
+        """
+        data = self.expressInterest(Interest(self.benchmark.makeQueryName(
+                keyValues, params)))
+        self.assertIsNotNone(data)
+        return (data.getName(), BSON(str(data.getContent())).decode())
+
+    def testSnapshotIsStable(self):
+        self.insertReadings(48)
+        (firstName, firstResult) = self.query({'building':'B0'})
+        version = firstName[-2].toVersion()
+
+        self.insertReadings(48)
+        # an equivalent query under the same version has no session or cached
+        # segments yet, so it is found again from the version's snapshot
+        sameName = self.benchmark.makeQueryName({'building':'B0'},
+                {'where':{'field':'ts', 'op':'>=', 'value':0}})
+        sameName.appendVersion(version).appendSegment(0)
+        again = self.expressInterest(Interest(sameName))
+        self.assertIsNotNone(again)
+        againResult = BSON(str(again.getContent())).decode()
+        self.assertEqual(againResult['results'], firstResult['results'])
+        self.assertEqual(againResult['count'], firstResult['count'])
+
+        (latestName, latestResult) = self.query({'building':'B0'})
+        self.assertNotEqual(latestName[-2].toVersion(), version)
+        self.assertEqual(latestResult['count'], 2*firstResult['count'])
+
+    def testInsertWithoutSchemaIsRefused(self):
+        response = self.benchmark.sendCommand('insert',
+                Name('/nothing/matches/this'))
+        self.assertIsNotNone(response)
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(response.HasField('process_id'))
+
+    def testShutdownWritesBufferedDocuments(self):
+        # nothing would be written for an hour, but for the shutdown
+        self.repo.ingestBuffer.maxDelay = 3600
+        for i in range(30):
+            self.repo.insertData(self.benchmark.makeReading())
+        self.assertEqual(self.repo.getIngestStats()['written'], 0)
+
+        self.repo.shutdown()
+        self.assertFalse(self.repo.isDatabaseOpen)
+        storage = SQLiteStorageEngine(self.storagePath)
+        storage.open()
+        try:
+            self.assertEqual(storage.count(self.schema, {}), 30)
+        finally:
+            storage.close()
+
+    def testCountsAfterDelete(self):
+        self.insertReadings(48)
+        removedCount = self.loop.run_until_complete(
+                self.repo.deleteData(self.schema, {'building':'B0'}))
+        self.assertEqual(removedCount, 24)
+
+        for (keyValues, expected) in (({}, 24), ({'building':'B0'}, 0),
+                ({'building':'B1'}, 24), ({'building':'B1', 'room':'1400'},
+                12)):
+            (name, result) = self.query(keyValues)
+            self.assertEqual(result['count'], expected)
+            self.assertTrue(result['countExact'])
+            self.assertEqual(len(result['results']), expected)
+
+    def testDeletedDataIsNotSent(self):
+        readings = self.insertReadings(6)
+        dataName = readings[0].getName()
+        latestInterest = Interest(dataName.getPrefix(-1))
+        latestInterest.setChildSelector(1)
+        # asked for once, so that both are answered from memory after
+        for interest in (Interest(dataName), latestInterest):
+            self.assertIsNotNone(self.expressInterest(interest))
+
+        removedCount = self.loop.run_until_complete(
+                self.repo.deleteData(self.schema, {}))
+        self.assertEqual(removedCount, 6)
+        self.assertIsNone(self.expressInterest(Interest(dataName)))
+        self.assertIsNone(self.expressInterest(latestInterest))
+
+    def testExcludeGivesNextReading(self):
+        readings = self.insertReadings(72)
+        # the series' first three readings are 0, 24 and 48
+        seriesName = readings[0].getName().getPrefix(-1)
+        interest = Interest(seriesName)
+        interest.setChildSelector(0)
+        interest.getExclude().appendAny()
+        interest.getExclude().appendComponent(readings[0].getName()[-1])
+        data = self.expressInterest(interest)
+        self.assertEqual(data.getName().toUri(),
+                readings[24].getName().toUri())
+
+    def testChildSelectorOnQueryNameIsAQuery(self):
+        self.insertReadings(24)
+        interest = Interest(self.benchmark.makeQueryName({'building':'B0'}))
+        interest.setChildSelector(1)
+        data = self.expressInterest(interest)
+        self.assertIsNotNone(data)
+        self.assertEqual(BSON(str(data.getContent())).decode()['count'], 12)
+
+    def queryError(self, name):
+        """
+        :return: The content of the repo's error response to an Interest
+        """
+        data = self.expressInterest(Interest(name))
+        self.assertIsNotNone(data)
+        self.assertEqual(data.getName().toUri(), name.toUri())
+        response = BSON(str(data.getContent())).decode()
+        self.assertNotIn('results', response)
+        return response
+
+    def testBadQueriesGetErrors(self):
+        self.insertReadings(24)
+        for params in ({'where':{'field':'nothing', 'op':'=', 'value':1}},
+                {'where':{'field':'room', 'op':'~', 'value':1}},
+                {'fields':['nothing']}, {'limit':-1},
+                {'after':{'asOf':'yesterday'}}):
+            response = self.queryError(self.benchmark.makeQueryName({},
+                    params))
+            self.assertEqual(response['status'], 400)
+
+        # the readings are encrypted, so there is no val to average
+        aggregate = {'functions':[{'op':'avg', 'field':'val'}],
+                'groupBy':['room'], 'bucket':{'field':'ts', 'seconds':900}}
+        response = self.queryError(self.benchmark.makeQueryName({},
+                {'aggregate':aggregate}))
+        self.assertEqual(response['status'], 400)
+        self.assertIn('val', response['error'])
+
+        badParams = self.benchmark.makeQueryName({}).append('\xc1garbage')
+        self.assertEqual(self.queryError(badParams)['status'], 400)
+        forgotten = self.benchmark.makeQueryName({}, {})
+        forgotten.appendVersion(1).appendSegment(0)
+        self.assertEqual(self.queryError(forgotten)['status'], 404)
+
+    def testCountsPerBucket(self):
+        # 30 minutes of readings, a minute apart, from 16:53:20 UTC: 7, 15
+        # and 8 of them in the 15 minute buckets they span, from each of the
+        # 6 series in a room
+        self.insertReadings(24*30)
+        aggregate = {'functions':[{'op':'count', 'field':'*'},
+                {'op':'max', 'field':'ts'}], 'groupBy':['room'],
+                'bucket':{'field':'ts', 'seconds':900}}
+        (name, result) = self.query({'building':'B0'},
+                {'aggregate':aggregate})
+        self.assertEqual(result['count'], 2*3)
+        self.assertEqual(sorted(g['count'] for g in result['results']),
+                [42, 42, 48, 48, 90, 90])
+        self.assertTrue(all('max_ts' in g for g in result['results']))
+
+    def testShutdownStopsWatches(self):
+        readings = [self.benchmark.makeReading() for i in range(24)]
+        for data in readings:
+            self.benchmark.face.putData(data)
+        seriesName = readings[0].getName().getPrefix(-1)
+        self.repo.watchInitialInterval = self.repo.watchMinInterval = 0.01
+        response = self.benchmark.sendCommand('watch start', seriesName)
+        self.assertEqual(response.status_code, 300)
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+
+        self.repo.shutdown()
+        expressedCount = self.benchmark.face.stats['expressed']
+        # a watch would poll and fetch again if it were still going
+        self.benchmark.face.putData(self.benchmark.makeReading())
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual(self.benchmark.face.stats['expressed'],
+                expressedCount)
+
+    def insertSegments(self, dataName, segmentCount, finalSegment=None,
+            **blockIds):
+        """
+        Publish segments of a reading, and send an insert command for them.
+        :return: The status code insert check gives once the insert is done
+        """
+        for segmentNum in range(segmentCount):
+            data = Data(Name(dataName).appendSegment(segmentNum))
+            data.setContent('segment {}'.format(segmentNum))
+            if finalSegment is not None:
+                data.getMetaInfo().setFinalBlockID(
+                        Name().appendSegment(finalSegment)[0])
+            self.benchmark.face.putData(data)
+        response = self.benchmark.sendCommand('insert', dataName, **blockIds)
+        self.assertEqual(response.status_code, 100)
+        for i in range(100):
+            self.loop.run_until_complete(asyncio.sleep(0.01))
+            check = self.benchmark.sendCommand('insert check',
+                    processId=response.process_id)
+            if check.status_code != 100:
+                return check.status_code
+        self.fail('Insert of {} did not finish'.format(dataName.toUri()))
+
+    def assertSegmentsStored(self, dataName, segmentNums):
+        for segmentNum in segmentNums:
+            data = self.expressInterest(Interest(Name(dataName).appendSegment(
+                    segmentNum)))
+            self.assertIsNotNone(data)
+            self.assertEqual(str(data.getContent()),
+                    'segment {}'.format(segmentNum))
+
+    def testSegmentedInsertUpToFinalBlockId(self):
+        dataName = self.benchmark.makeReading().getName()
+        self.assertEqual(self.insertSegments(dataName, 5, finalSegment=4,
+                startBlockId=0), 200)
+        self.assertSegmentsStored(dataName, range(5))
+
+    def testSegmentedInsertOfRange(self):
+        dataName = self.benchmark.makeReading().getName()
+        self.assertEqual(self.insertSegments(dataName, 8, startBlockId=2,
+                endBlockId=5), 200)
+        self.assertSegmentsStored(dataName, range(2, 6))
+        self.assertIsNone(self.expressInterest(Interest(
+                Name(dataName).appendSegment(6))))
+
+    def testSegmentedInsertWithoutEnd(self):
+        # no FinalBlockId: the insert ends at the first missing segment
+        dataName = self.benchmark.makeReading().getName()
+        self.assertEqual(self.insertSegments(dataName, 3, startBlockId=0), 200)
+        self.assertSegmentsStored(dataName, range(3))
+
+if __name__ == '__main__':
+    unittest.main()
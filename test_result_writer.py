@@ -0,0 +1,68 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+Tests for writing query results as CSV and JSON lines:
+
+    python -m unittest test_result_writer
+"""
+
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from datetime import datetime
+from result_writer import CsvResultWriter, JsonLinesResultWriter
+from StringIO import StringIO
+
+import json
+import unittest
+
+class ResultWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.objectId = ObjectId()
+        self.record = {'_id':self.objectId, 'room':u'1451',
+                'ts':datetime(2014, 10, 1, 10, 0), 'value':Binary('\x01\xff'),
+                'val':1.5}
+
+    def testJsonLines(self):
+        outFile = StringIO()
+        writer = JsonLinesResultWriter(outFile)
+        writer.writeRecords([self.record, {}, {'room':'1452'}])
+        lines = outFile.getvalue().splitlines()
+        self.assertEqual(writer.recordCount, 2)
+        self.assertEqual(json.loads(lines[0]), {'_id':str(self.objectId),
+                'room':'1451', 'ts':'2014-10-01T10:00:00', 'value':'01ff',
+                'val':1.5})
+        self.assertEqual(json.loads(lines[1]), {'room':'1452'})
+
+    def testJsonLinesRefusesUnknownTypes(self):
+        writer = JsonLinesResultWriter(StringIO())
+        with self.assertRaises(TypeError) as context:
+            writer.writeRecords([{'room':'1451', 'odd':object()}])
+        self.assertIn('object', str(context.exception))
+
+    def testCsv(self):
+        outFile = StringIO()
+        writer = CsvResultWriter(outFile)
+        writer.writeRecords([self.record, {'room':'1452', 'extra':1}])
+        self.assertEqual(outFile.getvalue().splitlines(),
+                ['ts,room,val,value', '2014-10-01T10:00:00,1451,1.5,01ff',
+                ',1452,,'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+Tests for fetching a range of segments with a window of Interests, run on the
+benchmark's LoopbackFace, where a missing segment times out at once:
+
+    python -m unittest test_segment_fetcher
+"""
+
+from pyndn import Name, Data
+from repo_benchmark import LoopbackFace
+from segment_fetcher import SegmentFetcher
+
+import trollius as asyncio
+import unittest
+
+class SegmentFetcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.face = LoopbackFace(self.loop)
+        self.baseName = Name('/bms/A/1/reading')
+        self.received = []
+        self.failed = []
+        self.completeCount = 0
+        self._done = None
+
+    def publish(self, segmentNums, finalSegment=None):
+        for segmentNum in segmentNums:
+            data = Data(Name(self.baseName).appendSegment(segmentNum))
+            data.setContent('segment {}'.format(segmentNum))
+            if finalSegment is not None:
+                data.getMetaInfo().setFinalBlockID(
+                        Name().appendSegment(finalSegment)[0])
+            self.face.putData(data)
+
+    def fetch(self, startSegment, endSegment, **kwargs):
+        """
+        Run a fetcher until it completes or fails.
+        :return: The fetcher
+        """
+        self._done = asyncio.Future()
+        fetcher = SegmentFetcher(self.face, self.baseName, startSegment,
+                endSegment, self.onSegment, self.onComplete, self.onFailed,
+                **kwargs)
+        fetcher.start()
+        self.loop.run_until_complete(asyncio.wait_for(self._done, 5))
+        # anything still arriving would be counted too
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        return fetcher
+
+    def onSegment(self, segmentNum, data):
+        self.assertEqual(str(data.getContent()),
+                'segment {}'.format(segmentNum))
+        self.received.append(segmentNum)
+
+    def onComplete(self):
+        self.completeCount += 1
+        if not self._done.done():
+            self._done.set_result(None)
+
+    def onFailed(self, segmentNum):
+        self.failed.append(segmentNum)
+        if not self._done.done():
+            self._done.set_result(None)
+
+    def testFetchesRange(self):
+        self.publish(range(10))
+        self.fetch(2, 7)
+        self.assertEqual(sorted(self.received), range(2, 8))
+        self.assertEqual((self.completeCount, self.failed), (1, []))
+
+    def testStopsAtFinalBlockId(self):
+        self.publish(range(10), finalSegment=9)
+        fetcher = self.fetch(0, None)
+        self.assertEqual(sorted(self.received), range(10))
+        self.assertEqual((self.completeCount, self.failed), (1, []))
+        self.assertTrue(fetcher.isEndKnown)
+
+    def testEndsAtFirstMissingSegmentWithoutEnd(self):
+        self.publish(range(6))
+        fetcher = self.fetch(0, None, maxRetries=2)
+        self.assertEqual(sorted(self.received), range(6))
+        self.assertEqual((self.completeCount, self.failed), (1, []))
+        self.assertEqual(fetcher.endSegment, 5)
+        self.assertFalse(fetcher.isEndKnown)
+
+    def testFailsOnMissingSegment(self):
+        self.publish([s for s in range(10) if s != 4])
+        self.fetch(0, 9, maxRetries=2)
+        self.assertEqual(self.failed, [4])
+        self.assertEqual(self.completeCount, 0)
+
+    def testWindowGrowsAndIsHalvedOnTimeout(self):
+        self.publish(range(40))
+        fetcher = self.fetch(0, 39, initialWindow=2, maxWindow=16)
+        self.assertGreater(fetcher.window, 2)
+        self.assertLessEqual(fetcher.window, 16)
+        self.assertTrue(fetcher.minLifetime <= fetcher.lifetime <=
+                fetcher.maxLifetime)
+
+        fetcher = self.fetch(40, 40, initialWindow=8, maxRetries=3)
+        self.assertEqual(self.failed, [40])
+        # halved on each of the 4 timeouts, down to 1
+        self.assertEqual(fetcher.window, 1.0)
+        self.assertEqual(fetcher.lifetime, fetcher.maxLifetime)
+
+if __name__ == '__main__':
+    unittest.main()
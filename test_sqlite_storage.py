@@ -0,0 +1,171 @@
+# -*- Mode:python; c-file-style:"gnu"; indent-tabs-mode:nil -*- */
+#
+# Copyright (C) 2014 Regents of the University of California.
+# Author: Adeola Bannis <thecodemaiden@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# A copy of the GNU General Public License is in the file COPYING.
+
+"""
+Tests that the SQLite storage engine answers MongoDB-style queries as MongoDB
+would:
+
+    python -m unittest test_sqlite_storage
+"""
+
+from pyndn import Name
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
+from repo import NdnSchema
+from sqlite_storage import SQLiteStorageEngine
+from storage_engine import ASCENDING, DESCENDING
+
+import hashlib
+import unittest
+
+START_TIME = datetime(2014, 10, 1, 10, 0)
+
+class SQLiteStorageTestCase(unittest.TestCase):
+    """
+     Stores 12 documents, from rooms 1 to 3 of buildings A and B, a minute
+     apart. Every fourth has no reading.
+    """
+    def setUp(self):
+        self.schema = NdnSchema(Name('/test/<building>/<room>'),
+                schemaName='test')
+        self.schema.addField('value', NdnSchema.SCHEMA_BINARY)
+        self.schema.addField('ts', NdnSchema.SCHEMA_TIMESTAMP)
+        self.schema.addField('reading', NdnSchema.SCHEMA_FLOAT)
+        self.storage = SQLiteStorageEngine(':memory:')
+        self.storage.open()
+        self.storage.ensureIndexes(self.schema)
+
+        self.documents = []
+        for i in range(12):
+            document = {'_id':ObjectId(), 'building':'AB'[i/6],
+                    'room':str(i%3 + 1), 'ts':START_TIME + timedelta(minutes=i),
+                    'value':Binary('v{}'.format(i)),
+                    NdnSchema.NAME_DIGEST_FIELD:Binary(
+                    hashlib.sha1(str(i)).digest())}
+            if i%4 != 0:
+                document['reading'] = float(i)
+            self.documents.append(document)
+        self.storage.bulkUpsert(self.schema, self.documents)
+
+    def tearDown(self):
+        self.storage.close()
+
+    def assertFinds(self, query, matches):
+        """
+        Check that the query finds exactly the documents that matches() is
+        true of.
+        """
+        expected = sorted(d['_id'] for d in self.documents if matches(d))
+        found = sorted(d['_id'] for d in self.storage.find(self.schema,
+                query))
+        self.assertEqual(found, expected)
+        self.assertEqual(self.storage.count(self.schema, query),
+                len(expected))
+
+    def testEquality(self):
+        self.assertFinds({}, lambda d: True)
+        self.assertFinds({'building':'A', 'room':'2'},
+                lambda d: d['building'] == 'A' and d['room'] == '2')
+        self.assertFinds({'reading':None}, lambda d: 'reading' not in d)
+
+    def testComparisons(self):
+        since = START_TIME + timedelta(minutes=3)
+        until = START_TIME + timedelta(minutes=8)
+        self.assertFinds({'ts':{'$gte':since, '$lt':until}},
+                lambda d: since <= d['ts'] < until)
+        self.assertFinds({'ts':{'$gt':since}}, lambda d: d['ts'] > since)
+        self.assertFinds({'ts':{'$lte':since}}, lambda d: d['ts'] <= since)
+        self.assertFinds({'reading':{'$gt':5.0}},
+                lambda d: d.get('reading', 0) > 5)
+
+    def testNotEqualMatchesMissingFields(self):
+        # as in MongoDB, a document without the field is not equal to it
+        self.assertFinds({'reading':{'$ne':5.0}},
+                lambda d: d.get('reading') != 5.0)
+        self.assertFinds({'room':{'$ne':'1'}}, lambda d: d['room'] != '1')
+
+    def testInAndExists(self):
+        self.assertFinds({'room':{'$in':['1', '3']}},
+                lambda d: d['room'] in ('1', '3'))
+        self.assertFinds({'room':{'$in':[]}}, lambda d: False)
+        self.assertFinds({'reading':{'$exists':True}},
+                lambda d: 'reading' in d)
+        self.assertFinds({'reading':{'$exists':False}},
+                lambda d: 'reading' not in d)
+
+    def testAndOr(self):
+        self.assertFinds({'$or':[{'building':'B'}, {'room':'1'}]},
+                lambda d: d['building'] == 'B' or d['room'] == '1')
+        self.assertFinds({'building':'A', '$or':[{'room':'1'},
+                {'reading':{'$gt':4.0}}]}, lambda d: d['building'] == 'A' and
+                (d['room'] == '1' or d.get('reading', 0) > 4))
+        self.assertFinds({'$and':[{'ts':{'$gt':START_TIME}},
+                {'ts':{'$lt':START_TIME + timedelta(minutes=5)}}]},
+                lambda d: START_TIME < d['ts'] <
+                START_TIME + timedelta(minutes=5))
+        self.assertFinds({'$and':[]}, lambda d: True)
+
+    def testUnknownFieldsAndOperators(self):
+        for query in ({'nothing':1}, {'room':{'$regex':'1'}},
+                {'$nor':[{'room':'1'}]}):
+            with self.assertRaises(ValueError):
+                self.storage.count(self.schema, query)
+
+    def testProjectionSortAndLimit(self):
+        found = list(self.storage.find(self.schema, {'building':'A'},
+                {'room':True}, [('ts', DESCENDING)], skip=1, limit=3))
+        self.assertEqual([set(d) for d in found], [set(['_id', 'room'])]*3)
+        self.assertEqual([d['_id'] for d in found],
+                [d['_id'] for d in self.documents[4:1:-1]])
+
+        found = self.storage.findOne(self.schema, {}, {'value':False},
+                [('ts', ASCENDING)])
+        self.assertNotIn('value', found)
+        self.assertEqual(found['ts'], START_TIME)
+
+    def testDistinctAndGroup(self):
+        self.assertEqual(sorted(self.storage.distinct(self.schema,
+                {'building':'B'}, 'room')), ['1', '2', '3'])
+        groups = self.storage.group(self.schema, {}, {'groupBy':['building'],
+                'bucket':None, 'functions':[{'op':'max', 'field':'reading'},
+                {'op':'count', 'field':'*'}]})
+        self.assertEqual([(k['building'], v['count'], v['max_reading'])
+                for (k, v) in groups], [('A', 6, 5.0), ('B', 6, 11.0)])
+
+    def testRemoveWithCounts(self):
+        self.storage.addCounts(self.schema, {():12, (('building', 'A'),):6})
+        seriesCounts = []
+        def getCounts(counted):
+            seriesCounts.extend(counted)
+            return {():-sum(n for (k, n) in counted),
+                    (('building', 'A'),):-sum(n for (k, n) in counted
+                    if k['building'] == 'A')}
+        removedCount = self.storage.remove(self.schema, {'room':'1'},
+                getCounts)
+        self.assertEqual(removedCount, 4)
+        self.assertEqual(sorted((k['building'], k['room'], n)
+                for (k, n) in seriesCounts), [('A', '1', 2), ('B', '1', 2)])
+        self.assertEqual(self.storage.getCount(self.schema, ()), 8)
+        self.assertEqual(self.storage.getCount(self.schema,
+                (('building', 'A'),)), 4)
+        self.assertEqual(self.storage.count(self.schema, {}), 8)
+
+if __name__ == '__main__':
+    unittest.main()